@@ -1,6 +1,7 @@
 from django.contrib import admin
 from django.contrib.auth.admin import UserAdmin
 from .models import Account, Contact, Message
+from .sharding import is_sharded
 
 
 @admin.register(Account)
@@ -59,6 +60,7 @@ class AccountAdmin(admin.ModelAdmin):
 @admin.register(Contact)
 class ContactAdmin(admin.ModelAdmin):
     list_display = ['user', 'contact', 'custom_name', 'is_accepted', 'created_at']
+    list_select_related = ['user', 'contact']
     list_filter = ['is_accepted', 'created_at']
     search_fields = ['user__username', 'contact__username', 'custom_name']
     readonly_fields = ['created_at', 'accepted_at']
@@ -69,4 +71,11 @@ class MessageAdmin(admin.ModelAdmin):
     list_display = ['sender', 'receiver', 'created_at']
     list_filter = ['created_at']
     search_fields = ['sender__username', 'receiver__username', 'text']
-    readonly_fields = ['created_at']
\ No newline at end of file
+    readonly_fields = ['created_at']
+
+    def get_queryset(self, request):
+        qs = super().get_queryset(request)
+        # Sharded messages can't be joined to accounts: two IN queries instead
+        if is_sharded():
+            return qs.prefetch_related('sender', 'receiver')
+        return qs.select_related('sender', 'receiver')
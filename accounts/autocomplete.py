@@ -0,0 +1,187 @@
+# accounts/autocomplete.py
+"""
+In-process prefix index for username / first name autocomplete.
+
+Every account contributes one entry per non-empty ``username`` and
+``first_name``: a single string ``"<lowercased key>\\0<id>\\0<username>\\0<first_name>"``
+kept in one sorted list. A prefix lookup is a ``bisect`` to the first entry
+>= the prefix and a short walk forward, so suggestions come back in
+microseconds and without a query. One ``str`` per entry plus an
+``id -> entries`` map keeps it to roughly 300 bytes per account (see
+``bench_autocomplete``).
+
+``autocomplete_index`` is filled by ``warm()``; updates that arrive while it
+loads are replayed after. The ``Account`` signals in ``accounts.signals``
+keep it current within the process. ``run()``, started by the ASGI process,
+warms it and then every ``AUTOCOMPLETE_REFRESH_INTERVAL`` seconds applies
+the accounts whose ``updated_at`` moved since, which covers saves made by
+other processes. Deletes there and ``update()`` calls that skip
+``updated_at`` wait for the full warm every ``AUTOCOMPLETE_REWARM_INTERVAL``
+seconds.
+"""
+import asyncio
+import logging
+import threading
+import time
+from bisect import bisect_left, insort
+from datetime import timedelta
+
+from django.conf import settings
+from django.utils import timezone
+
+from .db_executor import consumer_db
+from .models import Account
+
+logger = logging.getLogger(__name__)
+
+SEPARATOR = '\0'
+# Other processes' clocks, and saves that commit after their updated_at
+REFRESH_OVERLAP = timedelta(seconds=5)
+
+
+def _entries(id, username, first_name):
+    entries = []
+    for key in (username, first_name):
+        key = (key or '').lower()
+        if key and SEPARATOR not in key:
+            entry = SEPARATOR.join((key, str(id), username or '', first_name or ''))
+            if entry not in entries:
+                entries.append(entry)
+    return tuple(entries)
+
+
+class PrefixIndex:
+    def __init__(self):
+        self.entries = []  # sorted
+        self.by_id = {}  # id -> that account's entries
+        self.ready = False
+        self.loading = False
+        self.running = False
+        self.pending = []  # updates received while loading
+        self.loaded_at = None  # database changes before this are in the index
+        self.warmed_at = None  # monotonic
+        self.lookups = 0
+        self.refreshed = 0
+        self.lock = threading.Lock()
+
+    def warm(self, chunk_size=20000):
+        """Load every account from the database; returns the number indexed."""
+        started = time.monotonic()
+        loaded_at = timezone.now()
+        count = self.load(
+            Account.objects.values_list('id', 'username', 'first_name').iterator(chunk_size=chunk_size)
+        )
+        self.loaded_at, self.warmed_at = loaded_at, started
+        logger.info(f"🔤 Autocomplete index warmed: {count} accounts in {time.monotonic() - started:.2f}s")
+        return count
+
+    def load(self, rows):
+        """Replace the index with ``(id, username, first_name)`` rows."""
+        with self.lock:
+            self.loading = True
+            self.pending = []
+
+        entries, by_id = [], {}
+        for id, username, first_name in rows:
+            account_entries = _entries(id, username, first_name)
+            if account_entries:
+                by_id[id] = account_entries
+                entries.extend(account_entries)
+        entries.sort()
+
+        with self.lock:
+            self.entries, self.by_id = entries, by_id
+            self.loading = False
+            self.ready = True
+            pending, self.pending = self.pending, []
+            for args in pending:
+                self._apply(*args)
+        return len(by_id)
+
+    def refresh(self):
+        """Apply accounts saved since the last warm or refresh; returns how many."""
+        since, self.loaded_at = self.loaded_at, timezone.now()
+        rows = Account.objects.filter(
+            updated_at__gte=since - REFRESH_OVERLAP
+        ).values_list('id', 'username', 'first_name')
+        count = 0
+        for row in rows.iterator():
+            self.update(*row)
+            count += 1
+        self.refreshed += count
+        return count
+
+    async def run(self):
+        """In-process loop started by accounts.background."""
+        interval = getattr(settings, 'AUTOCOMPLETE_REFRESH_INTERVAL', 60)
+        rewarm = getattr(settings, 'AUTOCOMPLETE_REWARM_INTERVAL', 3600)
+        self.running = True
+        try:
+            while True:
+                try:
+                    if not self.ready or time.monotonic() - self.warmed_at >= rewarm:
+                        await consumer_db(self.warm)()
+                    else:
+                        await consumer_db(self.refresh)()
+                except Exception as e:
+                    logger.error(f"❌ Autocomplete refresh error: {str(e)}", exc_info=True)
+                await asyncio.sleep(interval)
+        finally:
+            self.running = False
+
+    def update(self, id, username, first_name):
+        with self.lock:
+            if self.loading:
+                self.pending.append((id, username, first_name))
+            elif not self.ready:
+                # Not warmed in this process (management commands, tests)
+                return
+            self._apply(id, username, first_name)
+
+    def remove(self, id):
+        self.update(id, None, None)
+
+    def _apply(self, id, username, first_name):
+        for entry in self.by_id.pop(id, ()):
+            i = bisect_left(self.entries, entry)
+            if i < len(self.entries) and self.entries[i] == entry:
+                del self.entries[i]
+        account_entries = _entries(id, username, first_name)
+        if account_entries:
+            self.by_id[id] = account_entries
+            for entry in account_entries:
+                insort(self.entries, entry)
+
+    def suggest(self, prefix, limit=10, exclude_id=None):
+        """Up to ``limit`` accounts whose username or first name starts with ``prefix``."""
+        prefix = prefix.lower()
+        results, seen = [], set()
+        if not prefix:
+            return results
+        with self.lock:
+            self.lookups += 1
+            i = bisect_left(self.entries, prefix)
+            while i < len(self.entries) and len(results) < limit:
+                entry = self.entries[i]
+                if not entry.startswith(prefix):
+                    break
+                i += 1
+                _, id, username, first_name = entry.split(SEPARATOR)
+                id = int(id)
+                if id in seen or id == exclude_id:
+                    continue
+                seen.add(id)
+                results.append({'id': id, 'username': username, 'first_name': first_name})
+        return results
+
+    def stats(self):
+        return {
+            'ready': self.ready,
+            'accounts': len(self.by_id),
+            'entries': len(self.entries),
+            'lookups': self.lookups,
+            'refreshed': self.refreshed,
+        }
+
+
+autocomplete_index = PrefixIndex()
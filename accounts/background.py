@@ -0,0 +1,60 @@
+# accounts/background.py
+"""
+Long-running asyncio tasks of the ASGI process.
+
+Daphne has no lifespan events, so ``BackgroundTasksMiddleware`` starts the
+tasks on the first HTTP request or WebSocket connection handled by the
+event loop.
+"""
+import asyncio
+import logging
+
+from django.conf import settings
+
+logger = logging.getLogger(__name__)
+
+_started = set()
+
+
+def ensure_background_tasks():
+    loop = asyncio.get_running_loop()
+    if loop in _started:
+        return
+    _started.add(loop)
+
+    if getattr(settings, 'MESSAGE_REAPER_ENABLED', False):
+        from .reaper import run_reaper
+        loop.create_task(run_reaper())
+        logger.info("🗑️ Message reaper started")
+
+    if getattr(settings, 'EXPIRY_EVENTS_ENABLED', False):
+        from .expiry import expiry_scheduler
+        loop.create_task(expiry_scheduler.run())
+        logger.info("⏱️ Expiry scheduler started")
+
+    if getattr(settings, 'AUTOCOMPLETE_ENABLED', False):
+        from .autocomplete import autocomplete_index
+        if not autocomplete_index.running:
+            loop.create_task(autocomplete_index.run())
+            logger.info("🔤 Autocomplete index warming")
+
+    if getattr(settings, 'MEDIA_GC_ENABLED', False):
+        from .media_gc import media_collector
+        loop.create_task(media_collector.run())
+        logger.info("🧹 Media GC started")
+
+    if getattr(settings, 'THUMBNAIL_WORKER_ENABLED', False):
+        from .thumbnails import thumbnail_worker
+        if not thumbnail_worker.running:
+            loop.create_task(thumbnail_worker.run())
+            logger.info("🖼️ Thumbnail worker started")
+
+
+class BackgroundTasksMiddleware:
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] in ('http', 'websocket'):
+            ensure_background_tasks()
+        return await self.app(scope, receive, send)
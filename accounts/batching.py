@@ -0,0 +1,120 @@
+# accounts/batching.py
+"""
+Write-behind persistence for chat messages.
+
+Consumers hand unsaved ``Message`` instances to the process-wide
+``MessageBatcher``; it coalesces everything queued by all connections into
+one ``bulk_create`` per message shard once ``MESSAGE_BATCH_SIZE`` messages are pending or
+``MESSAGE_BATCH_DELAY`` seconds have passed, and resolves each caller's
+future after the batch has committed.
+"""
+import asyncio
+import logging
+
+from django.conf import settings
+from django.db import transaction
+
+from .db_executor import db_writer
+from .models import Message
+from .sharding import conversation_key, group_by_shard
+
+logger = logging.getLogger(__name__)
+
+
+class MessageBatcher:
+    def __init__(self, max_batch=None, max_delay=None):
+        self.max_batch = max_batch or getattr(settings, 'MESSAGE_BATCH_SIZE', 200)
+        self.max_delay = max_delay or getattr(settings, 'MESSAGE_BATCH_DELAY', 0.05)
+        self.queue = asyncio.Queue()
+        self.task = None
+
+    def submit(self, message):
+        """Queue an unsaved message; the returned future resolves to the saved row."""
+        if self.task is None or self.task.done():
+            self.task = asyncio.get_running_loop().create_task(self.run())
+        future = asyncio.get_running_loop().create_future()
+        self.queue.put_nowait((message, future))
+        return future
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await self.queue.get()]
+            deadline = loop.time() + self.max_delay
+            while len(batch) < self.max_batch:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self.queue.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+            await self.flush(batch)
+
+    async def flush(self, batch):
+        messages = [message for message, _ in batch]
+        try:
+            results = await self.save(messages)
+        except Exception as e:
+            logger.error(f"❌ Batch flush failed: {str(e)}", exc_info=True)
+            results = [e] * len(messages)
+
+        for (_, future), result in zip(batch, results):
+            if future.done():
+                continue
+            if isinstance(result, Exception):
+                future.set_exception(result)
+            else:
+                future.set_result(result)
+
+    async def save(self, messages):
+        """Save ``messages`` on their shards; results come back in the same order."""
+        shards = group_by_shard(range(len(messages)), lambda i: (messages[i].sender_id, messages[i].receiver_id))
+        saved = await asyncio.gather(*(
+            db_writer.using(alias)(save_messages)(alias, [messages[i] for i in indexes])
+            for alias, indexes in shards.items()
+        ))
+        results = [None] * len(messages)
+        for indexes, shard_results in zip(shards.values(), saved):
+            for i, result in zip(indexes, shard_results):
+                results[i] = result
+        return results
+
+
+def save_messages(alias, messages):
+    for message in messages:
+        # bulk_create() doesn't call Message.save()
+        message.conversation_key = conversation_key(message.sender_id, message.receiver_id)
+    try:
+        with transaction.atomic(using=alias):
+            saved = Message.objects.using(alias).bulk_create(messages)
+        logger.info(f"💾 Batch saved: {len(saved)} messages")
+        return saved
+    except Exception as e:
+        # One bad row (e.g. a deleted receiver) must not fail the whole batch
+        logger.warning(f"⚠️ Bulk insert failed ({str(e)}), saving one by one")
+
+    results = []
+    for message in messages:
+        try:
+            with transaction.atomic(using=alias):
+                message.save(using=alias)
+            results.append(message)
+        except Exception as e:
+            results.append(e)
+    return results
+
+
+_batchers = {}
+
+
+def get_message_batcher():
+    """Return the batcher bound to the running event loop."""
+    loop = asyncio.get_running_loop()
+    batcher = _batchers.get(loop)
+    if batcher is None:
+        # Drop batchers of closed loops (tests, management commands)
+        for old_loop in [l for l in _batchers if l.is_closed()]:
+            del _batchers[old_loop]
+        batcher = _batchers[loop] = MessageBatcher()
+    return batcher
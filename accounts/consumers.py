@@ -1,8 +1,16 @@
 # chat/consumers.py
-import json
+import asyncio
 from channels.generic.websocket import AsyncWebsocketConsumer
-from channels.db import database_sync_to_async
-from accounts.models import Account, Contact, Message
+from accounts.models import Contact, Message
+from accounts.batching import get_message_batcher
+from accounts.ephemeral import ephemeral_store, is_ephemeral
+from accounts.expiry import expiry_scheduler
+from accounts.identity import identity_cache
+from accounts.presence import get_presence_registry
+from accounts.querycount import query_report, track_queries
+from accounts.serialization import dumps_text, loads
+from accounts.receipts import get_read_receipts, parse_read_mark
+from django.conf import settings
 from django.utils import timezone
 from datetime import timedelta
 import logging
@@ -25,8 +33,9 @@ class ChatConsumer(AsyncWebsocketConsumer):
 
         await self.accept()
         
-        # Set user online
-        await self.set_user_online(self.user_id, True)
+        # Set user online (written to the DB in batches)
+        get_presence_registry().connect(self.user_id)
+        self.account_id = await self.get_account_id(self.user_id)
         logger.info(f"✅ User {self.user_id} connected to {self.room_group_name}")
 
     async def disconnect(self, close_code):
@@ -38,28 +47,33 @@ class ChatConsumer(AsyncWebsocketConsumer):
             self.channel_name
         )
         
-        # Set user offline
-        await self.set_user_online(self.user_id, False)
+        # Set user offline once the last tab is closed
+        get_presence_registry().disconnect(self.user_id)
         logger.info(f"❌ User {self.user_id} disconnected")
 
     async def receive(self, text_data):
-        try:
-            data = json.loads(text_data)
-            message_type = data.get('type')
+        message_type = None
+        with track_queries() as stats:
+            try:
+                data = loads(text_data)
+                message_type = data.get('type')
+                
+                logger.info(f"📨 Received message: type={message_type}, data={data}")
+
+                if message_type == 'send_message':
+                    await self.handle_send_message(data)
+                elif message_type == 'contact_request':
+                    await self.handle_contact_request(data)
+                elif message_type == 'accept_contact':
+                    await self.handle_accept_contact(data)
+                elif message_type == 'mark_read':
+                    await self.handle_mark_read(data)
+                else:
+                    logger.warning(f"⚠️ Unknown message type: {message_type}")
             
-            logger.info(f"📨 Received message: type={message_type}, data={data}")
-
-            if message_type == 'send_message':
-                await self.handle_send_message(data)
-            elif message_type == 'contact_request':
-                await self.handle_contact_request(data)
-            elif message_type == 'accept_contact':
-                await self.handle_accept_contact(data)
-            else:
-                logger.warning(f"⚠️ Unknown message type: {message_type}")
-        
-        except Exception as e:
-            logger.error(f"❌ Error in receive: {str(e)}", exc_info=True)
+            except Exception as e:
+                logger.error(f"❌ Error in receive: {str(e)}", exc_info=True)
+        query_report.report(f'WS {message_type}', stats)
 
     async def handle_send_message(self, data):
         try:
@@ -69,36 +83,65 @@ class ChatConsumer(AsyncWebsocketConsumer):
 
             logger.info(f"💬 Sending message: from={self.user_id}, to={to_user_id}, text={message_text[:50]}")
 
-            # Save message to database
-            message = await self.save_message(
-                sender_telegram_id=int(self.user_id),  # ✅ Convert to int for DB query
-                receiver_id=to_user_id,
-                content=message_text
-            )
+            if not self.account_id:
+                logger.error("❌ Sender account not found")
+                return
 
-            if not message:
-                logger.error("❌ Failed to save message")
+            # Message expires in CHAT_MESSAGE_TTL seconds unless the client asks otherwise
+            try:
+                ttl = int(data.get('expire_seconds') or settings.CHAT_MESSAGE_TTL)
+            except (TypeError, ValueError, OverflowError):
+                ttl = 0
+            if ttl < 1:
+                logger.warning(f"⚠️ Invalid expire_seconds: {data.get('expire_seconds')!r}")
+                await self.send(text_data=dumps_text({
+                    'type': 'message_failed',
+                    'message_id': message_id,
+                    'error': 'Invalid expire_seconds',
+                }))
                 return
+            ttl = min(ttl, getattr(settings, 'CHAT_MESSAGE_MAX_TTL', 30 * 24 * 60 * 60))
 
             # Get receiver's telegram_id
             receiver_telegram_id = await self.get_telegram_id(to_user_id)
-            
-            if receiver_telegram_id:
-                # Send to receiver
-                await self.channel_layer.group_send(
-                    f'chat_{receiver_telegram_id}',
-                    {
-                        'type': 'chat_message',
-                        'message': message_text,
-                        'from_user_id': self.user_id,
-                        'message_id': message_id,
-                        'timestamp': message.created_at.isoformat()
-                    }
-                )
-                logger.info(f"✅ Message sent to chat_{receiver_telegram_id}")
-            else:
+            if not receiver_telegram_id:
                 logger.error(f"❌ Receiver not found: {to_user_id}")
-        
+                return
+
+            now = timezone.now()
+            expires_at = now + timedelta(seconds=ttl)
+
+            saved = None
+            if is_ephemeral(ttl):
+                # Short-lived: keep it in memory, never touches SQLite
+                saved = ephemeral_store.add(
+                    self.account_id, to_user_id, message_text, now, expires_at
+                )
+            if saved is None:
+                # Queue the message for the next batched INSERT
+                saved = get_message_batcher().submit(Message(
+                    sender_id=self.account_id,
+                    receiver_id=int(to_user_id),
+                    text=message_text,
+                    expires_at=expires_at
+                ))
+
+            # Deliver right away, the receiver doesn't wait for the flush
+            await self.channel_layer.group_send(
+                f'chat_{receiver_telegram_id}',
+                {
+                    'type': 'chat_message',
+                    'message': message_text,
+                    'from_user_id': self.user_id,
+                    'message_id': message_id,
+                    'timestamp': now.isoformat()
+                }
+            )
+            logger.info(f"✅ Message sent to chat_{receiver_telegram_id}")
+
+            # Durability ack goes back to the sender once the batch commits
+            asyncio.ensure_future(self.ack_message(saved, message_id, receiver_telegram_id))
+
         except Exception as e:
             logger.error(f"❌ Error sending message: {str(e)}", exc_info=True)
 
@@ -154,9 +197,50 @@ class ChatConsumer(AsyncWebsocketConsumer):
         except Exception as e:
             logger.error(f"❌ Error accepting contact: {str(e)}", exc_info=True)
 
+    async def handle_mark_read(self, data):
+        try:
+            contact_id = int(data.get('contact_id'))
+            up_to, ephemeral_up_to = parse_read_mark(data.get('up_to'), data.get('ephemeral_up_to'))
+        except (TypeError, ValueError) as e:
+            logger.warning(f"⚠️ Invalid mark_read: {str(e)}")
+            return
+
+        if not self.account_id:
+            logger.error("❌ Reader account not found")
+            return
+
+        # Coalesced with other marks and written on the next flush
+        get_read_receipts().mark(self.account_id, contact_id, up_to, ephemeral_up_to)
+
+    async def ack_message(self, saved, message_id, receiver_telegram_id):
+        try:
+            if isinstance(saved, dict):
+                # In-memory message, stored already
+                message_pk, created_at, expires_at = saved['id'], saved['created_at'], saved['expires_at']
+            else:
+                message = await saved
+                message_pk, created_at, expires_at = message.id, message.created_at, message.expires_at
+            expiry_scheduler.schedule(message_pk, expires_at, self.user_id, receiver_telegram_id)
+            ack = {
+                'type': 'message_saved',
+                'message_id': message_id,
+                'id': message_pk,
+                'timestamp': created_at.isoformat(),
+                'expires_at': expires_at.isoformat(),
+            }
+        except Exception as e:
+            logger.error(f"❌ Failed to save message: {str(e)}")
+            ack = {'type': 'message_failed', 'message_id': message_id}
+
+        try:
+            await self.send(text_data=dumps_text(ack))
+        except Exception as e:
+            # Socket may already be closed
+            logger.warning(f"⚠️ Could not deliver ack: {str(e)}")
+
     # WebSocket message handlers
     async def chat_message(self, event):
-        await self.send(text_data=json.dumps({
+        await self.send(text_data=dumps_text({
             'type': 'new_message',
             'message': event['message'],
             'from_user_id': event['from_user_id'],
@@ -165,65 +249,72 @@ class ChatConsumer(AsyncWebsocketConsumer):
         }))
 
     async def contact_request_notification(self, event):
-        await self.send(text_data=json.dumps({
+        await self.send(text_data=dumps_text({
             'type': 'contact_request',
             'from_user_id': event['from_user_id'],
             'from_name': event['from_name']
         }))
 
     async def contact_accepted_notification(self, event):
-        await self.send(text_data=json.dumps({
+        await self.send(text_data=dumps_text({
             'type': 'contact_accepted',
             'user_id': event['user_id']
         }))
 
-    # Database operations
-    @database_sync_to_async
-    def save_message(self, sender_telegram_id, receiver_id, content):
-        try:
-            sender = Account.objects.get(telegram_id=sender_telegram_id)
-            receiver = Account.objects.get(id=receiver_id)
-            
-            # Message expires in 30 seconds (configurable)
-            expires_at = timezone.now() + timedelta(seconds=30)
-            
-            message = Message.objects.create(
-                sender=sender,
-                receiver=receiver,
-                text=content,  # ✅ Fixed: Use 'text' field instead of 'content'
-                expires_at=expires_at
-            )
-            logger.info(f"💾 Message saved: id={message.id}")
-            return message
-        except Account.DoesNotExist as e:
-            logger.error(f"❌ Account not found: {str(e)}")
-            return None
-        except Exception as e:
-            logger.error(f"❌ Error saving message: {str(e)}", exc_info=True)
-            return None
+    async def messages_expired(self, event):
+        await self.send(text_data=dumps_text({
+            'type': 'messages_expired',
+            'contact_telegram_id': event['contact_telegram_id'],
+            'ranges': event['ranges'],
+            'ephemeral_ranges': event['ephemeral_ranges']
+        }))
 
-    @database_sync_to_async
-    def set_user_online(self, telegram_id, is_online):
-        try:
-            user = Account.objects.get(telegram_id=int(telegram_id))  # ✅ Convert to int
-            user.is_online = is_online
-            if not is_online:
-                user.last_seen = timezone.now()
-            user.save()
-            logger.info(f"👤 User {telegram_id} online status: {is_online}")
-        except Account.DoesNotExist:
+    async def media_message(self, event):
+        await self.send(text_data=dumps_text({
+            'type': 'new_media_message',
+            'from_user_id': event['from_user_id'],
+            'message': event['message']
+        }))
+
+    async def thumbnail_ready(self, event):
+        await self.send(text_data=dumps_text({
+            'type': 'thumbnail_ready',
+            'message_id': event['message_id'],
+            'thumbnail_url': event['thumbnail_url']
+        }))
+
+    async def read_up_to(self, event):
+        await self.send(text_data=dumps_text({
+            'type': 'read_up_to',
+            'reader_id': event['reader_id'],
+            'reader_telegram_id': event['reader_telegram_id'],
+            'up_to': event['up_to'],
+            'ephemeral_up_to': event['ephemeral_up_to']
+        }))
+
+    async def presence_update(self, event):
+        await self.send(text_data=dumps_text({
+            'type': 'presence',
+            'user_id': event['user_id'],
+            'telegram_id': event['telegram_id'],
+            'is_online': event['is_online'],
+            'last_seen': event['last_seen']
+        }))
+
+    # Database operations
+    async def get_account_id(self, telegram_id):
+        identity = await identity_cache.aget(telegram_id=telegram_id)
+        if identity is None:
             logger.error(f"❌ User not found: {telegram_id}")
-        except Exception as e:
-            logger.error(f"❌ Error setting user online: {str(e)}", exc_info=True)
+            return None
+        return identity.id
 
-    @database_sync_to_async
-    def get_telegram_id(self, user_id):
+    async def get_telegram_id(self, user_id):
         try:
-            user = Account.objects.get(id=user_id)
-            return str(user.telegram_id)  # ✅ Return as string for consistency
-        except Account.DoesNotExist:
+            identity = await identity_cache.aget(id=user_id)
+        except (TypeError, ValueError):
+            identity = None
+        if identity is None:
             logger.error(f"❌ User not found: {user_id}")
             return None
-        except Exception as e:
-            logger.error(f"❌ Error getting telegram_id: {str(e)}", exc_info=True)
-            return None 
\ No newline at end of file
+        return str(identity.telegram_id)  # ✅ Return as string for consistency
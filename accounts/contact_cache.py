@@ -0,0 +1,216 @@
+# accounts/contact_cache.py
+"""
+Per-user materialized contact lists.
+
+``get_contacts`` and the login response both need the same three ``Contact``
+queries. ``contact_cache`` keeps the rows for each user together with the
+encoded JSON body and an ETag derived from it, so a warm lookup needs one
+aggregate query and no encoding, and a poll with a matching
+``If-None-Match`` is a ``304``.
+
+The cache is per process, so every lookup first reads a version of the list
+from the database (row count and latest timestamps of the user's ``Contact``
+rows and of the accounts they show) and rebuilds when it differs from the
+cached one. That way adds, accepts and rejects made by other workers, or
+through ``QuerySet.update()``, are visible on the next request. ``Contact``
+and ``Account`` signals in ``accounts.signals`` still drop affected lists in
+this process, and presence flushes and logout patch ``is_online``/
+``last_seen`` in place.
+"""
+import hashlib
+import threading
+import time
+from collections import OrderedDict, namedtuple
+
+from django.conf import settings
+from django.db.models import Count, Max, Q, Sum
+
+from .db_executor import consumer_db
+from .models import Contact
+from .serialization import dumps
+
+ContactList = namedtuple('ContactList', 'rows body etag')
+
+
+def _row(account, c, is_accepted, pending_from_them):
+    return {
+        'id': account.id,
+        'user_id': c.user_id,
+        'telegram_id': account.telegram_id,
+        'name': c.custom_name or account.first_name,
+        'username': account.username,
+        'is_online': account.is_online,
+        'last_seen': account.last_seen.isoformat() if account.last_seen else None,
+        'is_accepted': is_accepted,
+        'pending_from_them': pending_from_them,
+    }
+
+
+def build_contact_list(user_id):
+    """Accepted contacts, then requests from others, then requests from the user."""
+    accepted = Contact.objects.filter(
+        user_id=user_id, is_accepted=True
+    ).select_related('contact').order_by('-accepted_at')
+    pending_from_them = Contact.objects.filter(
+        contact_id=user_id, is_accepted=False
+    ).select_related('user').order_by('-created_at')
+    pending_from_me = Contact.objects.filter(
+        user_id=user_id, is_accepted=False
+    ).select_related('contact').order_by('-created_at')
+
+    rows = [_row(c.contact, c, True, False) for c in accepted]
+    # Show accept/reject buttons
+    rows += [_row(c.user, c, False, True) for c in pending_from_them]
+    # Just show "Pending" badge
+    rows += [_row(c.contact, c, False, False) for c in pending_from_me]
+    return rows
+
+
+def contact_list_version(user_id):
+    """Everything ``build_contact_list`` depends on, read in one query."""
+    version = Contact.objects.filter(Q(user_id=user_id) | Q(contact_id=user_id)).aggregate(
+        count=Count('id'),
+        created=Max('created_at'),
+        accepted=Max('accepted_at'),
+        contact_updated=Max('contact__updated_at'),
+        contact_seen=Max('contact__last_seen'),
+        # presence goes through update() and only bumps last_seen when going offline
+        contact_online=Sum('contact_id', filter=Q(contact__is_online=True)),
+        user_updated=Max('user__updated_at'),
+        user_seen=Max('user__last_seen'),
+        user_online=Sum('user_id', filter=Q(user__is_online=True)),
+    )
+    return tuple(version.values())
+
+
+def _materialize(rows):
+    body = dumps({'success': True, 'contacts': rows})
+    etag = '"%s"' % hashlib.md5(body, usedforsecurity=False).hexdigest()
+    return ContactList(rows, body, etag)
+
+
+class ContactListCache:
+    def __init__(self, max_size=10000, ttl=300):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.entries = OrderedDict()  # user_id -> (expires, version, ContactList)
+        self.watchers = {}  # telegram_id -> user_ids whose cached list shows it
+        self.epoch = 0
+        self.hits = 0
+        self.misses = 0
+        self.stale = 0
+        self.patches = 0
+        self.lock = threading.Lock()
+
+    def peek(self, user_id, version):
+        user_id = int(user_id)
+        with self.lock:
+            entry = self.entries.get(user_id)
+            if entry is None or entry[0] < time.monotonic():
+                self.misses += 1
+                return None
+            if entry[1] != version:
+                # Changed by another process (or an update()) since it was built
+                self._remove(user_id)
+                self.stale += 1
+                self.misses += 1
+                return None
+            self.entries.move_to_end(user_id)
+            self.hits += 1
+            return entry[2]
+
+    def get(self, user_id):
+        """Return the ``ContactList`` for a user, building it on a miss."""
+        user_id = int(user_id)
+        # Read first: a change landing during the build only costs a rebuild
+        version = contact_list_version(user_id)
+        contact_list = self.peek(user_id, version)
+        if contact_list is not None:
+            return contact_list
+
+        epoch = self.epoch
+        contact_list = _materialize(build_contact_list(user_id))
+        with self.lock:
+            # Something changed while we were querying; serve it but don't keep it
+            if epoch == self.epoch:
+                self._put(user_id, version, contact_list)
+        return contact_list
+
+    async def aget(self, user_id):
+        return await consumer_db(self.get)(user_id)
+
+    def invalidate(self, *user_ids):
+        with self.lock:
+            self.epoch += 1
+            for user_id in user_ids:
+                self._remove(int(user_id))
+
+    def invalidate_account(self, telegram_id):
+        """Drop every cached list that shows this account."""
+        with self.lock:
+            self.epoch += 1
+            for user_id in list(self.watchers.get(str(telegram_id), ())):
+                self._remove(user_id)
+
+    def set_presence(self, telegram_id, is_online, last_seen=None):
+        """Patch the presence fields of an account in every list that shows it."""
+        telegram_id = str(telegram_id)
+        with self.lock:
+            self.epoch += 1
+            for user_id in list(self.watchers.get(telegram_id, ())):
+                expires, version, contact_list = self.entries[user_id]
+                rows = []
+                for row in contact_list.rows:
+                    if str(row['telegram_id']) == telegram_id:
+                        # Copy, readers may still hold the old list
+                        row = dict(row, is_online=is_online)
+                        if last_seen is not None:
+                            row['last_seen'] = last_seen.isoformat()
+                    rows.append(row)
+                self.entries[user_id] = (expires, version, _materialize(rows))
+                self.patches += 1
+
+    def clear(self):
+        with self.lock:
+            self.epoch += 1
+            self.entries.clear()
+            self.watchers.clear()
+
+    def _put(self, user_id, version, contact_list):
+        self._remove(user_id)
+        self.entries[user_id] = (time.monotonic() + self.ttl, version, contact_list)
+        for row in contact_list.rows:
+            self.watchers.setdefault(str(row['telegram_id']), set()).add(user_id)
+        while len(self.entries) > self.max_size:
+            self._remove(next(iter(self.entries)))
+
+    def _remove(self, user_id):
+        entry = self.entries.pop(user_id, None)
+        if entry is None:
+            return
+        for row in entry[2].rows:
+            telegram_id = str(row['telegram_id'])
+            users = self.watchers.get(telegram_id)
+            if users is not None:
+                users.discard(user_id)
+                if not users:
+                    del self.watchers[telegram_id]
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            'size': len(self.entries),
+            'max_size': self.max_size,
+            'ttl': self.ttl,
+            'hits': self.hits,
+            'misses': self.misses,
+            'stale': self.stale,
+            'patches': self.patches,
+            'hit_rate': round(self.hits / lookups, 4) if lookups else None,
+        }
+
+
+contact_cache = ContactListCache(
+    max_size=getattr(settings, 'CONTACT_CACHE_SIZE', 10000),
+    ttl=getattr(settings, 'CONTACT_CACHE_TTL', 300),
+)
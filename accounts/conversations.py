@@ -0,0 +1,168 @@
+# accounts/conversations.py
+"""
+Sidebar summaries: every accepted contact with the last message of the
+conversation, the unread count and expiry info.
+
+The contact list comes back in one query. Correlated subqueries annotate
+it with the newest unexpired message id of each conversation, using an
+index seek on ``message_conversation_key_idx``. They also add the unread count and
+the earliest unread expiry from the partial ``message_unread_idx``. A
+second query fetches the last messages by id. The cost stays at two queries
+however many contacts the user has. Messages still in ``ephemeral_store``
+count as well.
+
+With sharded messages the contacts can't be joined to their messages.
+Each shard holding some of the conversations then gets one grouped query
+for the last ids and one for the unread counts, and one more for the last
+messages, so the cost grows with the number of shards, not of contacts.
+"""
+from django.db.models import Count, Max, Min, OuterRef, Subquery, Value
+from django.db.models.functions import Coalesce
+
+from .ephemeral import ephemeral_store
+from .history import HISTORY_FIELDS
+from .models import Contact, Message
+from .sharding import (
+    conversation_key, conversation_key_sql, group_by_shard, is_sharded, message_db_for_id,
+)
+
+CONTACT_FIELDS = (
+    'contact_id', 'custom_name', 'accepted_at',
+    'contact__telegram_id', 'contact__first_name', 'contact__username',
+    'contact__is_online', 'contact__last_seen',
+)
+
+
+def _last_id(user_id, now):
+    return Subquery(
+        Message.objects.filter(
+            conversation_key=conversation_key_sql(Value(user_id), OuterRef('contact_id')),
+            expires_at__gte=now,
+        ).order_by('-id').values('id')[:1]
+    )
+
+
+def _contacts_query(user_id, now):
+    if is_sharded():
+        # Annotated from the shards by _shard_queries()
+        return Contact.objects.filter(user_id=user_id, is_accepted=True).values(*CONTACT_FIELDS)
+    unread = Message.objects.filter(
+        sender_id=OuterRef('contact_id'),
+        receiver_id=user_id,
+        is_read=False,
+        expires_at__gte=now,
+    ).order_by().values('receiver_id')
+    return Contact.objects.filter(user_id=user_id, is_accepted=True).annotate(
+        last_id=_last_id(user_id, now),
+        unread_count=Coalesce(Subquery(unread.annotate(n=Count('id')).values('n')), 0),
+        unread_expires_at=Subquery(unread.annotate(first=Min('expires_at')).values('first')),
+    ).values(*CONTACT_FIELDS, 'last_id', 'unread_count', 'unread_expires_at')
+
+
+def _shard_queries(user_id, now, contacts):
+    """``(last_ids, unread)`` querysets for each shard holding some of the conversations."""
+    for alias, contact_ids in group_by_shard(
+        [c['contact_id'] for c in contacts], lambda contact_id: (user_id, contact_id)
+    ).items():
+        messages = Message.objects.using(alias).filter(expires_at__gte=now).order_by()
+        last_ids = messages.filter(
+            conversation_key__in=[conversation_key(user_id, contact_id) for contact_id in contact_ids]
+        ).values('conversation_key').annotate(last_id=Max('id'))
+        unread = messages.filter(
+            sender_id__in=contact_ids, receiver_id=user_id, is_read=False,
+        ).values('sender_id').annotate(unread_count=Count('id'), unread_expires_at=Min('expires_at'))
+        yield last_ids, unread
+
+
+def _annotate(user_id, contacts, last_ids, unread):
+    by_id, by_key = {}, {}
+    for c in contacts:
+        c.update(last_id=None, unread_count=0, unread_expires_at=None)
+        by_id[c['contact_id']] = c
+        by_key[conversation_key(user_id, c['contact_id'])] = c
+    for row in last_ids:
+        by_key[row['conversation_key']]['last_id'] = row['last_id']
+    for row in unread:
+        by_id[row['sender_id']].update(
+            unread_count=row['unread_count'], unread_expires_at=row['unread_expires_at'],
+        )
+
+
+def _message_queries(ids):
+    shards = {}
+    for message_id in ids:
+        shards.setdefault(message_db_for_id(message_id), []).append(message_id)
+    for alias, shard_ids in shards.items():
+        yield Message.objects.using(alias).filter(id__in=shard_ids).values(*HISTORY_FIELDS)
+
+
+def _last_ids(contacts):
+    return [c['last_id'] for c in contacts if c['last_id'] is not None]
+
+
+def _summaries(user_id, now, contacts, messages):
+    summaries = []
+    for c in contacts:
+        last_message = messages.get(c['last_id'])
+        unread_count = c['unread_count']
+        unread_expires_at = c['unread_expires_at']
+
+        for row in ephemeral_store.conversation(user_id, c['contact_id'], now):
+            if last_message is None or row['created_at'] >= last_message['created_at']:
+                last_message = row
+            if row['sender_id'] == c['contact_id'] and not row['is_read']:
+                unread_count += 1
+                if unread_expires_at is None or row['expires_at'] < unread_expires_at:
+                    unread_expires_at = row['expires_at']
+
+        summaries.append({
+            'id': c['contact_id'],
+            'telegram_id': c['contact__telegram_id'],
+            'name': c['custom_name'] or c['contact__first_name'],
+            'username': c['contact__username'],
+            'is_online': c['contact__is_online'],
+            'last_seen': c['contact__last_seen'],
+            'accepted_at': c['accepted_at'],
+            'last_message': last_message,
+            'unread_count': unread_count,
+            'unread_expires_at': unread_expires_at,
+        })
+
+    # Most recent activity first, silent contacts by when they were added
+    summaries.sort(
+        key=lambda s: (s['last_message'] or {}).get('created_at') or s['accepted_at'] or now,
+        reverse=True,
+    )
+    return summaries
+
+
+def conversation_summaries(user_id, now):
+    contacts = list(_contacts_query(user_id, now))
+    if is_sharded():
+        last_ids, unread = [], []
+        for shard_last_ids, shard_unread in _shard_queries(user_id, now, contacts):
+            last_ids += shard_last_ids
+            unread += shard_unread
+        _annotate(user_id, contacts, last_ids, unread)
+    messages = {
+        row['id']: row
+        for qs in _message_queries(_last_ids(contacts))
+        for row in qs
+    }
+    return _summaries(user_id, now, contacts, messages)
+
+
+async def aconversation_summaries(user_id, now):
+    """Async version of ``conversation_summaries`` for the async views."""
+    contacts = [c async for c in _contacts_query(user_id, now)]
+    if is_sharded():
+        last_ids, unread = [], []
+        for shard_last_ids, shard_unread in _shard_queries(user_id, now, contacts):
+            last_ids += [row async for row in shard_last_ids]
+            unread += [row async for row in shard_unread]
+        _annotate(user_id, contacts, last_ids, unread)
+    messages = {}
+    for qs in _message_queries(_last_ids(contacts)):
+        async for row in qs:
+            messages[row['id']] = row
+    return _summaries(user_id, now, contacts, messages)
@@ -0,0 +1,234 @@
+# accounts/db_executor.py
+"""
+Dedicated thread pool for the database work of the WebSocket side.
+
+``database_sync_to_async`` runs everything on the single thread-sensitive
+executor, so one slow query from any socket delays all others. Functions
+decorated with ``@consumer_db`` run on a bounded pool of
+``CONSUMER_DB_WORKERS`` threads instead, each with its own Django
+connection, cleaned up before and after every call like
+``database_sync_to_async`` does. Queue depth and wait times are recorded so
+saturation shows up in /api/metrics/.
+
+SQLite allows one writer at a time; concurrent write transactions wait on
+the file lock and, past the busy timeout, fail with ``database is locked``.
+Functions decorated with ``@db_writer`` are queued for a single writer
+thread instead. It takes everything queued so far (up to
+``DB_WRITER_MAX_BATCH`` calls), runs each in its own savepoint inside one
+transaction and commits once (group commit). Callers are resolved after the
+commit, so one failing call never rolls back the others. Each call runs in
+a copy of its caller's context, so its queries are counted for the request
+or frame that queued it (see querycount.py). Reads stay on the
+pools and, in WAL mode, never wait for the writer. Each message shard has
+a writer of its own, ``db_writer.using(alias)``. With
+``DB_SINGLE_WRITER`` off (``fallback`` set), ``@db_writer`` behaves like
+``@consumer_db``.
+"""
+import asyncio
+import contextvars
+import logging
+import queue
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from functools import partial, wraps
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.db import close_old_connections, transaction
+
+logger = logging.getLogger(__name__)
+
+
+class DatabaseExecutor:
+    def __init__(self, max_workers, name='consumer-db'):
+        self.max_workers = max_workers
+        self.pool = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix=name)
+        self.lock = threading.Lock()
+        self.queued = 0
+        self.running = 0
+        self.max_queued = 0
+        self.completed = 0
+        self.errors = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+        self.total_run = 0.0
+
+    def __call__(self, func):
+        @wraps(func)
+        async def wrapper(*args, **kwargs):
+            submitted = time.perf_counter()
+            with self.lock:
+                self.queued += 1
+                self.max_queued = max(self.max_queued, self.queued)
+
+            def call():
+                started = time.perf_counter()
+                wait = started - submitted
+                with self.lock:
+                    self.queued -= 1
+                    self.running += 1
+                    self.total_wait += wait
+                    self.max_wait = max(self.max_wait, wait)
+                failed = False
+                close_old_connections()
+                try:
+                    return func(*args, **kwargs)
+                except Exception:
+                    failed = True
+                    raise
+                finally:
+                    close_old_connections()
+                    with self.lock:
+                        self.running -= 1
+                        self.completed += 1
+                        self.errors += failed
+                        self.total_run += time.perf_counter() - started
+
+            return await sync_to_async(call, thread_sensitive=False, executor=self.pool)()
+        return wrapper
+
+    def stats(self):
+        with self.lock:
+            done = self.completed or 1
+            return {
+                'workers': self.max_workers,
+                'queue_depth': self.queued,
+                'running': self.running,
+                'max_queue_depth': self.max_queued,
+                'completed': self.completed,
+                'errors': self.errors,
+                'avg_wait_ms': round(self.total_wait / done * 1000, 3),
+                'max_wait_ms': round(self.max_wait * 1000, 3),
+                'avg_run_ms': round(self.total_run / done * 1000, 3),
+            }
+
+
+consumer_db = DatabaseExecutor(max_workers=getattr(settings, 'CONSUMER_DB_WORKERS', 8))
+
+
+class DatabaseWriter:
+    def __init__(self, max_batch, fallback=None, alias='default'):
+        self.max_batch = max_batch
+        self.fallback = fallback
+        self.alias = alias
+        self.shards = {}
+        self.queue = queue.Queue()
+        self.thread = None
+        self.thread_lock = threading.Lock()
+        self.commits = 0
+        self.calls = 0
+        self.errors = 0
+        self.max_batch_seen = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+        self.total_commit = 0.0
+
+    def __call__(self, func):
+        @wraps(func)
+        async def wrapper(*args, **kwargs):
+            # Looked up per call: decorated at import, the mode may be switched later (tests)
+            if self.fallback is not None:
+                return await self.fallback(func)(*args, **kwargs)
+            return await asyncio.wrap_future(self.submit(func, *args, **kwargs))
+        return wrapper
+
+    def using(self, alias):
+        """The writer of another database (a message shard); each has its own thread."""
+        if alias == self.alias or self.fallback is not None:
+            return self
+        with self.thread_lock:
+            writer = self.shards.get(alias)
+            if writer is None:
+                writer = self.shards[alias] = DatabaseWriter(self.max_batch, alias=alias)
+            return writer
+
+    def submit(self, func, *args, **kwargs):
+        future = Future()
+        self.ensure_thread()
+        context = contextvars.copy_context()
+        self.queue.put((partial(context.run, func, *args, **kwargs), future, time.perf_counter()))
+        return future
+
+    def call(self, func, *args, **kwargs):
+        """Run ``func`` on the writer from synchronous code and wait for the commit."""
+        if threading.current_thread() is self.thread:
+            return func(*args, **kwargs)
+        return self.submit(func, *args, **kwargs).result()
+
+    def ensure_thread(self):
+        if self.thread is None or not self.thread.is_alive():
+            with self.thread_lock:
+                if self.thread is None or not self.thread.is_alive():
+                    self.thread = threading.Thread(target=self.run, name=f'db-writer-{self.alias}', daemon=True)
+                    self.thread.start()
+
+    def run(self):
+        while True:
+            batch = [self.queue.get()]
+            while len(batch) < self.max_batch:
+                try:
+                    batch.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+            self.commit(batch)
+
+    def commit(self, batch):
+        started = time.perf_counter()
+        results = []
+        close_old_connections()
+        try:
+            with transaction.atomic(using=self.alias):
+                for call, _, _ in batch:
+                    try:
+                        with transaction.atomic(using=self.alias):
+                            results.append((True, call()))
+                    except Exception as e:
+                        results.append((False, e))
+        except Exception as e:
+            logger.error(f"❌ Group commit of {len(batch)} writes failed: {str(e)}", exc_info=True)
+            results = [(False, e)] * len(batch)
+        finally:
+            close_old_connections()
+
+        finished = time.perf_counter()
+        self.commits += 1
+        self.calls += len(batch)
+        self.max_batch_seen = max(self.max_batch_seen, len(batch))
+        self.total_commit += finished - started
+        for (_, future, submitted), (ok, result) in zip(batch, results):
+            wait = started - submitted
+            self.total_wait += wait
+            self.max_wait = max(self.max_wait, wait)
+            if ok:
+                future.set_result(result)
+            else:
+                self.errors += 1
+                future.set_exception(result)
+
+    def stats(self):
+        if self.fallback is not None:
+            return {'enabled': False}
+        commits = self.commits or 1
+        calls = self.calls or 1
+        stats = {
+            'enabled': True,
+            'queue_depth': self.queue.qsize(),
+            'commits': self.commits,
+            'calls': self.calls,
+            'errors': self.errors,
+            'avg_batch': round(self.calls / commits, 2),
+            'max_batch': self.max_batch_seen,
+            'avg_wait_ms': round(self.total_wait / calls * 1000, 3),
+            'max_wait_ms': round(self.max_wait * 1000, 3),
+            'avg_commit_ms': round(self.total_commit / commits * 1000, 3),
+        }
+        if self.shards:
+            stats['shards'] = {alias: writer.stats() for alias, writer in self.shards.items()}
+        return stats
+
+
+db_writer = DatabaseWriter(
+    max_batch=getattr(settings, 'DB_WRITER_MAX_BATCH', 64),
+    fallback=None if getattr(settings, 'DB_SINGLE_WRITER', False) else consumer_db,
+)
@@ -0,0 +1,100 @@
+# accounts/ephemeral.py
+"""
+In-memory store for short-lived chat messages.
+
+Messages whose TTL is below ``EPHEMERAL_MESSAGE_TTL_THRESHOLD`` never reach
+SQLite: the consumer keeps them here, ``get_messages`` merges them into the
+newest page of history, and a min-heap on ``expires_at`` drops them as they
+expire. Ids are strings (``"e<n>"``) so they can't be mistaken for database
+ids in pagination cursors.
+
+The store lives in process memory, so with several daphne workers a message
+is only visible to history requests served by the worker that received it.
+"""
+import heapq
+import itertools
+import threading
+
+from django.conf import settings
+
+
+class EphemeralMessageStore:
+    def __init__(self, max_messages=100000):
+        self.max_messages = max_messages
+        self.conversations = {}  # (low_id, high_id) -> {message id: row}
+        self.heap = []  # (expires_at, message id, conversation key)
+        self.counter = itertools.count(1)
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def key(user_a, user_b):
+        user_a, user_b = int(user_a), int(user_b)
+        return (user_a, user_b) if user_a < user_b else (user_b, user_a)
+
+    def add(self, sender_id, receiver_id, text, created_at, expires_at):
+        """Store a message and return its row, or None if the store is full."""
+        key = self.key(sender_id, receiver_id)
+        with self.lock:
+            self._purge(created_at)
+            if len(self.heap) >= self.max_messages:
+                return None
+            row = {
+                'id': f'e{next(self.counter)}',
+                'text': text,
+                'sender_id': int(sender_id),
+                'receiver_id': int(receiver_id),
+                'is_read': False,
+                'created_at': created_at,
+                'expires_at': expires_at,
+            }
+            self.conversations.setdefault(key, {})[row['id']] = row
+            heapq.heappush(self.heap, (expires_at, row['id'], key))
+            return row
+
+    def conversation(self, user_a, user_b, now):
+        """Unexpired messages between two users, oldest first."""
+        with self.lock:
+            self._purge(now)
+            rows = self.conversations.get(self.key(user_a, user_b))
+            return list(rows.values()) if rows else []
+
+    def mark_read(self, sender_id, receiver_id, up_to):
+        """Mark messages from sender to receiver up to ``e<up_to>`` read; returns the count."""
+        sender_id, receiver_id = int(sender_id), int(receiver_id)
+        marked = 0
+        with self.lock:
+            rows = self.conversations.get(self.key(sender_id, receiver_id)) or {}
+            for row in rows.values():
+                if (row['sender_id'] == sender_id and not row['is_read']
+                        and int(row['id'][1:]) <= up_to):
+                    row['is_read'] = True
+                    marked += 1
+        return marked
+
+    def purge(self, now):
+        with self.lock:
+            return self._purge(now)
+
+    def _purge(self, now):
+        purged = 0
+        while self.heap and self.heap[0][0] < now:
+            _, message_id, key = heapq.heappop(self.heap)
+            rows = self.conversations.get(key)
+            if rows is not None:
+                rows.pop(message_id, None)
+                if not rows:
+                    del self.conversations[key]
+            purged += 1
+        return purged
+
+    def __len__(self):
+        return len(self.heap)
+
+
+ephemeral_store = EphemeralMessageStore(
+    max_messages=getattr(settings, 'EPHEMERAL_MESSAGE_MAX', 100000),
+)
+
+
+def is_ephemeral(ttl_seconds):
+    return ttl_seconds < getattr(settings, 'EPHEMERAL_MESSAGE_TTL_THRESHOLD', 0)
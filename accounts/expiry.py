@@ -0,0 +1,241 @@
+# accounts/expiry.py
+"""
+Server-pushed message expiry.
+
+``expiry_scheduler`` keeps pending ``expires_at`` values in a
+``TimingWheel``. Once a second it collects the messages that expired,
+groups them per conversation and sends one ``messages_expired`` event with
+compact id ranges to both participants' ``chat_<telegram_id>`` groups, so
+clients can drop them without re-fetching the history.
+
+The channel layer reaches every process, so each message must be scheduled
+by exactly one. Database messages belong to the process holding an
+exclusive lock on ``EXPIRY_LOCK_FILE``: it loads the pending ones once, then
+every ``EXPIRY_LOAD_INTERVAL`` seconds those saved since, by any process.
+The others try to take the lock over at the same interval, in case the
+owner exits. In-memory messages exist only in the process that received
+them, which schedules them itself.
+
+Expiries brought forward after a message was loaded (the media quota sets
+``expires_at`` to now, from whichever process runs the GC) are found by the
+same load: recently expired rows whose scheduled deadline is later get a new
+wheel entry, and the old one is skipped when it comes due. Loads run on the
+scheduler's own thread.
+"""
+import asyncio
+import logging
+import os
+import tempfile
+import threading
+import time
+from datetime import timedelta
+
+try:
+    import fcntl
+except ImportError:
+    # No flock (Windows): a single process is assumed
+    fcntl = None
+
+from channels.layers import get_channel_layer
+from django.conf import settings
+from django.utils import timezone
+
+from .db_executor import DatabaseExecutor
+from .models import Account, Message
+from .sharding import message_databases
+from .timing_wheel import TimingWheel
+
+logger = logging.getLogger(__name__)
+
+# How far back a load looks for expiries brought forward since the last one
+MOVED_WINDOW = timedelta(seconds=60)
+
+
+def id_ranges(ids):
+    """[1, 2, 3, 7, 9, 10] -> [[1, 3], [7, 7], [9, 10]]"""
+    ranges = []
+    for message_id in sorted(ids):
+        if ranges and message_id == ranges[-1][1] + 1:
+            ranges[-1][1] = message_id
+        else:
+            ranges.append([message_id, message_id])
+    return ranges
+
+
+class ExpiryScheduler:
+    def __init__(self, tick=1.0, lock_path=None):
+        self.tick = tick
+        self.lock_path = lock_path or os.path.join(tempfile.gettempdir(), 'vchat-expiry.lock')
+        self.wheel = TimingWheel(time.time(), tick=tick)
+        self.lock = threading.Lock()
+        self.running = False
+        self.owner = False
+        self.lock_file = None
+        self.loaded = {}  # alias -> highest message id looked at
+        self.deadlines = {}  # database message id -> timestamp of its live wheel entry
+        self.executor = DatabaseExecutor(max_workers=1, name='expiry')
+        self.rescheduled = 0
+        self.sent_events = 0
+
+    def schedule(self, message_id, expires_at, sender_telegram_id, receiver_telegram_id):
+        """Track one in-memory message; safe to call from request threads."""
+        if not self.running:
+            # Nothing would ever advance the wheel (management command, WSGI)
+            return
+        if not isinstance(message_id, str):
+            # Database message: the owner's next load picks it up
+            return
+        self._add(message_id, expires_at, sender_telegram_id, receiver_telegram_id)
+
+    def _add(self, message_id, expires_at, sender_telegram_id, receiver_telegram_id):
+        deadline = expires_at.timestamp()
+        with self.lock:
+            if not isinstance(message_id, str):
+                # Replaces an earlier entry of the same message, if any
+                self.deadlines[message_id] = deadline
+            self.wheel.add(
+                deadline,
+                (message_id, str(sender_telegram_id), str(receiver_telegram_id), deadline),
+            )
+
+    def pop_expired(self, now):
+        """Advance the wheel; returns ``(message_id, sender, receiver)`` of what expired."""
+        expired = []
+        with self.lock:
+            for message_id, sender_tid, receiver_tid, deadline in self.wheel.advance(now):
+                if not isinstance(message_id, str):
+                    if self.deadlines.get(message_id) != deadline:
+                        # Rescheduled; the other entry fires (or fired) for it
+                        continue
+                    del self.deadlines[message_id]
+                expired.append((message_id, sender_tid, receiver_tid))
+        return expired
+
+    def acquire(self):
+        """Become the owner of database messages unless another process is; returns ``owner``."""
+        if self.owner:
+            return True
+        if fcntl is None:
+            self.owner = True
+            return True
+        lock_file = open(self.lock_path, 'a')
+        try:
+            fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            lock_file.close()
+            return False
+        # Held until the process exits
+        self.lock_file, self.owner = lock_file, True
+        logger.info("⏱️ Expiry scheduler owns database messages")
+        return True
+
+    async def run(self):
+        self.running = True
+        load_interval = getattr(settings, 'EXPIRY_LOAD_INTERVAL', 5.0)
+        next_load = 0
+        while True:
+            if time.monotonic() >= next_load:
+                next_load = time.monotonic() + load_interval
+                try:
+                    if self.acquire():
+                        await self.executor(self.load_pending)()
+                except Exception as e:
+                    logger.error(f"❌ Could not load pending expiries: {str(e)}", exc_info=True)
+
+            await asyncio.sleep(self.tick)
+            expired = self.pop_expired(time.time())
+            if expired:
+                try:
+                    await self.notify(expired)
+                except Exception as e:
+                    logger.error(f"❌ Expiry notify error: {str(e)}", exc_info=True)
+
+    def load_pending(self):
+        """Schedule the messages saved since the last load; all unexpired ones the first time."""
+        count = 0
+        for alias in message_databases():
+            messages = Message.objects.using(alias)
+            if alias in self.loaded:
+                # Expired since they were saved or not, they are due
+                last_id = self.loaded[alias]
+                pending = messages.filter(id__gt=last_id)
+                count += self.reschedule_moved(messages.filter(id__lte=last_id))
+            else:
+                last_id = messages.order_by('-id').values_list('id', flat=True).first() or 0
+                pending = messages.filter(id__lte=last_id, expires_at__gte=timezone.now())
+            pending = pending.order_by('id').values_list('id', 'expires_at', 'sender_id', 'receiver_id')
+            rows = []
+            for row in pending.iterator(chunk_size=5000):
+                rows.append(row)
+                last_id = max(last_id, row[0])
+                if len(rows) == 5000:
+                    count += self.schedule_rows(rows)
+                    rows = []
+            count += self.schedule_rows(rows)
+            self.loaded[alias] = last_id
+        if count:
+            logger.info(f"⏱️ Expiry scheduler loaded {count} pending messages")
+        return count
+
+    def reschedule_moved(self, messages):
+        """Schedule again the loaded messages whose expiry was brought forward."""
+        now = timezone.now()
+        rows = list(messages.filter(
+            expires_at__gt=now - MOVED_WINDOW, expires_at__lte=now,
+        ).values_list('id', 'expires_at', 'sender_id', 'receiver_id'))
+        with self.lock:
+            # Not in deadlines: fired already, or never scheduled here
+            moved = [row for row in rows if self.deadlines.get(row[0], 0) > row[1].timestamp()]
+        if not moved:
+            return 0
+        self.rescheduled += len(moved)
+        return self.schedule_rows(moved)
+
+    def schedule_rows(self, rows):
+        # Accounts may be on another database than the messages: no join
+        account_ids = {account_id for row in rows for account_id in row[2:]}
+        telegram_ids = dict(Account.objects.filter(id__in=account_ids).values_list('id', 'telegram_id'))
+        for message_id, expires_at, sender_id, receiver_id in rows:
+            if sender_id in telegram_ids and receiver_id in telegram_ids:
+                self._add(message_id, expires_at, telegram_ids[sender_id], telegram_ids[receiver_id])
+        return len(rows)
+
+    async def notify(self, expired):
+        conversations = {}
+        for message_id, sender_tid, receiver_tid in expired:
+            pair = tuple(sorted((sender_tid, receiver_tid)))
+            ids = conversations.setdefault(pair, ([], []))
+            if isinstance(message_id, str):
+                # In-memory message, "e<n>"
+                ids[1].append(int(message_id[1:]))
+            else:
+                ids[0].append(message_id)
+
+        channel_layer = get_channel_layer()
+        for (first, second), (db_ids, ephemeral_ids) in conversations.items():
+            for telegram_id, other in ((first, second), (second, first)):
+                await channel_layer.group_send(
+                    f'chat_{telegram_id}',
+                    {
+                        'type': 'messages_expired',
+                        'contact_telegram_id': other,
+                        'ranges': id_ranges(db_ids),
+                        'ephemeral_ranges': id_ranges(ephemeral_ids),
+                    }
+                )
+                self.sent_events += 1
+
+    def stats(self):
+        return {
+            'running': self.running,
+            'owner': self.owner,
+            'pending': len(self.wheel),
+            'rescheduled': self.rescheduled,
+            'sent_events': self.sent_events,
+        }
+
+
+expiry_scheduler = ExpiryScheduler(
+    tick=getattr(settings, 'EXPIRY_EVENTS_TICK', 1.0),
+    lock_path=getattr(settings, 'EXPIRY_LOCK_FILE', None),
+)
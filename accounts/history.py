@@ -0,0 +1,110 @@
+# accounts/history.py
+"""
+Keyset pagination over the messages of one conversation.
+
+A conversation is one index range scan on ``(conversation_key, id)``, cut
+at ``limit + 1`` rows, so a page costs O(limit) no matter how long the
+history is.
+
+Short-lived messages held in ``ephemeral_store`` have no database id and are
+placed by ``created_at``: a page gets those between its cursor message and
+the far end of its rows (or the end of the history), then the whole page is
+cut to ``limit``. Finding the cursor message's time costs one more query,
+made only when the conversation has such messages.
+"""
+from .ephemeral import ephemeral_store
+from .models import Message
+from .sharding import conversation_key, message_db
+
+HISTORY_FIELDS = ('id', 'text', 'sender_id', 'is_read', 'created_at', 'expires_at')
+DEFAULT_PAGE_SIZE = 50
+MAX_PAGE_SIZE = 200
+
+
+def _page_query(user_id, contact_id, now, before, after, limit):
+    order = 'id' if after is not None else '-id'
+    qs = Message.objects.using(message_db(user_id, contact_id)).filter(
+        conversation_key=conversation_key(user_id, contact_id),
+        expires_at__gte=now,
+    )
+    if after is not None:
+        qs = qs.filter(id__gt=after)
+    elif before is not None:
+        qs = qs.filter(id__lt=before)
+    return qs.order_by(order).values(*HISTORY_FIELDS)[:limit + 1]
+
+
+def _cursor_time_query(user_id, contact_id, before, after):
+    """``created_at`` of the cursor message, or of the nearest one if it is gone."""
+    qs = Message.objects.using(message_db(user_id, contact_id)).filter(
+        conversation_key=conversation_key(user_id, contact_id),
+    )
+    if after is not None:
+        qs = qs.filter(id__lte=after).order_by('-id')
+    else:
+        qs = qs.filter(id__gte=before).order_by('id')
+    return qs.values_list('created_at', flat=True)
+
+
+def _finish_page(rows, before, after, limit, recent, cursor_time):
+    newest_first = after is None
+    has_more = len(rows) > limit
+    rows = rows[:limit]
+    if newest_first:
+        rows.reverse()
+    if not recent:
+        return rows, has_more
+
+    # In-memory messages go after database rows of the same time: from
+    # ``since`` (inclusive) to ``until`` (exclusive)
+    if newest_first:
+        since = rows[0]['created_at'] if has_more and rows else None
+        until = cursor_time
+    else:
+        since = cursor_time
+        until = rows[-1]['created_at'] if has_more and rows else None
+    recent = [
+        row for row in recent
+        if (since is None or row['created_at'] >= since) and (until is None or row['created_at'] < until)
+    ]
+    rows = sorted(rows + recent, key=lambda row: row['created_at'])
+    if len(rows) > limit:
+        has_more = True
+        rows = rows[-limit:] if newest_first else rows[:limit]
+        # The next page starts at the last stored row: leave what is beyond it
+        stored = [i for i, row in enumerate(rows) if isinstance(row['id'], int)]
+        if stored:
+            rows = rows[stored[0]:] if newest_first else rows[:stored[-1] + 1]
+    return rows, has_more
+
+
+def history_page(user_id, contact_id, now, before=None, after=None, limit=DEFAULT_PAGE_SIZE):
+    """
+    Return ``(rows, has_more)`` for the page of unexpired messages older than
+    ``before``, newer than ``after``, or the newest page. Rows are oldest first.
+    """
+    rows = list(_page_query(user_id, contact_id, now, before, after, limit))
+    recent = ephemeral_store.conversation(user_id, contact_id, now)
+    cursor_time = None
+    if recent and (before is not None or after is not None):
+        cursor_time = _cursor_time_query(user_id, contact_id, before, after).first()
+    return _finish_page(rows, before, after, limit, recent, cursor_time)
+
+
+async def ahistory_page(user_id, contact_id, now, before=None, after=None, limit=DEFAULT_PAGE_SIZE):
+    """Async version of ``history_page`` for the async views."""
+    rows = [row async for row in _page_query(user_id, contact_id, now, before, after, limit)]
+    recent = ephemeral_store.conversation(user_id, contact_id, now)
+    cursor_time = None
+    if recent and (before is not None or after is not None):
+        cursor_time = await _cursor_time_query(user_id, contact_id, before, after).afirst()
+    return _finish_page(rows, before, after, limit, recent, cursor_time)
+
+
+def page_cursor(rows, before=None, after=None):
+    """Cursors for the next requests; in-memory rows don't take part."""
+    ids = [row['id'] for row in rows if isinstance(row['id'], int)]
+    return {
+        'before': ids[0] if ids else before,
+        'after': ids[-1] if ids else after,
+    }
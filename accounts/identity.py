@@ -0,0 +1,136 @@
+# accounts/identity.py
+"""
+Process-wide cache of Account identities.
+
+Hot paths mostly need to translate between an account's primary key, its
+``telegram_id`` and its ``username``, plus a couple of display fields.
+``identity_cache`` keeps those in a bounded LRU with a TTL and secondary
+indexes, so any of the three keys resolves without a query once warm.
+Entries are dropped by the ``post_save``/``post_delete`` handlers in
+``accounts.signals``; the TTL bounds staleness for changes made by other
+processes or through ``QuerySet.update()``.
+"""
+import threading
+import time
+from collections import OrderedDict, namedtuple
+
+from django.conf import settings
+
+from .db_executor import consumer_db
+from .models import Account
+
+Identity = namedtuple('Identity', 'id telegram_id username first_name last_name')
+
+IDENTITY_FIELDS = Identity._fields
+
+
+class IdentityCache:
+    def __init__(self, max_size=10000, ttl=300):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.entries = OrderedDict()  # id -> (expires, Identity)
+        self.by_telegram_id = {}
+        self.by_username = {}
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def _lookup(id=None, telegram_id=None, username=None):
+        if id is not None:
+            return {'id': int(id)}
+        if telegram_id is not None:
+            return {'telegram_id': int(telegram_id)}
+        if username:
+            return {'username': username}
+        raise ValueError("id, telegram_id or username is required")
+
+    def peek(self, id=None, telegram_id=None, username=None):
+        """Return the cached identity or None, without touching the database."""
+        (field, value), = self._lookup(id, telegram_id, username).items()
+        with self.lock:
+            if field == 'telegram_id':
+                value = self.by_telegram_id.get(value)
+            elif field == 'username':
+                value = self.by_username.get(value)
+            entry = self.entries.get(value) if value is not None else None
+            if entry is None or entry[0] < time.monotonic():
+                self.misses += 1
+                return None
+            self.entries.move_to_end(value)
+            self.hits += 1
+            return entry[1]
+
+    def get(self, id=None, telegram_id=None, username=None):
+        """Return the identity for one of the keys, loading it on a miss."""
+        identity = self.peek(id, telegram_id, username)
+        if identity is not None:
+            return identity
+        return self._load(id, telegram_id, username)
+
+    async def aget(self, id=None, telegram_id=None, username=None):
+        identity = self.peek(id, telegram_id, username)
+        if identity is not None:
+            return identity
+        # Straight to the query: get() would peek (and count the miss) again
+        return await consumer_db(self._load)(id, telegram_id, username)
+
+    def _load(self, id=None, telegram_id=None, username=None):
+        row = Account.objects.filter(
+            **self._lookup(id, telegram_id, username)
+        ).values_list(*IDENTITY_FIELDS).first()
+        if row is None:
+            return None
+        identity = Identity(*row)
+        self.put(identity)
+        return identity
+
+    def put(self, identity):
+        with self.lock:
+            self._remove(identity.id)
+            self.entries[identity.id] = (time.monotonic() + self.ttl, identity)
+            self.by_telegram_id[identity.telegram_id] = identity.id
+            if identity.username:
+                self.by_username[identity.username] = identity.id
+            while len(self.entries) > self.max_size:
+                self._remove(next(iter(self.entries)))
+                self.evictions += 1
+
+    def invalidate(self, id):
+        with self.lock:
+            self._remove(id)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.by_telegram_id.clear()
+            self.by_username.clear()
+
+    def _remove(self, id):
+        entry = self.entries.pop(id, None)
+        if entry is None:
+            return
+        identity = entry[1]
+        if self.by_telegram_id.get(identity.telegram_id) == id:
+            del self.by_telegram_id[identity.telegram_id]
+        if identity.username and self.by_username.get(identity.username) == id:
+            del self.by_username[identity.username]
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            'size': len(self.entries),
+            'max_size': self.max_size,
+            'ttl': self.ttl,
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'hit_rate': round(self.hits / lookups, 4) if lookups else None,
+        }
+
+
+identity_cache = IdentityCache(
+    max_size=getattr(settings, 'IDENTITY_CACHE_SIZE', 10000),
+    ttl=getattr(settings, 'IDENTITY_CACHE_TTL', 300),
+)
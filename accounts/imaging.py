@@ -0,0 +1,58 @@
+# accounts/imaging.py
+"""
+Thumbnail rendering, run inside the thumbnail worker processes.
+
+Deliberately free of Django imports: the worker pool uses the ``spawn``
+start method, and the child processes only import this module.
+"""
+import os
+import shutil
+import subprocess
+
+from PIL import Image, ImageDraw, ImageOps
+
+
+def render_image(src, dst, size):
+    with Image.open(src) as image:
+        # JPEG: let the decoder downscale by 1/2..1/8 instead of decoding full size
+        image.draft('RGB', (size, size))
+        image = ImageOps.exif_transpose(image)
+        image.thumbnail((size, size))
+        if image.mode not in ('RGB', 'L'):
+            image = image.convert('RGB')
+        image.save(dst, 'JPEG', quality=80, optimize=True)
+
+
+def render_placeholder(dst, size):
+    image = Image.new('RGB', (size, size * 9 // 16), (32, 32, 32))
+    draw = ImageDraw.Draw(image)
+    w, h = image.size
+    r = h // 5
+    draw.polygon([(w // 2 - r // 2, h // 2 - r), (w // 2 - r // 2, h // 2 + r), (w // 2 + r, h // 2)],
+                 fill=(230, 230, 230))
+    image.save(dst, 'JPEG', quality=80)
+
+
+def render_video(src, dst, size):
+    """Poster frame through ffmpeg when installed, a play-button placeholder otherwise."""
+    ffmpeg = shutil.which('ffmpeg')
+    if ffmpeg:
+        # 1s in skips black intro frames; very short clips fall back to the first frame
+        for seek in ('1', '0'):
+            result = subprocess.run(
+                [ffmpeg, '-v', 'error', '-y', '-ss', seek, '-i', src, '-frames:v', '1',
+                 '-vf', f'scale={size}:{size}:force_original_aspect_ratio=decrease', dst],
+                stdin=subprocess.DEVNULL, capture_output=True, timeout=60,
+            )
+            if result.returncode == 0 and os.path.exists(dst) and os.path.getsize(dst):
+                return 'poster'
+    render_placeholder(dst, size)
+    return 'placeholder'
+
+
+def render_thumbnail(message_type, src, dst, size):
+    """Write a JPEG thumbnail of ``src`` to ``dst``; returns what was rendered."""
+    if message_type == 'video':
+        return render_video(src, dst, size)
+    render_image(src, dst, size)
+    return 'image'
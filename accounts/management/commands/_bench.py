@@ -0,0 +1,96 @@
+"""Helpers shared by the bench_* management commands."""
+import os
+import random
+import shutil
+import statistics
+import tempfile
+import time
+from contextlib import contextmanager
+from datetime import timedelta
+
+from django.db import connections, transaction
+from django.utils import timezone
+
+from accounts.models import Account, Message
+from accounts.sharding import conversation_key
+
+
+@contextmanager
+def scratch_database(alias='default'):
+    """Run the body against a freshly migrated throwaway SQLite file."""
+    connection = connections[alias]
+    old_name = connection.settings_dict['NAME']
+    old_test = dict(connection.settings_dict.get('TEST') or {})
+    tmpdir = tempfile.mkdtemp(prefix='vchat_bench_')
+    connection.settings_dict['TEST'] = {**old_test, 'NAME': os.path.join(tmpdir, 'bench.sqlite3')}
+    connection.creation.create_test_db(verbosity=0, autoclobber=True, serialize=False)
+    try:
+        yield connection
+    finally:
+        connection.creation.destroy_test_db(old_name, verbosity=0)
+        connection.settings_dict['TEST'] = old_test
+        shutil.rmtree(tmpdir, ignore_errors=True)
+
+
+def seed_accounts(count):
+    Account.objects.bulk_create(
+        [Account(telegram_id=1_000_000 + i, first_name=f'User {i}', username=f'user_{i}')
+         for i in range(count)],
+        batch_size=5000,
+    )
+    return list(Account.objects.order_by('id').values_list('id', flat=True))
+
+
+def seed_messages(rows, account_ids, hot_pair, hot_share=0.05, batch=50000, expired_share=0.0):
+    """
+    Insert ``rows`` messages between random pairs; ``hot_share`` of them go
+    to ``hot_pair`` so there is one long conversation to page through.
+
+    Rows are written with raw executemany(); going through bulk_create()
+    makes seeding millions of rows take minutes.
+    """
+    connection = connections['default']
+    now = timezone.now()
+    fields = [f for f in Message._meta.concrete_fields if not f.primary_key]
+    template = Message(sender_id=0, receiver_id=0, text='', created_at=now, expires_at=now)
+    base = {f.column: f.get_db_prep_save(getattr(template, f.attname), connection) for f in fields}
+    columns = list(base)
+    positions = {column: columns.index(column) for column in
+                 ('sender_id', 'receiver_id', 'conversation_key', 'text', 'expires_at')}
+    sql = 'INSERT INTO %s (%s) VALUES (%s)' % (
+        Message._meta.db_table, ', '.join(columns), ', '.join(['%s'] * len(columns))
+    )
+    alive = connection.ops.adapt_datetimefield_value(now + timedelta(days=1))
+    expired = connection.ops.adapt_datetimefield_value(now - timedelta(minutes=1))
+    texts = ['x' * n for n in range(5, 81)]
+
+    rng = random.Random(42)
+    done = 0
+    while done < rows:
+        chunk = []
+        for _ in range(min(batch, rows - done)):
+            if rng.random() < hot_share:
+                sender, receiver = hot_pair if rng.random() < 0.5 else hot_pair[::-1]
+            else:
+                sender, receiver = rng.sample(account_ids, 2)
+            row = list(base.values())
+            row[positions['sender_id']] = sender
+            row[positions['receiver_id']] = receiver
+            row[positions['conversation_key']] = conversation_key(sender, receiver)
+            row[positions['text']] = rng.choice(texts)
+            row[positions['expires_at']] = expired if rng.random() < expired_share else alive
+            chunk.append(row)
+        with transaction.atomic(), connection.cursor() as cursor:
+            cursor.executemany(sql, chunk)
+        done += len(chunk)
+
+
+def timed(func, repeat=20):
+    """Return (p50, p99) wall time in milliseconds."""
+    samples = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        func()
+        samples.append((time.perf_counter() - started) * 1000)
+    samples.sort()
+    return statistics.median(samples), samples[min(len(samples) - 1, int(len(samples) * 0.99))]
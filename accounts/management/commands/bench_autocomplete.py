@@ -0,0 +1,57 @@
+import gc
+import random
+import string
+import time
+import tracemalloc
+
+from django.core.management.base import BaseCommand
+
+from accounts.autocomplete import PrefixIndex
+
+from ._bench import timed
+
+
+class Command(BaseCommand):
+    help = "Memory per million accounts and lookup latency of the in-memory autocomplete index"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--users', type=int, default=1_000_000)
+        parser.add_argument('--limit', type=int, default=10)
+
+    def handle(self, *args, **options):
+        users = options['users']
+        rng = random.Random(42)
+
+        def name(low, high):
+            return ''.join(rng.choices(string.ascii_lowercase, k=rng.randint(low, high)))
+
+        rows = [(i + 1, f'{name(4, 10)}_{i}', name(3, 9).title()) for i in range(users)]
+
+        gc.collect()
+        tracemalloc.start()
+        started = time.perf_counter()
+        index = PrefixIndex()
+        index.load(iter(rows))
+        elapsed = time.perf_counter() - started
+        gc.collect()
+        used = tracemalloc.get_traced_memory()[0]
+        tracemalloc.stop()
+
+        self.stdout.write(f"🔤 Indexed {users:,} accounts ({len(index.entries):,} entries) in {elapsed:.1f}s")
+        self.stdout.write(
+            f"  memory: {used / 2**20:,.1f} MiB total, {used / users:,.0f} B/account, "
+            f"{used / users * 1_000_000 / 2**20:,.0f} MiB per million accounts"
+        )
+
+        limit = options['limit']
+        for label, prefix in (('1 char', 'k'), ('3 chars', 'kat'), ('full username', rows[-1][1]),
+                              ('no match', 'zzzzzzzzzzzz')):
+            p50, p99 = timed(lambda: index.suggest(prefix, limit=limit), repeat=2000)
+            self.stdout.write(f"  {label:<14} p50={p50 * 1000:7.1f}µs  p99={p99 * 1000:7.1f}µs")
+
+        started = time.perf_counter()
+        for i in range(1000):
+            index.update(users + i + 1, f'new_{i}', 'New')
+        self.stdout.write(
+            f"  update (insort): {(time.perf_counter() - started):.3f}ms per account"
+        )
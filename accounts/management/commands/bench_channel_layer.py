@@ -0,0 +1,124 @@
+import asyncio
+import multiprocessing
+import os
+import shutil
+import tempfile
+import time
+
+from channels.layers import InMemoryChannelLayer
+from django.core.management.base import BaseCommand
+
+from config.channel_layers import SQLiteChannelLayer
+
+GROUP = 'bench'
+
+
+async def _join_and_receive(layer, receivers, messages, ready=None):
+    channels = [await layer.new_channel() for _ in range(receivers)]
+    for channel in channels:
+        await layer.group_add(GROUP, channel)
+    if ready is not None:
+        ready.set()
+
+    async def drain(channel):
+        for _ in range(messages):
+            await layer.receive(channel)
+
+    return asyncio.gather(*(drain(channel) for channel in channels))
+
+
+def _remote_receivers(path, receivers, messages, ready, done):
+    """Runs in a child process: join the group and drain every message."""
+    async def main():
+        layer = SQLiteChannelLayer(path=path, capacity=messages + 1)
+        waiter = await _join_and_receive(layer, receivers, messages, ready)
+        await waiter
+        done.put(time.perf_counter())
+        await layer.close()
+
+    asyncio.run(main())
+
+
+class Command(BaseCommand):
+    help = "Measure group_send fan-out throughput of the in-memory and SQLite channel layers"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--receivers', type=int, default=50, help='Receivers per process')
+        parser.add_argument('--messages', type=int, default=200, help='group_send calls')
+        parser.add_argument('--processes', type=int, default=2,
+                            help='Extra receiver processes for the SQLite layer')
+
+    def handle(self, *args, **options):
+        receivers = options['receivers']
+        messages = options['messages']
+        processes = options['processes']
+
+        self.stdout.write(f"📊 Fan-out: {messages} messages -> {receivers} receivers/process")
+
+        elapsed = asyncio.run(self.local_fanout(
+            InMemoryChannelLayer(capacity=messages + 1), receivers, messages
+        ))
+        self.report('memory (1 process)', receivers * messages, elapsed)
+
+        tmpdir = tempfile.mkdtemp(prefix='bench_layer_')
+        try:
+            path = os.path.join(tmpdir, 'channels.sqlite3')
+            elapsed = asyncio.run(self.local_fanout(
+                SQLiteChannelLayer(path=path, capacity=messages + 1), receivers, messages
+            ))
+            self.report('sqlite (1 process)', receivers * messages, elapsed)
+
+            if processes:
+                path = os.path.join(tmpdir, 'channels-mp.sqlite3')
+                elapsed = self.cross_process_fanout(path, receivers, messages, processes)
+                self.report(
+                    f'sqlite ({processes} processes)',
+                    receivers * messages * processes,
+                    elapsed,
+                )
+        finally:
+            shutil.rmtree(tmpdir, ignore_errors=True)
+
+    async def local_fanout(self, layer, receivers, messages):
+        waiter = await _join_and_receive(layer, receivers, messages)
+        started = time.perf_counter()
+        for i in range(messages):
+            await layer.group_send(GROUP, {'type': 'chat.message', 'n': i})
+        await waiter
+        elapsed = time.perf_counter() - started
+        await layer.close()
+        return elapsed
+
+    def cross_process_fanout(self, path, receivers, messages, processes):
+        ctx = multiprocessing.get_context('spawn')
+        done = ctx.Queue()
+        workers = []
+        for _ in range(processes):
+            ready = ctx.Event()
+            worker = ctx.Process(
+                target=_remote_receivers,
+                args=(path, receivers, messages, ready, done),
+            )
+            worker.start()
+            workers.append((worker, ready))
+        for _, ready in workers:
+            ready.wait()
+
+        async def send_all():
+            layer = SQLiteChannelLayer(path=path, capacity=messages + 1)
+            for i in range(messages):
+                await layer.group_send(GROUP, {'type': 'chat.message', 'n': i})
+            await layer.close()
+
+        started = time.perf_counter()
+        asyncio.run(send_all())
+        finished = max(done.get() for _ in range(processes))
+        for worker, _ in workers:
+            worker.join()
+        return finished - started
+
+    def report(self, label, deliveries, elapsed):
+        self.stdout.write(
+            f"  {label:<22} {deliveries:>8} deliveries in {elapsed:.3f}s "
+            f"= {deliveries / elapsed:,.0f} msg/s"
+        )
@@ -0,0 +1,137 @@
+import statistics
+import threading
+import time
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand
+from django.db import close_old_connections, connections, transaction
+from django.utils import timezone
+
+from accounts.db_executor import DatabaseWriter
+from accounts.history import history_page
+from accounts.models import Message
+
+from ._bench import scratch_database, seed_accounts, seed_messages
+
+PROFILES = {
+    # What DATABASES had before: rollback journal, deferred transactions, 5s timeout
+    'default': {
+        'OPTIONS': {'init_command': 'PRAGMA journal_mode=DELETE;', 'timeout': 5},
+        'single_writer': False,
+    },
+    'wal': {
+        'OPTIONS': {
+            'init_command': 'PRAGMA journal_mode=WAL;PRAGMA synchronous=NORMAL;',
+            'timeout': 20,
+            'transaction_mode': 'IMMEDIATE',
+        },
+        'single_writer': False,
+    },
+    'wal + single writer': {
+        'OPTIONS': {
+            'init_command': 'PRAGMA journal_mode=WAL;PRAGMA synchronous=NORMAL;',
+            'timeout': 20,
+            'transaction_mode': 'IMMEDIATE',
+        },
+        'single_writer': True,
+    },
+}
+
+
+def percentile(samples, share):
+    return samples[min(len(samples) - 1, int(len(samples) * share))] if samples else 0
+
+
+class Command(BaseCommand):
+    help = "Concurrent message inserts (consumers) against get_messages reads per SQLite profile"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--writers', type=int, default=16)
+        parser.add_argument('--readers', type=int, default=8)
+        parser.add_argument('--seconds', type=float, default=5)
+        parser.add_argument('--messages', type=int, default=100_000)
+
+    def handle(self, *args, **options):
+        with scratch_database() as connection:
+            account_ids = seed_accounts(200)
+            pair = (account_ids[0], account_ids[1])
+            seed_messages(options['messages'], account_ids, pair)
+            settings_dict = connection.settings_dict
+            original = dict(settings_dict.get('OPTIONS') or {})
+            try:
+                for label, profile in PROFILES.items():
+                    connections.close_all()
+                    settings_dict['OPTIONS'] = dict(profile['OPTIONS'])
+                    self.report(label, self.run(profile, account_ids, pair, options))
+            finally:
+                connections.close_all()
+                settings_dict['OPTIONS'] = original
+
+    def run(self, profile, account_ids, pair, options):
+        writer = DatabaseWriter(max_batch=64) if profile['single_writer'] else None
+        deadline = time.perf_counter() + options['seconds']
+        lock = threading.Lock()
+        result = {'writes': [], 'reads': [], 'errors': 0}
+
+        def insert(sender_id, receiver_id):
+            # One row per call, like a consumer saving one message
+            with transaction.atomic():
+                Message.objects.create(
+                    sender_id=sender_id, receiver_id=receiver_id, text='bench',
+                    expires_at=timezone.now() + timedelta(days=1),
+                )
+
+        def write_loop(n):
+            sender_id, receiver_id = account_ids[2 + n % 100], account_ids[102 + n % 98]
+            samples, errors = [], 0
+            while time.perf_counter() < deadline:
+                started = time.perf_counter()
+                try:
+                    if writer:
+                        writer.call(insert, sender_id, receiver_id)
+                    else:
+                        insert(sender_id, receiver_id)
+                    samples.append((time.perf_counter() - started) * 1000)
+                except Exception:
+                    errors += 1  # database is locked
+            close_old_connections()
+            connections['default'].close()
+            with lock:
+                result['writes'] += samples
+                result['errors'] += errors
+
+        def read_loop(n):
+            samples = []
+            while time.perf_counter() < deadline:
+                started = time.perf_counter()
+                history_page(pair[0], pair[1], timezone.now())
+                samples.append((time.perf_counter() - started) * 1000)
+            connections['default'].close()
+            with lock:
+                result['reads'] += samples
+
+        threads = (
+            [threading.Thread(target=write_loop, args=(n,)) for n in range(options['writers'])]
+            + [threading.Thread(target=read_loop, args=(n,)) for n in range(options['readers'])]
+        )
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        if writer:
+            result['commits'] = writer.commits
+        result['seconds'] = options['seconds']
+        return result
+
+    def report(self, label, result):
+        writes, reads = sorted(result['writes']), sorted(result['reads'])
+        line = (
+            f"{label:<20} writes {len(writes) / result['seconds']:8,.0f}/s "
+            f"p50={statistics.median(writes) if writes else 0:7.1f}ms p99={percentile(writes, 0.99):7.1f}ms "
+            f"locked={result['errors']:<5} "
+            f"reads {len(reads) / result['seconds']:8,.0f}/s "
+            f"p50={statistics.median(reads) if reads else 0:7.1f}ms p99={percentile(reads, 0.99):7.1f}ms"
+        )
+        if 'commits' in result:
+            line += f" ({len(writes) / max(result['commits'], 1):.1f} writes/commit)"
+        self.stdout.write(line)
@@ -0,0 +1,112 @@
+import asyncio
+import json
+import random
+import statistics
+import time
+import types
+from functools import wraps
+
+from asgiref.sync import async_to_sync, iscoroutinefunction
+from django.core.management.base import BaseCommand
+from django.test import AsyncClient, override_settings
+from django.urls import clear_url_caches, path
+
+from accounts import urls as account_urls
+from accounts.models import Contact
+
+from ._bench import scratch_database, seed_accounts, seed_messages
+
+
+def as_sync_view(view):
+    """
+    Run an async view the way a plain ``def`` view runs under ASGI: on the
+    single thread-sensitive executor, for the whole request.
+    """
+    @wraps(view)
+    def sync_view(request, *args, **kwargs):
+        return async_to_sync(view)(request, *args, **kwargs)
+    return sync_view
+
+
+def build_urlconf(sync):
+    module = types.ModuleType('bench_sync_urls' if sync else 'bench_async_urls')
+    module.urlpatterns = [
+        path(
+            str(pattern.pattern),
+            as_sync_view(pattern.callback)
+            if sync and iscoroutinefunction(pattern.callback) else pattern.callback,
+            name=pattern.name,
+        )
+        for pattern in account_urls.urlpatterns
+    ]
+    return module
+
+
+class Command(BaseCommand):
+    help = "p50/p99 latency of the hot HTTP endpoints under many concurrent clients, sync vs async views"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--clients', type=int, default=500)
+        parser.add_argument('--rounds', type=int, default=2,
+                            help='Request cycles per client')
+        parser.add_argument('--messages', type=int, default=50_000)
+
+    def handle(self, *args, **options):
+        with scratch_database():
+            account_ids = seed_accounts(max(options['clients'], 2) + 1)
+            pairs = list(zip(account_ids, account_ids[1:]))
+            Contact.objects.bulk_create(
+                [Contact(user_id=a, contact_id=b, is_accepted=True) for a, b in pairs]
+                + [Contact(user_id=b, contact_id=a, is_accepted=True) for a, b in pairs]
+            )
+            seed_messages(options['messages'], account_ids, pairs[0])
+
+            for label, sync in (('sync views (before)', True), ('async views (after)', False)):
+                clear_url_caches()
+                with override_settings(ROOT_URLCONF=build_urlconf(sync)):
+                    latencies, elapsed = async_to_sync(self.run_clients)(
+                        pairs[:options['clients']], options['rounds']
+                    )
+                clear_url_caches()
+                self.report(label, latencies, elapsed)
+
+    async def run_clients(self, pairs, rounds):
+        latencies = {}
+
+        async def client(user_id, contact_id):
+            c = AsyncClient()
+            c.cookies['user_id'] = str(user_id)
+            requests = [
+                ('contacts', lambda: c.get('/api/contacts/')),
+                ('messages', lambda: c.get(f'/api/messages/{contact_id}/')),
+                ('search', lambda: c.post(
+                    '/api/search/users/',
+                    json.dumps({'type': 'username', 'value': f'user_{random.randint(0, 99)}'}),
+                    content_type='application/json',
+                )),
+                ('send', lambda: c.post(
+                    '/api/messages/send/',
+                    json.dumps({'to_user_id': contact_id, 'content': 'bench'}),
+                    content_type='application/json',
+                )),
+            ]
+            for _ in range(rounds):
+                for name, request in requests:
+                    started = time.perf_counter()
+                    response = await request()
+                    latencies.setdefault(name, []).append((time.perf_counter() - started) * 1000)
+                    assert response.status_code == 200, (name, response.content[:200])
+
+        started = time.perf_counter()
+        await asyncio.gather(*(client(a, b) for a, b in pairs))
+        return latencies, time.perf_counter() - started
+
+    def report(self, label, latencies, elapsed):
+        total = sum(len(samples) for samples in latencies.values())
+        self.stdout.write(f"\n{label}: {total} requests in {elapsed:.2f}s ({total / elapsed:,.0f} req/s)")
+        for name, samples in latencies.items():
+            samples.sort()
+            p99 = samples[min(len(samples) - 1, int(len(samples) * 0.99))]
+            self.stdout.write(
+                f"  {name:<10} p50={statistics.median(samples):8.1f}ms  p99={p99:8.1f}ms"
+            )
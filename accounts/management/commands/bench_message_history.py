@@ -0,0 +1,68 @@
+import time
+
+from django.core.management.base import BaseCommand
+from django.db.models import Q
+from django.utils import timezone
+
+from accounts.history import history_page
+from accounts.models import Message
+from accounts.sharding import conversation_key
+
+from ._bench import scratch_database, seed_accounts, seed_messages, timed
+
+
+class Command(BaseCommand):
+    help = "Compare full-history and keyset-paginated get_messages queries on a seeded table"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--rows', type=int, default=2_000_000)
+        parser.add_argument('--users', type=int, default=2000)
+        parser.add_argument('--limit', type=int, default=50)
+
+    def handle(self, *args, **options):
+        with scratch_database() as connection:
+            started = time.perf_counter()
+            account_ids = seed_accounts(options['users'])
+            a, b = account_ids[0], account_ids[1]
+            seed_messages(options['rows'], account_ids, (a, b))
+            self.stdout.write(
+                f"🌱 Seeded {options['rows']:,} messages in {time.perf_counter() - started:.1f}s"
+            )
+
+            now = timezone.now()
+            old_hot = Message.objects.filter(
+                Q(sender_id=a, receiver_id=b) | Q(sender_id=b, receiver_id=a)
+            )
+            hot = Message.objects.filter(conversation_key=conversation_key(a, b))
+            total = hot.count()
+            middle = hot.order_by('id').values_list('id', flat=True)[total // 2]
+            limit = options['limit']
+            self.stdout.write(f"💬 Hot conversation: {total:,} messages")
+
+            # A short conversation of the same busy user: without the key index
+            # SQLite falls back to scanning a's messages to find the few with c
+            c = account_ids[2]
+
+            cases = [
+                ('full history (old)', lambda: list(
+                    old_hot.filter(expires_at__gte=now).order_by('created_at')
+                )),
+                ('OR page (old)', lambda: list(
+                    old_hot.filter(expires_at__gte=now).order_by('-id')[:limit + 1]
+                )),
+                ('newest page', lambda: history_page(a, b, now, limit=limit)),
+                ('page before middle', lambda: history_page(a, b, now, before=middle, limit=limit)),
+                ('page after middle', lambda: history_page(a, b, now, after=middle, limit=limit)),
+                ('short conversation', lambda: history_page(a, c, now, limit=limit)),
+            ]
+            self.run_cases('with message_conversation_key_idx', cases)
+
+            with connection.cursor() as cursor:
+                cursor.execute('DROP INDEX message_conversation_key_idx')
+            self.run_cases('without the index', cases[2:])
+
+    def run_cases(self, title, cases):
+        self.stdout.write(f"\n{title}")
+        for label, func in cases:
+            p50, p99 = timed(func, repeat=5 if 'full' in label else 50)
+            self.stdout.write(f"  {label:<22} p50={p50:8.2f}ms  p99={p99:8.2f}ms")
@@ -0,0 +1,119 @@
+import multiprocessing
+import random
+import shutil
+import tempfile
+import threading
+import time
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand
+from django.db import connections
+from django.test import override_settings
+from django.utils import timezone
+
+from accounts.batching import save_messages
+from accounts.db_executor import DatabaseWriter
+from accounts.models import Message
+from accounts.sharding import message_databases, message_db
+
+from ._bench import scratch_database
+
+
+class Command(BaseCommand):
+    help = "Message insert throughput of several worker processes with 1..N conversation shards"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--shards', default='1,2,4,8',
+                            help='Comma-separated shard counts to compare')
+        parser.add_argument('--processes', type=int, default=4,
+                            help='Writer processes (ASGI workers)')
+        parser.add_argument('--clients', type=int, default=32,
+                            help='Concurrent senders, spread over the processes')
+        parser.add_argument('--seconds', type=float, default=5)
+        parser.add_argument('--synchronous', default='NORMAL', choices=['OFF', 'NORMAL', 'FULL'],
+                            help='PRAGMA synchronous of the shard files')
+
+    def handle(self, *args, **options):
+        with scratch_database():
+            self.compare(options)
+
+    def compare(self, options):
+        baseline = None
+        for count in [int(n) for n in options['shards'].split(',')]:
+            tmpdir = tempfile.mkdtemp(prefix='vchat_shards_')
+            try:
+                with override_settings(MESSAGE_SHARDS=count):
+                    aliases = message_databases()
+                    self.create_shards(aliases, tmpdir, options['synchronous'])
+                    sent, commits = self.run(aliases, options['processes'], options['clients'], options['seconds'])
+            finally:
+                for alias in aliases:
+                    connections[alias].close()
+                    if alias != 'default':
+                        del connections.settings[alias]
+                        delattr(connections._connections, alias)
+                shutil.rmtree(tmpdir, ignore_errors=True)
+
+            rate = sent / options['seconds']
+            baseline = baseline or rate
+            self.stdout.write(
+                f"{count:>2} shard(s): {rate:9,.0f} messages/s  ({rate / baseline:4.2f}x, "
+                f"{sent / max(commits, 1):.1f} messages/commit)"
+            )
+
+    def create_shards(self, aliases, tmpdir, synchronous):
+        template = connections.settings['default']
+        for alias in aliases:
+            options = dict(template.get('OPTIONS') or {})
+            options['init_command'] = f'PRAGMA journal_mode=WAL;PRAGMA synchronous={synchronous};'
+            if alias == 'default':
+                # One shard: the (scratch) default database itself
+                connections['default'].close()
+                template['OPTIONS'] = options
+                continue
+            connections.settings[alias] = {
+                **template, 'NAME': f'{tmpdir}/{alias}.sqlite3', 'OPTIONS': options,
+            }
+            with connections[alias].schema_editor() as editor:
+                # No foreign key constraints: the shard has no accounts table
+                editor.create_model(Message)
+
+    def run(self, aliases, processes, clients, seconds):
+        # Several worker processes, like several ASGI workers: they compete for the file locks
+        connections.close_all()
+        with multiprocessing.get_context('fork').Pool(processes) as pool:
+            results = pool.starmap(send_messages, [
+                (aliases, max(clients // processes, 1), seconds, n) for n in range(processes)
+            ])
+        return sum(sent for sent, _ in results), sum(commits for _, commits in results)
+
+
+def send_messages(aliases, clients, seconds, seed):
+    """One process: ``clients`` threads sending through a writer per shard."""
+    connections.close_all()
+    writers = {alias: DatabaseWriter(max_batch=64, alias=alias) for alias in aliases}
+    deadline = time.perf_counter() + seconds
+    lock = threading.Lock()
+    totals = {'sent': 0}
+
+    def client(n):
+        rng = random.Random(seed * 1000 + n)
+        sent = 0
+        while time.perf_counter() < deadline:
+            sender_id, receiver_id = rng.sample(range(1, 10_001), 2)
+            alias = message_db(sender_id, receiver_id)
+            message = Message(
+                sender_id=sender_id, receiver_id=receiver_id, text='bench',
+                expires_at=timezone.now() + timedelta(days=1),
+            )
+            writers[alias].call(save_messages, alias, [message])
+            sent += 1
+        with lock:
+            totals['sent'] += sent
+
+    threads = [threading.Thread(target=client, args=(n,)) for n in range(clients)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return totals['sent'], sum(writer.commits for writer in writers.values())
@@ -0,0 +1,101 @@
+import asyncio
+import json
+import tracemalloc
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand
+from django.core.serializers.json import DjangoJSONEncoder
+from django.utils import timezone
+
+from accounts import serialization
+from accounts.serialization import dumps, stream_json
+
+from ._bench import timed
+
+
+def history_rows(count):
+    now = timezone.now()
+    return [{
+        'id': 1_000_000 + i,
+        'content': 'x' * (20 + i % 60),
+        'sender_id': 7 if i % 2 else 9,
+        'is_read': bool(i % 3),
+        'created_at': (now + timedelta(seconds=i)).isoformat(),
+        'expires_at': (now + timedelta(days=1, seconds=i)).isoformat(),
+    } for i in range(count)]
+
+
+def event():
+    return {
+        'type': 'new_message',
+        'message': 'hello there, how are you?',
+        'from_user_id': 123456789,
+        'message_id': 'c-1a2b3c',
+        'timestamp': timezone.now().isoformat(),
+    }
+
+
+def peak_kib(func):
+    tracemalloc.start()
+    try:
+        func()
+        return tracemalloc.get_traced_memory()[1] / 1024
+    finally:
+        tracemalloc.stop()
+
+
+class Command(BaseCommand):
+    help = "JSON encoding of history pages and WebSocket events: stdlib vs the fast encoder"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--rows', default='50,200,10000',
+                            help='Comma-separated history sizes')
+        parser.add_argument('--events', type=int, default=10_000,
+                            help='WebSocket events per timing')
+
+    def handle(self, *args, **options):
+        encoder = 'orjson' if serialization.orjson is not None else 'json (orjson not installed)'
+        self.stdout.write(f"Fast encoder: {encoder}")
+
+        for count in [int(n) for n in options['rows'].split(',')]:
+            rows = history_rows(count)
+            payload = {'success': True, 'messages': rows, 'has_more': False}
+            self.stdout.write(f"\nhistory, {count:,} messages ({len(dumps(payload)) / 1024:,.0f} KiB)")
+            repeat = max(5, min(200, 200_000 // count))
+            self.report('JsonResponse (json)', timed(
+                lambda: json.dumps(payload, cls=DjangoJSONEncoder).encode(), repeat=repeat,
+            ))
+            self.report('dumps()', timed(lambda: dumps(payload), repeat=repeat))
+            self.report('stream_json()', timed(lambda: asyncio.run(self.drain(rows)), repeat=repeat))
+
+        for label, build in (('whole body', self.whole), ('stream_json()', self.streamed)):
+            self.stdout.write(f"  peak memory, 10,000 messages generated on the fly, {label}: "
+                              f"{peak_kib(build):,.0f} KiB")
+
+        events = options['events']
+        self.stdout.write(f"\n{events:,} WebSocket events")
+        self.report('json.dumps()', timed(lambda: [json.dumps(event()) for _ in range(events)], repeat=5))
+        self.report('dumps_text()', timed(
+            lambda: [serialization.dumps_text(event()) for _ in range(events)], repeat=5,
+        ))
+
+    async def drain(self, rows, tail=None):
+        size = 0
+        async for piece in stream_json({'success': True}, 'messages', rows, tail or {'has_more': False}):
+            size += len(piece)
+        return size
+
+    def whole(self):
+        rows = history_rows(10_000)
+        return len(dumps({'success': True, 'messages': rows, 'has_more': False}))
+
+    def streamed(self):
+        def rows():
+            # The dicts are made as the stream asks for them
+            for _ in range(0, 10_000, 100):
+                yield from history_rows(100)
+        return asyncio.run(self.drain(rows()))
+
+    def report(self, label, result):
+        p50, p99 = result
+        self.stdout.write(f"  {label:<22} p50={p50:8.3f}ms  p99={p99:8.3f}ms")
@@ -0,0 +1,46 @@
+import time
+
+from django.core.management.base import BaseCommand
+from django.db.models import Q
+
+from accounts.models import Account
+from accounts.search import rebuild_search_index, search_accounts
+
+from ._bench import scratch_database, seed_accounts, timed
+
+
+class Command(BaseCommand):
+    help = "Compare icontains user search with the FTS5 trigram index on a seeded table"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--users', type=int, default=1_000_000)
+
+    def handle(self, *args, **options):
+        with scratch_database():
+            started = time.perf_counter()
+            seed_accounts(options['users'])
+            self.stdout.write(
+                f"🌱 Seeded {options['users']:,} accounts in {time.perf_counter() - started:.1f}s"
+            )
+            started = time.perf_counter()
+            rebuild_search_index()
+            self.stdout.write(f"🔍 Indexed in {time.perf_counter() - started:.1f}s")
+
+            last = options['users'] - 1
+            queries = [
+                ('exact username', f'user_{last}', False),
+                ('@username prefix', f'user_{last // 10}', True),
+                ('substring', str(last // 100), False),
+                ('no match', 'zzzzzz', False),
+            ]
+            for label, value, prefix in queries:
+                old = lambda: list(Account.objects.filter(
+                    Q(username__icontains=value) | Q(first_name__icontains=value)
+                )[:10])
+                new = lambda: search_accounts(value, prefix=prefix)
+                old_p50, old_p99 = timed(old, repeat=5)
+                new_p50, new_p99 = timed(new, repeat=50)
+                self.stdout.write(
+                    f"  {label:<18} icontains p50={old_p50:8.2f}ms p99={old_p99:8.2f}ms   "
+                    f"fts5 p50={new_p50:8.2f}ms p99={new_p99:8.2f}ms"
+                )
@@ -0,0 +1,39 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from accounts.media_gc import media_collector
+
+
+class Command(BaseCommand):
+    help = "Remove media files no message refers to and apply the media quotas"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=None)
+        parser.add_argument('--pause', type=float, default=None,
+                            help='Seconds to sleep between batches')
+        parser.add_argument('--dry-run', action='store_true',
+                            help='Only report what would be removed')
+        parser.add_argument('--loop', action='store_true', help='Keep running')
+        parser.add_argument('--interval', type=float, default=300,
+                            help='Seconds between passes with --loop')
+
+    def handle(self, *args, **options):
+        while True:
+            started = time.perf_counter()
+            media_collector.collect(
+                batch_size=options['batch_size'],
+                pause=options['pause'],
+                dry_run=options['dry_run'],
+            )
+            stats = media_collector.stats()
+            self.stdout.write(
+                f"🧹 {stats['scanned']} files scanned, {stats['removed_files']} "
+                f"{'would be ' if options['dry_run'] else ''}removed ({stats['removed_bytes']} bytes), "
+                f"{stats['fixed_blobs']} blobs fixed, {stats['expired_uploads']} uploads expired, "
+                f"{stats['quota_expired']} messages over quota, {stats['disk_bytes']} bytes on disk, "
+                f"{time.perf_counter() - started:.2f}s"
+            )
+            if not options['loop']:
+                break
+            time.sleep(options['interval'])
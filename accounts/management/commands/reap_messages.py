@@ -0,0 +1,35 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from accounts.reaper import reap_expired
+
+
+class Command(BaseCommand):
+    help = "Delete expired messages in bounded batches"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=1000)
+        parser.add_argument('--max-batches', type=int, default=None,
+                            help='Stop after this many batches per shard (default: until done)')
+        parser.add_argument('--pause', type=float, default=0,
+                            help='Seconds to sleep between batches')
+        parser.add_argument('--loop', action='store_true', help='Keep running')
+        parser.add_argument('--interval', type=float, default=30,
+                            help='Seconds between runs with --loop')
+
+    def handle(self, *args, **options):
+        while True:
+            stats = reap_expired(
+                batch_size=options['batch_size'],
+                max_batches=options['max_batches'],
+                pause=options['pause'],
+            )
+            self.stdout.write(
+                f"🗑️ {stats['last_rows']} rows in {stats['batches']} batches, "
+                f"{stats['elapsed']:.2f}s ({stats['last_rows_per_sec'] or 0} rows/s), "
+                f"backlog {stats['last_backlog']}"
+            )
+            if not options['loop']:
+                break
+            time.sleep(options['interval'])
@@ -0,0 +1,17 @@
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+
+from accounts.search import rebuild_search_index, search_index_available
+
+
+class Command(BaseCommand):
+    help = "Repopulate the FTS5 user search index from the accounts table"
+
+    def handle(self, *args, **options):
+        if not search_index_available():
+            raise CommandError("User search index is not available (needs SQLite with FTS5, run migrate)")
+
+        started = time.perf_counter()
+        count = rebuild_search_index()
+        self.stdout.write(f"🔍 Indexed {count:,} accounts in {time.perf_counter() - started:.2f}s")
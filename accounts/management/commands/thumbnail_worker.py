@@ -0,0 +1,30 @@
+import asyncio
+
+from django.core.management.base import BaseCommand
+
+from accounts.thumbnails import ThumbnailWorker
+
+
+class Command(BaseCommand):
+    help = "Render queued media thumbnails in a process pool"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--processes', type=int, default=None,
+                            help='Worker processes (default: THUMBNAIL_WORKERS)')
+        parser.add_argument('--batch-size', type=int, default=None)
+        parser.add_argument('--once', action='store_true', help='Exit when the queue is empty')
+
+    def handle(self, *args, **options):
+        worker = ThumbnailWorker(processes=options['processes'], batch_size=options['batch_size'])
+        self.stdout.write(f"🖼️ Thumbnail worker {worker.token}: {worker.processes} processes")
+        try:
+            asyncio.run(worker.run(once=options['once']))
+        except KeyboardInterrupt:
+            pass
+        finally:
+            if worker.pool is not None:
+                worker.pool.shutdown()
+            stats = worker.stats()
+            self.stdout.write(
+                f"✅ {stats['processed']} done, {stats['failed']} failed, {stats['queue_depth']} pending"
+            )
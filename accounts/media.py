@@ -0,0 +1,164 @@
+# accounts/media.py
+"""
+Serving message media: HTTP Range, validators and chunked streaming.
+
+Files are streamed in ``MEDIA_BLOCK_SIZE`` pieces by an async iterator,
+limited to the requested byte range, so seeking in a video only reads what
+the player asks for. (``FileResponse`` would be read whole into memory
+under ASGI, since its iterator is synchronous.)
+Content-addressed files use their hash as a strong ETag; older files use
+size and mtime. With ``MEDIA_SENDFILE_HEADER`` set (``X-Accel-Redirect`` for
+nginx, ``X-Sendfile`` for Apache), the view only checks access, and the
+front server sends the file with ``sendfile()``, including Range handling.
+"""
+import asyncio
+import os
+
+from django.conf import settings
+from django.http import HttpResponse, HttpResponseNotModified, StreamingHttpResponse
+from django.urls import reverse
+from django.utils.http import content_disposition_header, http_date, parse_etags, parse_http_date_safe
+
+from .storage import CAS_PREFIX
+
+
+class RangeNotSatisfiable(Exception):
+    pass
+
+
+def media_url(message_id, thumbnail=False):
+    name = 'accounts:serve_thumbnail' if thumbnail else 'accounts:serve_media'
+    return reverse(name, args=[message_id])
+
+
+def file_etag(name, stat):
+    if name.startswith(CAS_PREFIX):
+        return '"%s"' % os.path.basename(name)
+    return '"%x-%x"' % (stat.st_size, int(stat.st_mtime))
+
+
+def parse_range(header, size):
+    """
+    ``(start, end)`` (inclusive) for a single ``bytes=`` range, ``None`` to
+    send the whole file. Multiple ranges get the whole file too, and so do
+    invalid ones such as ``bytes=5-3`` (RFC 9110 14.2); only a valid range
+    that starts at or past the end is ``416``.
+    """
+    if not header or not header.startswith('bytes=') or ',' in header:
+        return None
+    first, dash, last = header[6:].strip().partition('-')
+    first, last = first.strip(), last.strip()
+    # Digits only: int() would also take signs, spaces and underscores
+    parts = [part for part in (first, last) if part]
+    if not dash or not parts or not all(part.isascii() and part.isdigit() for part in parts):
+        return None
+    if not first:
+        # bytes=-500: the last 500 bytes
+        length = int(last)
+        if length == 0 or size == 0:
+            raise RangeNotSatisfiable()
+        return max(size - length, 0), size - 1
+    start = int(first)
+    end = int(last) if last else size - 1
+    if last and end < start:
+        return None
+    if start >= size:
+        raise RangeNotSatisfiable()
+    return start, min(end, size - 1)
+
+
+def not_modified(request, etag, mtime):
+    """True if the client's cached copy is current (RFC 9110 precedence)."""
+    if_none_match = request.headers.get('If-None-Match')
+    if if_none_match:
+        return etag in parse_etags(if_none_match) or if_none_match.strip() == '*'
+    since = parse_http_date_safe(request.headers.get('If-Modified-Since', ''))
+    return since is not None and int(mtime) <= since
+
+
+def range_applies(request, etag, mtime):
+    """If-Range: only honour Range when the client's validator still matches."""
+    if_range = request.headers.get('If-Range')
+    if not if_range:
+        return True
+    if if_range.startswith('"') or if_range.startswith('W/'):
+        return if_range == etag
+    since = parse_http_date_safe(if_range)
+    return since is not None and int(mtime) <= since
+
+
+def _set_headers(response, headers):
+    for key, value in headers.items():
+        response[key] = value
+
+
+async def _read_file(path, start, length, block_size):
+    # Reads run on the default executor; the event loop only moves bytes
+    loop = asyncio.get_running_loop()
+    f = await loop.run_in_executor(None, open, path, 'rb')
+    try:
+        await loop.run_in_executor(None, f.seek, start)
+        while length > 0:
+            data = await loop.run_in_executor(None, f.read, min(block_size, length))
+            if not data:
+                break
+            length -= len(data)
+            yield data
+    finally:
+        f.close()
+
+
+def media_response(request, field, content_type, file_name=None, max_age=0):
+    """Response for ``field`` (a FieldFile) honouring Range and conditional headers."""
+    path = field.path
+    stat = os.stat(path)
+    size = stat.st_size
+    etag = file_etag(field.name, stat)
+    headers = {
+        'ETag': etag,
+        'Last-Modified': http_date(stat.st_mtime),
+        'Accept-Ranges': 'bytes',
+        'Cache-Control': f'private, max-age={max(int(max_age), 0)}',
+    }
+
+    if not_modified(request, etag, stat.st_mtime):
+        response = HttpResponseNotModified()
+        _set_headers(response, headers)
+        return response
+
+    byte_range = None
+    if request.headers.get('Range') and range_applies(request, etag, stat.st_mtime):
+        try:
+            byte_range = parse_range(request.headers['Range'], size)
+        except RangeNotSatisfiable:
+            response = HttpResponse(status=416)
+            response['Content-Range'] = f'bytes */{size}'
+            _set_headers(response, headers)
+            return response
+
+    sendfile_header = getattr(settings, 'MEDIA_SENDFILE_HEADER', None)
+    if sendfile_header:
+        # The front server sends the file (and the range) itself
+        response = HttpResponse(content_type=content_type)
+        if sendfile_header == 'X-Accel-Redirect':
+            response[sendfile_header] = settings.MEDIA_SENDFILE_PREFIX + field.name
+        else:
+            response[sendfile_header] = path
+    else:
+        start, end = byte_range or (0, size - 1)
+        length = end - start + 1
+        block_size = getattr(settings, 'MEDIA_BLOCK_SIZE', 256 * 1024)
+        # An async iterator: Django buffers sync iterators whole under ASGI
+        response = StreamingHttpResponse(
+            _read_file(path, start, length, block_size),
+            status=206 if byte_range else 200,
+            content_type=content_type,
+        )
+        response['Content-Length'] = str(length)
+        if byte_range:
+            response['Content-Range'] = f'bytes {start}-{end}/{size}'
+
+    if file_name:
+        response['Content-Disposition'] = content_disposition_header(False, file_name)
+    _set_headers(response, headers)
+    return response
@@ -0,0 +1,403 @@
+# accounts/media_gc.py
+"""
+Background garbage collection of media files, with disk quotas.
+
+Deleting a message releases its content-addressed files (see
+``accounts.storage``), but files saved under the old ``chat_media/`` and
+``chat_thumbnails/`` date paths are not reference counted. Crashes,
+``QuerySet.update()`` and the like can also leave a ``MediaBlob`` refcount
+wrong. ``MediaCollector`` works in steps of ``MEDIA_GC_BATCH_SIZE`` rows or
+files, run one at a time on a thread of its own (not the thread shared by
+``database_sync_to_async``) with an ``asyncio.sleep(MEDIA_GC_PAUSE)``
+between them, up to ``MEDIA_GC_MAX_BATCHES`` before a longer break. That
+keeps its disk and database load small next to the foreground requests.
+
+A pass starts by dropping uploads idle for ``MEDIA_UPLOAD_EXPIRE_SECONDS``.
+It then brings the snapshot of referenced media names up to date, reading
+only messages past a keyset cursor per shard. Deleted messages are not
+seen that way, so their names stay in the snapshot (and their files on
+disk) until it is rebuilt from scratch every ``MEDIA_GC_SNAPSHOT_REBUILD``
+passes. ``MediaBlob`` refcounts the snapshot finds too low are counted
+again and raised, never lowered: a save takes its reference before its
+message commits and a delete releases it after, so a lower count may just
+be a save in flight. A blob left counted too high loses its row and file in
+the walk once no message uses it.
+
+The walk goes through ``chat_media/``, ``chat_thumbnails/`` and ``cas/``.
+A file no message refers to is deleted once it is older than
+``MEDIA_GC_GRACE_SECONDS``, so files saved just before their message row
+commits survive.
+
+Each pass ends by applying the quotas. A sender over
+``MEDIA_QUOTA_PER_USER`` bytes of live media, or all media together over
+``MEDIA_QUOTA_TOTAL`` bytes on disk, has its oldest media messages expired
+early. The reaper then deletes them and their files. ``create_upload``
+checks the per-user quota up front, so this only matters when the quota is
+lowered or legacy data is over it.
+"""
+import asyncio
+import heapq
+import logging
+import os
+import time
+import uuid
+from collections import Counter
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Count, Q, Sum
+from django.utils import timezone
+
+from .db_executor import DatabaseExecutor
+from .models import MediaBlob, MediaUpload, Message
+from .sharding import message_databases, message_db_for_id
+from .storage import CAS_PREFIX, blob_name
+from .uploads import discard_upload
+
+logger = logging.getLogger(__name__)
+
+MEDIA_DIRS = ('chat_media', 'chat_thumbnails', CAS_PREFIX.rstrip('/'))
+MEDIA_TYPES = ('image', 'video')
+
+
+def _scan(root, prefix):
+    """(name, DirEntry) for every file under ``root``, one directory at a time."""
+    try:
+        entries = sorted(os.scandir(root), key=lambda entry: entry.name)
+    except FileNotFoundError:
+        return
+    for entry in entries:
+        name = f'{prefix}/{entry.name}'
+        if entry.is_dir(follow_symlinks=False):
+            yield from _scan(entry.path, name)
+        elif entry.is_file(follow_symlinks=False):
+            yield name, entry
+
+
+def _referenced(names):
+    """The subset of ``names`` some message row points at."""
+    referenced = set()
+    for alias in message_databases():
+        rows = Message.objects.using(alias).filter(
+            Q(media_file__in=names) | Q(media_thumbnail__in=names)
+        ).values_list('media_file', 'media_thumbnail')
+        referenced.update(name for row in rows for name in row if name)
+    return referenced
+
+
+def _count_references(name):
+    """Messages pointing at ``name`` right now, over all shards."""
+    total = 0
+    for alias in message_databases():
+        counts = Message.objects.using(alias).filter(
+            Q(media_file=name) | Q(media_thumbnail=name)
+        ).aggregate(
+            files=Count('id', filter=Q(media_file=name)),
+            thumbnails=Count('id', filter=Q(media_thumbnail=name)),
+        )
+        total += counts['files'] + counts['thumbnails']
+    return total
+
+
+def _live_media(alias, now):
+    return Message.objects.using(alias).filter(message_type__in=MEDIA_TYPES, expires_at__gt=now)
+
+
+class MediaCollector:
+    def __init__(self):
+        self.storage = Message._meta.get_field('media_file').storage
+        self.executor = DatabaseExecutor(max_workers=1, name='media-gc')
+        self.referenced = Counter()  # media name -> messages using it, as far as read
+        self.cursors = {}  # alias -> last message id read into ``referenced``
+        self.snapshot_age = 0  # passes since ``referenced`` was rebuilt
+        self._behind = None  # aliases update_snapshot() has yet to catch up on
+        self._walk = None
+        self._pass = None
+        self.passes = 0
+        self.scanned = 0
+        self.removed_files = 0
+        self.removed_bytes = 0
+        self.fixed_blobs = 0
+        self.expired_uploads = 0
+        self.quota_expired = 0
+        self.disk_bytes = None  # as of the last complete pass
+        self.last_pass_at = None
+
+    # ---- pass boundaries ----------------------------------------------
+
+    def start_pass(self, dry_run=False):
+        now = timezone.now()
+        if not dry_run:
+            self.expire_uploads(now)
+        if not self.cursors or self.snapshot_age >= getattr(settings, 'MEDIA_GC_SNAPSHOT_REBUILD', 12):
+            self.referenced, self.cursors, self.snapshot_age = Counter(), {}, 0
+        self._behind = None
+        self._pass = {
+            'started': now,
+            'cutoff': time.time() - getattr(settings, 'MEDIA_GC_GRACE_SECONDS', 3600),
+            'phase': 'snapshot',
+            # Only a fresh snapshot is worth recounting blobs from
+            'reconcile': not self.snapshot_age and not dry_run,
+            'blob_cursor': '',
+            'bytes': 0,
+        }
+
+    def finish_pass(self, dry_run=False):
+        self.disk_bytes = self._pass['bytes']
+        if not dry_run:
+            self.enforce_quotas(self.disk_bytes)
+        self.passes += 1
+        self.snapshot_age += 1
+        self.last_pass_at = self._pass['started'].isoformat()
+        self._walk = self._pass = None
+
+    def update_snapshot(self, batch_size):
+        """Read up to ``batch_size`` media messages past the cursors; False once caught up."""
+        if self._behind is None:
+            self._behind = list(message_databases())
+        while self._behind:
+            alias = self._behind[0]
+            rows = list(
+                Message.objects.using(alias).filter(
+                    message_type__in=MEDIA_TYPES, id__gt=self.cursors.get(alias, 0),
+                ).order_by('id').values_list('id', 'media_file', 'media_thumbnail')[:batch_size]
+            )
+            if len(rows) < batch_size:
+                self._behind.pop(0)
+            if rows:
+                for _, *names in rows:
+                    self.referenced.update(name for name in names if name)
+                self.cursors[alias] = rows[-1][0]
+                return True
+        self._behind = None
+        return False
+
+    def reconcile_blobs(self, referenced, after='', limit=None):
+        """
+        Raise ``MediaBlob`` refcounts below the number of messages using the
+        blob, for up to ``limit`` blobs past ``after`` in hash order. Returns
+        the last hash looked at, or None if there was none.
+        """
+        blobs = MediaBlob.objects.filter(sha256__gt=after).order_by('sha256').values_list('sha256', 'refcount')
+        last = None
+        for sha256, refcount in (blobs[:limit] if limit else blobs).iterator(chunk_size=2000):
+            last = sha256
+            seen = referenced.get(blob_name(sha256), 0)
+            missing = not seen and not self.storage.exists(blob_name(sha256))
+            if seen <= refcount and not missing:
+                continue
+            # The snapshot is older than the refcount we just read: count again
+            actual = _count_references(blob_name(sha256))
+            if actual > refcount:
+                self.fixed_blobs += MediaBlob.objects.filter(
+                    sha256=sha256, refcount__lt=actual
+                ).update(refcount=actual)
+            elif missing and not actual:
+                # File already gone; the walk won't find it to drop the row.
+                # Unless a save has since taken a reference and written it again.
+                self.fixed_blobs += MediaBlob.objects.filter(sha256=sha256, refcount=refcount).delete()[0]
+        # Other blobs nobody refers to go with their files during the walk
+        return last
+
+    def expire_uploads(self, now):
+        stale = now - timedelta(seconds=getattr(settings, 'MEDIA_UPLOAD_EXPIRE_SECONDS', 86400))
+        uploads = MediaUpload.objects.filter(updated_at__lt=stale)
+        for upload_id in uploads.filter(message__isnull=True).values_list('id', flat=True):
+            discard_upload(upload_id)
+        deleted, _ = uploads.delete()
+        self.expired_uploads += deleted
+
+        # Part files whose upload row is gone
+        cutoff = time.time() - getattr(settings, 'MEDIA_GC_GRACE_SECONDS', 3600)
+        try:
+            entries = list(os.scandir(settings.MEDIA_UPLOAD_TEMP_DIR))
+        except FileNotFoundError:
+            return
+        parts = {}
+        for entry in entries:
+            name, ext = os.path.splitext(entry.name)
+            if ext == '.part' and entry.stat().st_mtime < cutoff:
+                try:
+                    parts[uuid.UUID(name)] = entry
+                except ValueError:
+                    continue
+        known = set(MediaUpload.objects.filter(id__in=list(parts)).values_list('id', flat=True))
+        for upload_id in parts.keys() - known:
+            discard_upload(upload_id)
+
+    # ---- the walk -----------------------------------------------------
+
+    def collect_batch(self, batch_size, dry_run=False):
+        """One step over ``batch_size`` messages, blobs or files; False once the pass is complete."""
+        if self._pass is None:
+            self.start_pass(dry_run)
+
+        phase = self._pass['phase']
+        if phase == 'snapshot':
+            if not self.update_snapshot(batch_size):
+                self._pass['phase'] = 'reconcile' if self._pass['reconcile'] else 'walk'
+            return True
+        if phase == 'reconcile':
+            last = self.reconcile_blobs(self.referenced, self._pass['blob_cursor'], batch_size)
+            if last is None:
+                self._pass['phase'] = 'walk'
+            self._pass['blob_cursor'] = last
+            return True
+
+        if self._walk is None:
+            self._walk = (
+                item for directory in MEDIA_DIRS
+                for item in _scan(self.storage.path(directory), directory)
+            )
+        candidates = []
+        done = True
+        for name, entry in self._walk:
+            stat = entry.stat(follow_symlinks=False)
+            self._pass['bytes'] += stat.st_size
+            if name not in self.referenced and stat.st_mtime < self._pass['cutoff']:
+                candidates.append((name, stat.st_size))
+            self.scanned += 1
+            batch_size -= 1
+            if not batch_size:
+                done = False
+                break
+
+        self.remove(candidates, dry_run)
+        if done:
+            self.finish_pass(dry_run)
+        return not done
+
+    def remove(self, candidates, dry_run):
+        if not candidates:
+            return
+        with transaction.atomic():
+            # Referenced since the snapshot: keep
+            live = _referenced([name for name, _ in candidates])
+            orphans = [(name, size) for name, size in candidates if name not in live]
+            blobs = [os.path.basename(name) for name, _ in orphans if name.startswith(CAS_PREFIX)]
+            if dry_run:
+                transaction.set_rollback(True)
+            elif blobs:
+                MediaBlob.objects.filter(sha256__in=blobs).delete()
+                # Under the write lock, as in storage.release: a save of the same content waits
+                for name, _ in orphans:
+                    if name.startswith(CAS_PREFIX):
+                        self.storage.delete(name)
+
+        for name, size in orphans:
+            if not dry_run and not name.startswith(CAS_PREFIX):
+                self.storage.delete(name)
+            self._pass['bytes'] -= size
+            self.removed_files += 1
+            self.removed_bytes += size
+        if orphans:
+            logger.info(f"🧹 {'Would remove' if dry_run else 'Removed'} {len(orphans)} orphaned media files")
+
+    # ---- quotas -------------------------------------------------------
+
+    def enforce_quotas(self, disk_bytes):
+        now = timezone.now()
+
+        per_user = getattr(settings, 'MEDIA_QUOTA_PER_USER', None)
+        if per_user:
+            totals = Counter()
+            for alias in message_databases():
+                for row in _live_media(alias, now).values('sender_id').annotate(total=Sum('file_size')):
+                    totals[row['sender_id']] += row['total'] or 0
+            for sender_id, total in totals.items():
+                if total > per_user:
+                    self.expire_oldest(total - per_user, now, sender_id=sender_id)
+
+        total = getattr(settings, 'MEDIA_QUOTA_TOTAL', None)
+        if total and disk_bytes > total:
+            self.expire_oldest(disk_bytes - total, now)
+
+    def expire_oldest(self, excess, now, **filters):
+        """Expire the oldest live media messages until about ``excess`` bytes are freed."""
+        # Oldest first across all shards (ids are only ordered within one)
+        oldest = heapq.merge(*(
+            _live_media(alias, now).filter(**filters).order_by('created_at')
+            .values_list('created_at', 'id', 'file_size').iterator(chunk_size=500)
+            for alias in message_databases()
+        ))
+        ids = []
+        for _, message_id, file_size in oldest:
+            if excess <= 0:
+                break
+            ids.append(message_id)
+            excess -= file_size or 0
+
+        shards = {}
+        for message_id in ids:
+            shards.setdefault(message_db_for_id(message_id), []).append(message_id)
+        for alias, shard_ids in shards.items():
+            for start in range(0, len(shard_ids), 500):
+                # The reaper deletes them (and releases their files) on its next run
+                self.quota_expired += Message.objects.using(alias).filter(
+                    id__in=shard_ids[start:start + 500]
+                ).update(expires_at=now)
+        if ids:
+            logger.warning(f"⚠️ Media quota: expired {len(ids)} messages early")
+
+    # ---- driving ------------------------------------------------------
+
+    def collect(self, batch_size=None, max_batches=None, pause=None, dry_run=False):
+        """
+        Up to ``max_batches`` batches (``None`` = until the pass completes).
+        Returns True if the pass is still in progress.
+        """
+        batch_size = batch_size or getattr(settings, 'MEDIA_GC_BATCH_SIZE', 500)
+        pause = getattr(settings, 'MEDIA_GC_PAUSE', 0.05) if pause is None else pause
+        batches = 0
+        while max_batches is None or batches < max_batches:
+            if not self.collect_batch(batch_size, dry_run):
+                return False
+            batches += 1
+            if pause:
+                time.sleep(pause)
+        return True
+
+    async def run(self):
+        """In-process loop started by accounts.background; one step per call on the GC's thread."""
+        interval = getattr(settings, 'MEDIA_GC_INTERVAL', 300)
+        batch_size = getattr(settings, 'MEDIA_GC_BATCH_SIZE', 500)
+        max_batches = getattr(settings, 'MEDIA_GC_MAX_BATCHES', 20)
+        pause = getattr(settings, 'MEDIA_GC_PAUSE', 0.05)
+        step = self.executor(self.collect_batch)
+        batches = 0
+        while True:
+            try:
+                in_progress = await step(batch_size)
+            except Exception as e:
+                logger.error(f"❌ Media GC error: {str(e)}", exc_info=True)
+                self._walk = self._pass = None
+                in_progress = False
+            batches += 1
+            if not in_progress:
+                batches = 0
+                await asyncio.sleep(interval)
+            elif batches >= max_batches:
+                # Keep walking soon while a pass is under way
+                batches = 0
+                await asyncio.sleep(1)
+            else:
+                await asyncio.sleep(pause)
+
+    def stats(self):
+        return {
+            'passes': self.passes,
+            'in_progress': self._pass is not None,
+            'snapshot_names': len(self.referenced),
+            'scanned': self.scanned,
+            'removed_files': self.removed_files,
+            'removed_bytes': self.removed_bytes,
+            'fixed_blobs': self.fixed_blobs,
+            'expired_uploads': self.expired_uploads,
+            'quota_expired': self.quota_expired,
+            'disk_bytes': self.disk_bytes,
+            'last_pass_at': self.last_pass_at,
+        }
+
+
+media_collector = MediaCollector()
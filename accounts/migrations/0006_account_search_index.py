@@ -0,0 +1,38 @@
+from django.db import migrations
+
+SEARCH_TABLE = 'accounts_account_search'
+
+
+def create_search_index(apps, schema_editor):
+    connection = schema_editor.connection
+    if connection.vendor != 'sqlite':
+        return
+    with connection.cursor() as cursor:
+        cursor.execute(
+            f"CREATE VIRTUAL TABLE IF NOT EXISTS {SEARCH_TABLE} "
+            f"USING fts5(username, first_name, last_name, tokenize='trigram')"
+        )
+        cursor.execute(
+            f"INSERT INTO {SEARCH_TABLE} (rowid, username, first_name, last_name) "
+            f"SELECT id, COALESCE(username, ''), first_name, COALESCE(last_name, '') "
+            f"FROM accounts_account"
+        )
+
+
+def drop_search_index(apps, schema_editor):
+    connection = schema_editor.connection
+    if connection.vendor != 'sqlite':
+        return
+    with connection.cursor() as cursor:
+        cursor.execute(f"DROP TABLE IF EXISTS {SEARCH_TABLE}")
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('accounts', '0005_message_expires_at_index'),
+    ]
+
+    operations = [
+        migrations.RunPython(create_search_index, drop_search_index),
+    ]
@@ -0,0 +1,33 @@
+# Generated by Django 5.2.18 on 2026-10-17 00:42
+
+import accounts.storage
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('accounts', '0009_thumbnailjob'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='MediaBlob',
+            fields=[
+                ('sha256', models.CharField(max_length=64, primary_key=True, serialize=False)),
+                ('size', models.BigIntegerField()),
+                ('refcount', models.PositiveIntegerField(default=0)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+            ],
+        ),
+        migrations.AlterField(
+            model_name='message',
+            name='media_file',
+            field=models.FileField(blank=True, null=True, storage=accounts.storage.get_media_storage, upload_to='chat_media/%Y/%m/%d/'),
+        ),
+        migrations.AlterField(
+            model_name='message',
+            name='media_thumbnail',
+            field=models.ImageField(blank=True, null=True, storage=accounts.storage.get_media_storage, upload_to='chat_thumbnails/%Y/%m/%d/'),
+        ),
+    ]
@@ -0,0 +1,54 @@
+# Generated by Django 5.2.18 on 2026-10-17 01:10
+
+from django.db import migrations, models
+from django.db.models import F
+
+from accounts.sharding import conversation_key_sql, number_shard_messages
+
+BACKFILL_CHUNK = 10000
+
+
+def backfill_conversation_key(apps, schema_editor):
+    """Fill the key in chunks of ids, one short write transaction per chunk."""
+    Message = apps.get_model('accounts', 'Message')
+    messages = Message.objects.using(schema_editor.connection.alias)
+    last_id = 0
+    while True:
+        ids = list(
+            messages.filter(id__gt=last_id).order_by('id').values_list('id', flat=True)[:BACKFILL_CHUNK]
+        )
+        if not ids:
+            break
+        messages.filter(id__gte=ids[0], id__lte=ids[-1]).update(
+            conversation_key=conversation_key_sql(F('sender_id'), F('receiver_id'))
+        )
+        last_id = ids[-1]
+
+
+class Migration(migrations.Migration):
+    # Each backfill chunk commits on its own instead of one long write lock
+    atomic = False
+
+    dependencies = [
+        ('accounts', '0011_message_shards'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='message',
+            name='conversation_key',
+            field=models.CharField(default='', editable=False, max_length=41),
+            preserve_default=False,
+        ),
+        # Adding the column rebuilt the table
+        migrations.RunPython(
+            number_shard_messages, migrations.RunPython.noop, hints={'model_name': 'message'},
+        ),
+        migrations.RunPython(
+            backfill_conversation_key, migrations.RunPython.noop, hints={'model_name': 'message'},
+        ),
+        migrations.AddIndex(
+            model_name='message',
+            index=models.Index(fields=['conversation_key', 'id'], name='message_conversation_key_idx'),
+        ),
+    ]
@@ -0,0 +1,17 @@
+# Generated by Django 5.2.18 on 2026-10-17 01:02
+
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('accounts', '0012_message_conversation_key'),
+    ]
+
+    operations = [
+        migrations.AlterModelOptions(
+            name='account',
+            options={},
+        ),
+    ]
@@ -0,0 +1,26 @@
+# Generated by Django 5.2.18 on 2026-10-17 01:36
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('accounts', '0014_account_updated_at_index'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='PresenceConnection',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('process', models.CharField(max_length=100)),
+                ('telegram_id', models.BigIntegerField(db_index=True)),
+                ('count', models.PositiveIntegerField()),
+                ('heartbeat', models.DateTimeField(db_index=True)),
+            ],
+            options={
+                'unique_together': {('process', 'telegram_id')},
+            },
+        ),
+    ]
@@ -1,7 +1,12 @@
+import uuid
+
 from django.db import models
 from django.contrib.auth.models import AbstractBaseUser, BaseUserManager
 from django.utils import timezone
 
+from .sharding import conversation_key
+from .storage import get_media_storage
+
 class AccountManager(BaseUserManager):
     def create_user(self, telegram_id, first_name, password=None):
         user = self.model(
@@ -30,7 +35,8 @@ class Account(AbstractBaseUser):
     is_online = models.BooleanField(default=False)
     is_banned = models.BooleanField(default=False)
     created_at = models.DateTimeField(auto_now_add=True)
-    updated_at = models.DateTimeField(auto_now=True)
+    # Indexed for the autocomplete refresh (see autocomplete.py)
+    updated_at = models.DateTimeField(auto_now=True, db_index=True)
     last_seen = models.DateTimeField(auto_now=True)
     is_active = models.BooleanField(default=True)
     is_admin = models.BooleanField(default=False)
@@ -49,9 +55,6 @@ class Account(AbstractBaseUser):
     def has_perm(self, perm, obj=None):
         return True
 
-    class Meta:
-        ordering = ['-created_at']
-
 
 class Contact(models.Model):
     user = models.ForeignKey(Account, on_delete=models.CASCADE, related_name='contacts_sent')
@@ -75,14 +78,18 @@ class Message(models.Model):
         ('video', 'Video'),
     )
     
-    sender = models.ForeignKey(Account, on_delete=models.CASCADE, related_name='sent_messages')
-    receiver = models.ForeignKey(Account, on_delete=models.CASCADE, related_name='received_messages')
+    # Messages may live on another database than accounts (see sharding.py);
+    # deleting an account deletes its messages through a pre_delete signal
+    sender = models.ForeignKey(Account, on_delete=models.DO_NOTHING, db_constraint=False, related_name='sent_messages')
+    receiver = models.ForeignKey(Account, on_delete=models.DO_NOTHING, db_constraint=False, related_name='received_messages')
+    # "min:max" of sender and receiver ids, the same for both directions
+    conversation_key = models.CharField(max_length=41, editable=False)
     message_type = models.CharField(max_length=10, choices=MESSAGE_TYPES, default='text')
     text = models.TextField(blank=True, null=True)
     
     # Media fields
-    media_file = models.FileField(upload_to='chat_media/%Y/%m/%d/', blank=True, null=True)
-    media_thumbnail = models.ImageField(upload_to='chat_thumbnails/%Y/%m/%d/', blank=True, null=True)
+    media_file = models.FileField(upload_to='chat_media/%Y/%m/%d/', storage=get_media_storage, blank=True, null=True)
+    media_thumbnail = models.ImageField(upload_to='chat_thumbnails/%Y/%m/%d/', storage=get_media_storage, blank=True, null=True)
     file_name = models.CharField(max_length=255, blank=True, null=True)
     file_size = models.BigIntegerField(blank=True, null=True)
     
@@ -90,10 +97,107 @@ class Message(models.Model):
     is_deleted_by_sender = models.BooleanField(default=False)
     is_deleted_by_receiver = models.BooleanField(default=False)
     created_at = models.DateTimeField(auto_now_add=True)
-    expires_at = models.DateTimeField()
+    expires_at = models.DateTimeField(db_index=True)
 
     class Meta:
         ordering = ['created_at']
+        indexes = [
+            # Keyset pagination of one conversation (see history.py)
+            models.Index(fields=['conversation_key', 'id'], name='message_conversation_key_idx'),
+            # One direction of a conversation (read receipts, per-sender totals)
+            models.Index(fields=['sender', 'receiver', 'id'], name='message_conversation_idx'),
+            # Unread counts per conversation (see conversations.py); only unread rows are indexed
+            models.Index(
+                fields=['receiver', 'sender'],
+                condition=models.Q(is_read=False),
+                name='message_unread_idx',
+            ),
+        ]
+
+    def save(self, *args, **kwargs):
+        # bulk_create() skips this: the batcher fills the key itself. Partial saves
+        # of other columns leave it alone, sender/receiver may be deferred there
+        update_fields = kwargs.get('update_fields')
+        if update_fields is None or 'conversation_key' in update_fields:
+            self.conversation_key = conversation_key(self.sender_id, self.receiver_id)
+        super().save(*args, **kwargs)
+
+    def __str__(self):
+        return f"{self.sender.username} -> {self.receiver.username}: {self.message_type}"
+
+
+class MediaBlob(models.Model):
+    """Reference count of one stored media file (see storage.py)"""
+    sha256 = models.CharField(max_length=64, primary_key=True)
+    size = models.BigIntegerField()
+    refcount = models.PositiveIntegerField(default=0)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    def __str__(self):
+        return f"{self.sha256} x{self.refcount}"
+
+
+class PresenceConnection(models.Model):
+    """Open WebSockets of one user in one process (see presence.py)"""
+    process = models.CharField(max_length=100)
+    telegram_id = models.BigIntegerField(db_index=True)
+    count = models.PositiveIntegerField()
+    heartbeat = models.DateTimeField(db_index=True)
+
+    class Meta:
+        unique_together = ('process', 'telegram_id')
+
+    def __str__(self):
+        return f"{self.telegram_id} x{self.count} on {self.process}"
+
+
+class MediaUpload(models.Model):
+    """A resumable upload in progress; becomes a media Message once complete"""
+    id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
+    uploader = models.ForeignKey(Account, on_delete=models.CASCADE, related_name='media_uploads')
+    receiver = models.ForeignKey(Account, on_delete=models.CASCADE, related_name='+')
+    message_type = models.CharField(max_length=10, choices=Message.MESSAGE_TYPES)
+    file_name = models.CharField(max_length=255)
+    file_size = models.BigIntegerField()
+    received = models.BigIntegerField(default=0)
+    expire_seconds = models.PositiveIntegerField()
+    sha256 = models.CharField(max_length=64, blank=True, null=True)
+    # Messages may be on a shard; a completed upload outlives its message until media GC drops it
+    message = models.OneToOneField(Message, on_delete=models.DO_NOTHING, db_constraint=False, blank=True, null=True, related_name='upload')
+    created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    def __str__(self):
+        return f"{self.file_name} ({self.received}/{self.file_size})"
+
+
+class ThumbnailJob(models.Model):
+    """Persistent queue of thumbnails to render (see thumbnails.py)"""
+    PENDING = 'pending'
+    RUNNING = 'running'
+    DONE = 'done'
+    FAILED = 'failed'
+    STATUSES = (
+        (PENDING, 'Pending'),
+        (RUNNING, 'Running'),
+        (DONE, 'Done'),
+        (FAILED, 'Failed'),
+    )
+
+    message = models.OneToOneField(Message, on_delete=models.CASCADE, related_name='thumbnail_job')
+    status = models.CharField(max_length=10, choices=STATUSES, default=PENDING)
+    attempts = models.PositiveSmallIntegerField(default=0)
+    claimed_by = models.CharField(max_length=100, blank=True, null=True)
+    error = models.TextField(blank=True, null=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+    started_at = models.DateTimeField(blank=True, null=True)
+    finished_at = models.DateTimeField(blank=True, null=True)
+
+    class Meta:
+        indexes = [
+            # Workers claim the oldest pending jobs
+            models.Index(fields=['status', 'id'], name='thumbnailjob_queue_idx'),
+        ]
 
     def __str__(self):
-        return f"{self.sender.username} -> {self.receiver.username}: {self.message_type}"
\ No newline at end of file
+        return f"Thumbnail for message {self.message_id}: {self.status}"
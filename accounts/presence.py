@@ -0,0 +1,213 @@
+# accounts/presence.py
+"""
+In-memory presence tracking for WebSocket connections.
+
+Every open socket increments a per-user counter, so a user with several tabs
+stays online until the last one closes. Changed counters are collected and
+written back every ``PRESENCE_FLUSH_INTERVAL`` seconds to
+``PresenceConnection``, one row per process and user, so a user is online
+while any daphne worker holds one of their sockets. The same transaction sums
+the rows of live processes and compares them with ``Account.is_online``; only
+users whose state actually changed are written and announced to their
+accepted contacts, which also hides quick reconnects such as a page reload.
+
+Processes refresh the ``heartbeat`` of their rows every
+``PRESENCE_HEARTBEAT_INTERVAL`` seconds. Rows older than
+``PRESENCE_STALE_AFTER`` belong to a worker that died with sockets open; they
+are deleted by the next heartbeat of any worker and their users rechecked.
+"""
+import asyncio
+import logging
+import os
+import socket
+import time
+import uuid
+from datetime import timedelta
+
+from channels.layers import get_channel_layer
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Case, DateTimeField, Value, When
+from django.utils import timezone
+
+from .contact_cache import contact_cache
+from .db_executor import db_writer
+from .models import Account, Contact, PresenceConnection
+
+logger = logging.getLogger(__name__)
+
+
+class PresenceRegistry:
+    def __init__(self, flush_interval=None):
+        self.flush_interval = flush_interval or getattr(settings, 'PRESENCE_FLUSH_INTERVAL', 1.0)
+        self.heartbeat_interval = getattr(settings, 'PRESENCE_HEARTBEAT_INTERVAL', 15)
+        self.stale_after = getattr(settings, 'PRESENCE_STALE_AFTER', 60)
+        # One registry per event loop, so the pid alone is not unique
+        self.process = f'{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}'
+        self.connections = {}  # telegram_id -> open sockets in this process
+        self.pending = {}  # telegram_id -> timestamp of the latest change
+        self.last_heartbeat = time.monotonic()
+        self.task = None
+
+    def connect(self, telegram_id):
+        telegram_id = str(telegram_id)
+        self.connections[telegram_id] = self.connections.get(telegram_id, 0) + 1
+        if self.connections[telegram_id] == 1:
+            self.mark_changed(telegram_id)
+
+    def disconnect(self, telegram_id):
+        telegram_id = str(telegram_id)
+        count = self.connections.get(telegram_id, 0) - 1
+        if count > 0:
+            self.connections[telegram_id] = count
+            return
+        self.connections.pop(telegram_id, None)
+        self.mark_changed(telegram_id)
+
+    def is_connected(self, telegram_id):
+        """Whether this process holds a socket of the user; see ``Account.is_online``"""
+        return str(telegram_id) in self.connections
+
+    def mark_changed(self, telegram_id):
+        self.pending[telegram_id] = timezone.now()
+        if self.task is None or self.task.done():
+            self.task = asyncio.get_running_loop().create_task(self.run())
+
+    async def run(self):
+        # Connections keep the loop alive for the heartbeat
+        while self.pending or self.connections:
+            await asyncio.sleep(self.flush_interval)
+            try:
+                if time.monotonic() - self.last_heartbeat >= self.heartbeat_interval:
+                    await self.heartbeat()
+                await self.flush()
+            except Exception as e:
+                logger.error(f"❌ Presence flush failed: {str(e)}", exc_info=True)
+
+    async def heartbeat(self):
+        stale = await self.touch()
+        self.last_heartbeat = time.monotonic()
+        for telegram_id, last_seen in stale:
+            # Offline from when the dead worker was last heard of, if nobody else has them
+            self.pending.setdefault(str(telegram_id), last_seen)
+
+    @db_writer
+    def touch(self):
+        now = timezone.now()
+        PresenceConnection.objects.filter(process=self.process).update(heartbeat=now)
+        stale = list(PresenceConnection.objects.filter(
+            heartbeat__lt=now - timedelta(seconds=self.stale_after)
+        ).values_list('id', 'telegram_id', 'heartbeat'))
+        if stale:
+            PresenceConnection.objects.filter(id__in=[row[0] for row in stale]).delete()
+            logger.info(f"👤 Presence: dropped {len(stale)} connections of dead workers")
+        return [row[1:] for row in stale]
+
+    async def flush(self):
+        pending, self.pending = self.pending, {}
+        if not pending:
+            return
+
+        counts = {telegram_id: self.connections.get(telegram_id, 0) for telegram_id in pending}
+        try:
+            went_online, went_offline, watchers = await self.save(counts, pending)
+        except Exception:
+            # Written by the next flush, unless something newer has replaced them
+            for telegram_id, changed_at in pending.items():
+                self.pending.setdefault(telegram_id, changed_at)
+            raise
+        if not went_online and not went_offline:
+            return
+
+        for telegram_id in went_online:
+            contact_cache.set_presence(telegram_id, True)
+        for telegram_id, last_seen in went_offline.items():
+            contact_cache.set_presence(telegram_id, False, last_seen)
+
+        channel_layer = get_channel_layer()
+        for account_id, telegram_id, watcher_telegram_id in watchers:
+            last_seen = went_offline.get(str(telegram_id))
+            await channel_layer.group_send(
+                f'chat_{watcher_telegram_id}',
+                {
+                    'type': 'presence_update',
+                    'user_id': account_id,
+                    'telegram_id': str(telegram_id),
+                    'is_online': last_seen is None,
+                    'last_seen': last_seen.isoformat() if last_seen else None,
+                }
+            )
+        logger.info(f"👤 Presence flushed: +{len(went_online)} online, -{len(went_offline)} offline")
+
+    @db_writer
+    def save(self, counts, changed_at):
+        """Write this process's counts; return who went online/offline and their watchers."""
+        now = timezone.now()
+        with transaction.atomic():
+            PresenceConnection.objects.filter(
+                process=self.process,
+                telegram_id__in=[telegram_id for telegram_id, count in counts.items() if not count],
+            ).delete()
+            PresenceConnection.objects.bulk_create(
+                [
+                    PresenceConnection(process=self.process, telegram_id=telegram_id, count=count, heartbeat=now)
+                    for telegram_id, count in counts.items() if count
+                ],
+                update_conflicts=True,
+                unique_fields=['process', 'telegram_id'],
+                update_fields=['count', 'heartbeat'],
+            )
+
+            # Sockets in any live process, against what was last written
+            connected = {str(telegram_id) for telegram_id in PresenceConnection.objects.filter(
+                telegram_id__in=list(counts),
+                heartbeat__gte=now - timedelta(seconds=self.stale_after),
+            ).values_list('telegram_id', flat=True)}
+            written = {str(telegram_id): is_online for telegram_id, is_online in Account.objects.filter(
+                telegram_id__in=list(counts)
+            ).values_list('telegram_id', 'is_online')}
+            went_online = [
+                telegram_id for telegram_id in counts
+                if telegram_id in connected and written.get(telegram_id) is False
+            ]
+            went_offline = {
+                telegram_id: changed_at[telegram_id] for telegram_id in counts
+                if telegram_id not in connected and written.get(telegram_id)
+            }
+            if not went_online and not went_offline:
+                return went_online, went_offline, []
+
+            return went_online, went_offline, self.save_accounts(went_online, went_offline)
+
+    def save_accounts(self, went_online, went_offline):
+        # QuerySet.update() only touches these columns and skips auto_now
+        if went_online:
+            Account.objects.filter(telegram_id__in=went_online).update(is_online=True)
+        if went_offline:
+            Account.objects.filter(telegram_id__in=list(went_offline)).update(
+                is_online=False,
+                last_seen=Case(
+                    *[When(telegram_id=tid, then=Value(ts)) for tid, ts in went_offline.items()],
+                    output_field=DateTimeField(),
+                ),
+            )
+
+        # Users that have the changed users as an accepted contact
+        return list(Contact.objects.filter(
+            contact__telegram_id__in=[*went_online, *went_offline],
+            is_accepted=True,
+        ).values_list('contact_id', 'contact__telegram_id', 'user__telegram_id'))
+
+
+_registries = {}
+
+
+def get_presence_registry():
+    """Return the presence registry bound to the running event loop."""
+    loop = asyncio.get_running_loop()
+    registry = _registries.get(loop)
+    if registry is None:
+        for old_loop in [l for l in _registries if l.is_closed()]:
+            del _registries[old_loop]
+        registry = _registries[loop] = PresenceRegistry()
+    return registry
@@ -0,0 +1,159 @@
+# accounts/querycount.py
+"""
+Query counts and database time per HTTP request and per WebSocket frame,
+with an N+1 detector.
+
+``count_queries`` is installed as an execute wrapper on every database
+connection (see signals.py). It adds each statement to the ``QueryStats``
+objects that are active in the current context. ``track_queries()`` makes
+one active. Context variables follow the work into ``sync_to_async`` and
+``consumer_db`` threads, and each call queued for the single writer thread
+runs in its caller's context. Only the writer's shared ``BEGIN`` and
+``COMMIT`` are not attributed to anyone.
+
+``QueryCountMiddleware`` tracks every request and ``ChatConsumer.receive``
+tracks every frame. A unit that runs the same statement
+``QUERY_REPEAT_THRESHOLD`` times or more is logged as a likely N+1. One
+with more than ``QUERY_COUNT_WARN`` queries is logged as well. Both show
+up in /api/metrics/. The same statement means the same SQL with
+``IN (...)`` lists collapsed; values are parameters and don't count. In
+DEBUG, responses get a ``Server-Timing: db`` header.
+"""
+import contextvars
+import logging
+import re
+import threading
+import time
+from collections import Counter
+from contextlib import contextmanager
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+from django.conf import settings
+
+logger = logging.getLogger(__name__)
+
+_active = contextvars.ContextVar('query_stats', default=())
+_IN_LIST = re.compile(r'IN \((?:%s, )*%s\)')
+
+
+class QueryStats:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.count = 0
+        self.seconds = 0.0
+        self.statements = Counter()
+
+    def add(self, sql, seconds):
+        with self.lock:
+            self.count += 1
+            self.seconds += seconds
+            self.statements[_IN_LIST.sub('IN (...)', sql)] += 1
+
+    def repeated(self, threshold):
+        """Statements run at least ``threshold`` times, most frequent first."""
+        return [(sql, n) for sql, n in self.statements.most_common() if n >= threshold]
+
+
+def count_queries(execute, sql, params, many, context):
+    active = _active.get()
+    if not active:
+        return execute(sql, params, many, context)
+    started = time.perf_counter()
+    try:
+        return execute(sql, params, many, context)
+    finally:
+        elapsed = time.perf_counter() - started
+        for stats in active:
+            stats.add(sql, elapsed)
+
+
+@contextmanager
+def track_queries():
+    """Count the queries run inside the block (nested blocks count in all)."""
+    stats = QueryStats()
+    token = _active.set(_active.get() + (stats,))
+    try:
+        yield stats
+    finally:
+        _active.reset(token)
+
+
+class QueryReport:
+    """Totals over all tracked units, for /api/metrics/."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.units = 0
+        self.queries = 0
+        self.seconds = 0.0
+        self.max_queries = 0
+        self.over_budget = Counter()
+        self.n_plus_one = Counter()
+
+    def report(self, label, stats):
+        warn = getattr(settings, 'QUERY_COUNT_WARN', 30)
+        repeated = stats.repeated(getattr(settings, 'QUERY_REPEAT_THRESHOLD', 5))
+        with self.lock:
+            self.units += 1
+            self.queries += stats.count
+            self.seconds += stats.seconds
+            self.max_queries = max(self.max_queries, stats.count)
+            if stats.count > warn:
+                self.over_budget[label] += 1
+            if repeated:
+                self.n_plus_one[label] += 1
+
+        if stats.count > warn:
+            logger.warning(f"⚠️ {label}: {stats.count} queries, {stats.seconds * 1000:.1f}ms in the database")
+        for sql, n in repeated:
+            logger.warning(f"🔁 Possible N+1 in {label}: {n}x {sql}")
+
+    def stats(self):
+        with self.lock:
+            units = self.units or 1
+            return {
+                'units': self.units,
+                'avg_queries': round(self.queries / units, 2),
+                'max_queries': self.max_queries,
+                'avg_db_ms': round(self.seconds / units * 1000, 3),
+                'over_budget': dict(self.over_budget.most_common(10)),
+                'n_plus_one': dict(self.n_plus_one.most_common(10)),
+            }
+
+
+query_report = QueryReport()
+
+
+def request_label(request):
+    match = getattr(request, 'resolver_match', None)
+    return f'{request.method} {match.view_name if match else request.path}'
+
+
+class QueryCountMiddleware:
+    """Counts the queries of each request (streamed response bodies excluded)."""
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        self.is_async = iscoroutinefunction(get_response)
+        if self.is_async:
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if self.is_async:
+            return self.__acall__(request)
+        with track_queries() as stats:
+            response = self.get_response(request)
+        return self.finish(request, response, stats)
+
+    async def __acall__(self, request):
+        with track_queries() as stats:
+            response = await self.get_response(request)
+        return self.finish(request, response, stats)
+
+    def finish(self, request, response, stats):
+        query_report.report(request_label(request), stats)
+        if settings.DEBUG:
+            response['Server-Timing'] = f'db;dur={stats.seconds * 1000:.1f};desc="{stats.count} queries"'
+        return response
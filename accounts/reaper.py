@@ -0,0 +1,109 @@
+# accounts/reaper.py
+"""
+Background deletion of expired messages.
+
+Rows are removed in primary-key batches picked in ``expires_at`` order from
+the ``expires_at`` index, so each statement holds the write lock only
+briefly and reads never have to clean up after themselves. Run it with
+``manage.py reap_messages`` or let the ASGI process do it on a timer
+(``MESSAGE_REAPER_ENABLED``); the loop runs on its own thread so long
+deletes never hold up ``consumer_db`` or the thread behind
+``database_sync_to_async``.
+"""
+import asyncio
+import logging
+import time
+
+from django.conf import settings
+from django.utils import timezone
+
+from .db_executor import DatabaseExecutor
+from .models import Message
+from .sharding import message_databases
+
+logger = logging.getLogger(__name__)
+
+reaper_executor = DatabaseExecutor(max_workers=1, name='message-reaper')
+
+# Last run of the reaper in this process, served by /api/metrics/
+reaper_stats = {
+    'runs': 0,
+    'total_rows': 0,
+    'last_rows': 0,
+    'last_rows_per_sec': None,
+    'last_backlog': None,
+    'last_run_at': None,
+}
+
+
+def expired_backlog(now=None):
+    """Number of expired rows still waiting to be deleted."""
+    now = now or timezone.now()
+    return sum(
+        Message.objects.using(alias).filter(expires_at__lt=now).count()
+        for alias in message_databases()
+    )
+
+
+def reap_expired(batch_size=None, max_batches=None, pause=0):
+    """
+    Delete expired messages in batches of ``batch_size``, at most
+    ``max_batches`` of them per shard (``None`` = until nothing is left).
+    Returns the run statistics.
+    """
+    batch_size = batch_size or getattr(settings, 'MESSAGE_REAPER_BATCH_SIZE', 1000)
+    now = timezone.now()
+    started = time.perf_counter()
+    rows = batches = 0
+
+    for alias in message_databases():
+        messages = Message.objects.using(alias)
+        # Each shard gets the whole budget, a backlog on one doesn't starve the rest
+        shard_batches = 0
+        while max_batches is None or shard_batches < max_batches:
+            ids = list(
+                messages.filter(expires_at__lt=now)
+                .order_by('expires_at')
+                .values_list('id', flat=True)[:batch_size]
+            )
+            if not ids:
+                break
+            # The total also counts cascaded rows (thumbnail jobs)
+            _, deleted = messages.filter(id__in=ids).delete()
+            rows += deleted.get(Message._meta.label, 0)
+            shard_batches += 1
+            batches += 1
+            if len(ids) < batch_size:
+                break
+            if pause:
+                time.sleep(pause)
+
+    elapsed = time.perf_counter() - started
+    backlog = expired_backlog(now)
+    reaper_stats.update({
+        'runs': reaper_stats['runs'] + 1,
+        'total_rows': reaper_stats['total_rows'] + rows,
+        'last_rows': rows,
+        'last_rows_per_sec': round(rows / elapsed, 1) if elapsed > 0 else None,
+        'last_backlog': backlog,
+        'last_run_at': now.isoformat(),
+    })
+    if rows:
+        logger.info(
+            f"🗑️ Reaped {rows} expired messages in {batches} batches "
+            f"({reaper_stats['last_rows_per_sec']} rows/s, backlog {backlog})"
+        )
+    return dict(reaper_stats, batches=batches, elapsed=elapsed)
+
+
+async def run_reaper():
+    """In-process loop started by accounts.background."""
+    interval = getattr(settings, 'MESSAGE_REAPER_INTERVAL', 30)
+    max_batches = getattr(settings, 'MESSAGE_REAPER_MAX_BATCHES', 50)
+    reap = reaper_executor(reap_expired)
+    while True:
+        try:
+            await reap(max_batches=max_batches)
+        except Exception as e:
+            logger.error(f"❌ Reaper error: {str(e)}", exc_info=True)
+        await asyncio.sleep(interval)
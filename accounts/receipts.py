@@ -0,0 +1,160 @@
+# accounts/receipts.py
+"""
+Bulk read receipts.
+
+Clients report a high-water mark per conversation rather than single ids:
+"everything the contact sent me up to message N is read". One ``UPDATE``
+(through the partial ``message_unread_idx``) covers the whole range, and the
+contact gets a single ``read_up_to`` event. Ids of in-memory messages
+(``e<n>``) come from their own counter, so they carry a separate
+``ephemeral_up_to`` mark.
+
+Over WebSocket, marks are collected per event loop by ``ReadReceipts`` and
+written every ``READ_RECEIPT_FLUSH_INTERVAL`` seconds, so a client scrolling
+through a chat and sending a mark per screen still costs one ``UPDATE`` and
+one event per conversation and interval.
+"""
+import asyncio
+import logging
+
+from channels.layers import get_channel_layer
+from django.conf import settings
+
+from .db_executor import db_writer
+from .ephemeral import ephemeral_store
+from .identity import identity_cache
+from .models import Message
+from .sharding import group_by_shard
+
+logger = logging.getLogger(__name__)
+
+
+def parse_read_mark(up_to=None, ephemeral_up_to=None):
+    """Validate client marks; returns ``(up_to, ephemeral_up_to)`` or raises ValueError."""
+    if up_to is not None:
+        up_to = int(up_to)
+    if ephemeral_up_to is not None:
+        ephemeral_up_to = str(ephemeral_up_to)
+        if not ephemeral_up_to.startswith('e'):
+            raise ValueError(f"Invalid ephemeral message id: {ephemeral_up_to}")
+        ephemeral_up_to = int(ephemeral_up_to[1:])
+    if up_to is None and ephemeral_up_to is None:
+        raise ValueError("up_to or ephemeral_up_to is required")
+    return up_to, ephemeral_up_to
+
+
+def _max(a, b):
+    return b if a is None else a if b is None else max(a, b)
+
+
+def _save_shard_marks(alias, marks):
+    updated = {}
+    for (reader_id, contact_id), (up_to, _) in marks:
+        updated[reader_id, contact_id] = Message.objects.using(alias).filter(
+            sender_id=contact_id,
+            receiver_id=reader_id,
+            is_read=False,
+            id__lte=up_to,
+        ).update(is_read=True)
+    return updated
+
+
+async def save_read_marks(marks):
+    """One bulk UPDATE per conversation; returns ``{(reader_id, contact_id): rows}``."""
+    shards = group_by_shard(
+        [(pair, mark) for pair, mark in marks.items() if mark[0] is not None],
+        lambda item: item[0],
+    )
+    updated = {}
+    # Each shard's updates commit together on that shard's writer
+    for result in await asyncio.gather(*(
+        db_writer.using(alias)(_save_shard_marks)(alias, shard_marks)
+        for alias, shard_marks in shards.items()
+    )):
+        updated.update(result)
+    return updated
+
+
+async def apply_read_marks(marks):
+    """
+    Persist ``{(reader_id, contact_id): (up_to, ephemeral_up_to)}`` and send
+    each contact one ``read_up_to`` event. Returns the number of messages marked.
+    """
+    updated = await save_read_marks(marks)
+
+    channel_layer = get_channel_layer()
+    total = 0
+    for (reader_id, contact_id), (up_to, ephemeral_up_to) in marks.items():
+        count = updated.get((reader_id, contact_id), 0)
+        if ephemeral_up_to is not None:
+            count += ephemeral_store.mark_read(contact_id, reader_id, ephemeral_up_to)
+        if not count:
+            # Already read, nothing to tell
+            continue
+        total += count
+
+        reader = await identity_cache.aget(id=reader_id)
+        contact = await identity_cache.aget(id=contact_id)
+        if reader is None or contact is None:
+            continue
+        await channel_layer.group_send(
+            f'chat_{contact.telegram_id}',
+            {
+                'type': 'read_up_to',
+                'reader_id': reader_id,
+                'reader_telegram_id': str(reader.telegram_id),
+                'up_to': up_to,
+                'ephemeral_up_to': f'e{ephemeral_up_to}' if ephemeral_up_to is not None else None,
+            }
+        )
+    return total
+
+
+class ReadReceipts:
+    def __init__(self, flush_interval=None):
+        self.flush_interval = flush_interval or getattr(settings, 'READ_RECEIPT_FLUSH_INTERVAL', 0.5)
+        self.pending = {}  # (reader_id, contact_id) -> (up_to, ephemeral_up_to)
+        self.task = None
+
+    def mark(self, reader_id, contact_id, up_to=None, ephemeral_up_to=None):
+        self.merge((int(reader_id), int(contact_id)), up_to, ephemeral_up_to)
+        if self.task is None or self.task.done():
+            self.task = asyncio.get_running_loop().create_task(self.run())
+
+    def merge(self, key, up_to, ephemeral_up_to):
+        current_up_to, current_ephemeral = self.pending.get(key, (None, None))
+        self.pending[key] = (_max(current_up_to, up_to), _max(current_ephemeral, ephemeral_up_to))
+
+    async def run(self):
+        while self.pending:
+            await asyncio.sleep(self.flush_interval)
+            try:
+                await self.flush()
+            except Exception as e:
+                logger.error(f"❌ Read receipt flush failed: {str(e)}", exc_info=True)
+
+    async def flush(self):
+        pending, self.pending = self.pending, {}
+        if pending:
+            try:
+                count = await apply_read_marks(pending)
+            except Exception:
+                # Marks are idempotent: write them again with the next flush
+                for key, (up_to, ephemeral_up_to) in pending.items():
+                    self.merge(key, up_to, ephemeral_up_to)
+                raise
+            logger.info(f"👁️ Read receipts flushed: {len(pending)} conversations, {count} messages")
+
+
+_receipts = {}
+
+
+def get_read_receipts():
+    """Return the read receipt collector bound to the running event loop."""
+    loop = asyncio.get_running_loop()
+    receipts = _receipts.get(loop)
+    if receipts is None:
+        for old_loop in [l for l in _receipts if l.is_closed()]:
+            del _receipts[old_loop]
+        receipts = _receipts[loop] = ReadReceipts()
+    return receipts
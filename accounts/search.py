@@ -0,0 +1,123 @@
+# accounts/search.py
+"""
+User search over an SQLite FTS5 trigram index.
+
+``accounts_account_search`` (migration 0006) holds ``username``,
+``first_name`` and ``last_name`` of every account under the account's id as
+rowid. The trigram tokenizer answers case-insensitive substring queries of
+three or more characters from the index instead of scanning
+``accounts_account``; ``@username`` prefixes use the same lookup restricted
+to the username column. Rows are kept in sync by the ``Account`` signals in
+``accounts.signals``; ``bulk_create()``/``update()`` bypass them, so run
+``manage.py rebuild_user_search`` after bulk imports.
+
+On other databases, or if SQLite was built without FTS5, search falls back
+to the old ``icontains`` query.
+"""
+from django.db import connection
+from django.db.models import Q
+
+from .models import Account
+
+SEARCH_TABLE = 'accounts_account_search'
+SEARCH_FIELDS = ('username', 'first_name', 'last_name')
+
+_available = None
+
+
+def search_index_available():
+    global _available
+    if _available is None:
+        _available = (
+            connection.vendor == 'sqlite'
+            and SEARCH_TABLE in connection.introspection.table_names()
+        )
+    return _available
+
+
+def _like_escape(value):
+    return value.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+
+
+def _fts_phrase(value):
+    return '"%s"' % value.replace('"', '""')
+
+
+def search_account_ids(value, prefix=False, exclude_id=None, limit=10):
+    """
+    Ids of accounts matching ``value``: a username prefix when ``prefix`` is
+    set (the ``@username`` case), otherwise a substring of any name field.
+    """
+    if prefix:
+        # LIKE only filters; the MATCH on the username column does the lookup
+        where, params = "username LIKE %s ESCAPE '\\'", [_like_escape(value) + '%']
+        if len(value) >= 3:
+            where += f' AND {SEARCH_TABLE} MATCH %s'
+            params.append('username : ' + _fts_phrase(value))
+    elif len(value) >= 3:
+        where, params = f'{SEARCH_TABLE} MATCH %s', [_fts_phrase(value)]
+    else:
+        # Shorter than one trigram: the index can't help, scan the FTS rows
+        pattern = '%' + _like_escape(value) + '%'
+        where = ' OR '.join(f"{field} LIKE %s ESCAPE '\\'" for field in SEARCH_FIELDS)
+        where, params = f'({where})', [pattern] * len(SEARCH_FIELDS)
+
+    if exclude_id is not None:
+        where += ' AND rowid != %s'
+        params.append(int(exclude_id))
+
+    with connection.cursor() as cursor:
+        cursor.execute(f'SELECT rowid FROM {SEARCH_TABLE} WHERE {where} LIMIT %s', [*params, limit])
+        return [row[0] for row in cursor.fetchall()]
+
+
+def search_accounts(value, prefix=False, exclude_id=None, limit=10):
+    """Matching ``Account`` objects, in index order."""
+    if not search_index_available():
+        if prefix:
+            users = Account.objects.filter(username__istartswith=value)
+        else:
+            users = Account.objects.filter(
+                Q(username__icontains=value) |
+                Q(first_name__icontains=value) |
+                Q(last_name__icontains=value)
+            )
+        if exclude_id is not None:
+            users = users.exclude(id=exclude_id)
+        return list(users[:limit])
+
+    ids = search_account_ids(value, prefix, exclude_id, limit)
+    accounts = Account.objects.in_bulk(ids)
+    return [accounts[pk] for pk in ids if pk in accounts]
+
+
+def index_account(account):
+    if not search_index_available():
+        return
+    with connection.cursor() as cursor:
+        cursor.execute(f'DELETE FROM {SEARCH_TABLE} WHERE rowid = %s', [account.pk])
+        cursor.execute(
+            f'INSERT INTO {SEARCH_TABLE} (rowid, username, first_name, last_name) VALUES (%s, %s, %s, %s)',
+            [account.pk, account.username or '', account.first_name or '', account.last_name or ''],
+        )
+
+
+def unindex_account(pk):
+    if not search_index_available():
+        return
+    with connection.cursor() as cursor:
+        cursor.execute(f'DELETE FROM {SEARCH_TABLE} WHERE rowid = %s', [pk])
+
+
+def rebuild_search_index():
+    """Repopulate the index from ``accounts_account``; returns the row count."""
+    with connection.cursor() as cursor:
+        cursor.execute(f'DELETE FROM {SEARCH_TABLE}')
+        cursor.execute(
+            f'INSERT INTO {SEARCH_TABLE} (rowid, username, first_name, last_name) '
+            f"SELECT id, COALESCE(username, ''), first_name, COALESCE(last_name, '') "
+            f'FROM {Account._meta.db_table}'
+        )
+        count = cursor.rowcount
+        cursor.execute(f"INSERT INTO {SEARCH_TABLE} ({SEARCH_TABLE}) VALUES ('optimize')")
+    return count
@@ -0,0 +1,99 @@
+# accounts/serialization.py
+"""
+JSON encoding shared by the views and ``ChatConsumer``.
+
+``dumps()`` uses orjson when it is installed and the stdlib ``json``
+otherwise. Both accept what the views send, datetimes included (as
+``isoformat()``), and differ only in whitespace. ``loads()`` is the
+matching decoder. ``JSONResponse`` is a ``JsonResponse`` built on ``dumps()``.
+
+``StreamingJSONResponse`` writes an object with one list member fed by an
+iterator, ``STREAM_CHUNK_ITEMS`` items at a time. Neither the list of
+dicts nor the whole body has to exist at once. Its iterator is async,
+since Django would buffer a sync one whole under ASGI (see media.py).
+"""
+import datetime
+import json
+import uuid
+
+from django.http import HttpResponse, StreamingHttpResponse
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+STREAM_CHUNK_ITEMS = 100
+
+
+def _default(obj):
+    if isinstance(obj, (datetime.datetime, datetime.date, datetime.time)):
+        return obj.isoformat()
+    if isinstance(obj, uuid.UUID):
+        return str(obj)
+    raise TypeError(f'Object of type {type(obj).__name__} is not JSON serializable')
+
+
+if orjson is not None:
+    def dumps(obj):
+        """``obj`` as UTF-8 encoded JSON."""
+        return orjson.dumps(obj, default=_default, option=orjson.OPT_NON_STR_KEYS)
+
+    loads = orjson.loads
+else:
+    _encoder = json.JSONEncoder(default=_default, ensure_ascii=False, separators=(',', ':'))
+
+    def dumps(obj):
+        """``obj`` as UTF-8 encoded JSON."""
+        return _encoder.encode(obj).encode()
+
+    loads = json.loads
+
+
+def dumps_text(obj):
+    """``dumps()`` as ``str``, for WebSocket text frames."""
+    return dumps(obj).decode()
+
+
+class JSONResponse(HttpResponse):
+    def __init__(self, data, **kwargs):
+        kwargs.setdefault('content_type', 'application/json')
+        super().__init__(dumps(data), **kwargs)
+
+
+async def _chunks(items):
+    chunk = []
+    if hasattr(items, '__aiter__'):
+        async for item in items:
+            chunk.append(item)
+            if len(chunk) == STREAM_CHUNK_ITEMS:
+                yield chunk
+                chunk = []
+    else:
+        for item in items:
+            chunk.append(item)
+            if len(chunk) == STREAM_CHUNK_ITEMS:
+                yield chunk
+                chunk = []
+    if chunk:
+        yield chunk
+
+
+async def stream_json(head, key, items, tail=None):
+    """
+    Encode ``{**head, key: [*items], **tail}`` piece by piece. ``tail``
+    may be a callable, called once the items are written.
+    """
+    yield dumps(head)[:-1] + (b',' if head else b'') + dumps(key) + b':['
+    first = True
+    async for chunk in _chunks(items):
+        yield (b'' if first else b',') + dumps(chunk)[1:-1]
+        first = False
+    tail = tail() if callable(tail) else tail
+    yield b']' + (b',' + dumps(tail)[1:] if tail else b'}')
+
+
+class StreamingJSONResponse(StreamingHttpResponse):
+    def __init__(self, head, key, items, tail=None, **kwargs):
+        kwargs.setdefault('content_type', 'application/json')
+        super().__init__(stream_json(head, key, items, tail), **kwargs)
@@ -0,0 +1,141 @@
+# accounts/sharding.py
+"""
+Conversation-sharded message storage.
+
+With ``MESSAGE_SHARDS = N`` above 1, ``Message`` and ``ThumbnailJob`` rows
+live in N SQLite files (``messages_0`` ... ``messages_N-1`` in
+``DATABASES``), each with its own write lock. Everything else stays on
+``default``. A conversation always lives on one shard, picked by a CRC32 of
+its sorted participant ids, so history, read receipts and unread counts
+stay single-shard queries. With one shard, ``default`` is that shard and
+nothing changes. The same ``"min:max"`` string is stored on every message
+as ``Message.conversation_key``, so a conversation is one indexed equality.
+
+Message ids stay unique across shards: shard ``k`` numbers its rows from
+``k << SHARD_ID_BITS`` (see ``number_shard_messages``), so ``message_db_for_id()``
+finds the shard of any id without a lookup. ``MessageRouter`` sends
+instances to their shard. It lets relations cross databases, which is why
+the foreign keys into and out of ``Message`` have no database constraint.
+Querysets have no instance to route by, so code that queries messages
+names its shard with ``.using()``. Unrouted queries go to the first shard.
+"""
+import zlib
+
+from django.conf import settings
+from django.db.models import BigIntegerField, CharField, Value
+from django.db.models.functions import Cast, Concat, Greatest, Least
+
+SHARD_ID_BITS = 48
+SHARDED_MODELS = {'message', 'thumbnailjob'}
+
+
+def message_databases():
+    """Aliases of the message shards, in shard order."""
+    count = getattr(settings, 'MESSAGE_SHARDS', 1)
+    if count <= 1:
+        return ['default']
+    return [f'messages_{index}' for index in range(count)]
+
+
+def is_sharded():
+    return message_databases() != ['default']
+
+
+def shard_index(alias):
+    return message_databases().index(alias) if alias in message_databases() else None
+
+
+def conversation_key(user_id, contact_id):
+    """``"min:max"`` of the two account ids: the same key in either direction."""
+    first, second = sorted((int(user_id), int(contact_id)))
+    return f'{first}:{second}'
+
+
+def conversation_key_sql(user_id, contact_id):
+    """``conversation_key()`` as a database expression of two id expressions."""
+    return Concat(
+        Cast(Least(user_id, contact_id, output_field=BigIntegerField()), CharField()),
+        Value(':'),
+        Cast(Greatest(user_id, contact_id, output_field=BigIntegerField()), CharField()),
+        output_field=CharField(),
+    )
+
+
+def message_db(user_id, contact_id):
+    """Shard of the conversation between two accounts (in either direction)."""
+    shards = message_databases()
+    if len(shards) == 1:
+        return shards[0]
+    return shards[zlib.crc32(conversation_key(user_id, contact_id).encode()) % len(shards)]
+
+
+def message_db_for_id(message_id):
+    shards = message_databases()
+    index = int(message_id) >> SHARD_ID_BITS
+    return shards[index] if index < len(shards) else shards[0]
+
+
+def number_shard_messages(apps, schema_editor):
+    """
+    Migration step: shard k hands out message ids from k << SHARD_ID_BITS,
+    so ids stay unique. SQLite drops the counter of an empty table whenever
+    a migration rebuilds it, so migrations that do so run this again.
+    """
+    connection = schema_editor.connection
+    index = shard_index(connection.alias)
+    if not index or connection.vendor != 'sqlite':
+        return
+    base = index << SHARD_ID_BITS
+    table = apps.get_model('accounts', 'Message')._meta.db_table
+    with connection.cursor() as cursor:
+        cursor.execute("UPDATE sqlite_sequence SET seq = MAX(seq, %s) WHERE name = %s", [base, table])
+        cursor.execute(
+            "INSERT INTO sqlite_sequence (name, seq) SELECT %s, %s "
+            "WHERE NOT EXISTS (SELECT 1 FROM sqlite_sequence WHERE name = %s)",
+            [table, base, table],
+        )
+
+
+def group_by_shard(items, key):
+    """``{alias: [item, ...]}`` using ``key(item) -> (user_id, contact_id)``."""
+    groups = {}
+    for item in items:
+        groups.setdefault(message_db(*key(item)), []).append(item)
+    return groups
+
+
+class MessageRouter:
+    def _db_for(self, model, instance=None, **hints):
+        if model._meta.app_label != 'accounts' or model._meta.model_name not in SHARDED_MODELS:
+            # Otherwise a message's sender would be looked up on the message's shard
+            return 'default' if is_sharded() else None
+        if instance is not None:
+            if isinstance(instance, model) and instance._state.db:
+                return instance._state.db
+            if getattr(instance, 'sender_id', None) and getattr(instance, 'receiver_id', None):
+                return message_db(instance.sender_id, instance.receiver_id)
+            if getattr(instance, 'message_id', None):
+                # A ThumbnailJob or MediaUpload pointing at a message
+                return message_db_for_id(instance.message_id)
+        return message_databases()[0]
+
+    def db_for_read(self, model, **hints):
+        return self._db_for(model, **hints)
+
+    def db_for_write(self, model, **hints):
+        return self._db_for(model, **hints)
+
+    def allow_relation(self, obj1, obj2, **hints):
+        if obj1._meta.app_label == obj2._meta.app_label == 'accounts':
+            return True
+        return None
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        if not is_sharded():
+            return None
+        sharded = app_label == 'accounts' and model_name in SHARDED_MODELS
+        if db in message_databases():
+            return sharded
+        if sharded:
+            return False
+        return None
@@ -0,0 +1,63 @@
+# accounts/signals.py
+from django.db.backends.signals import connection_created
+from django.db.models import Q
+from django.db.models.signals import post_delete, post_save, pre_delete
+from django.dispatch import receiver
+
+from .autocomplete import autocomplete_index
+from .contact_cache import contact_cache
+from .identity import identity_cache
+from .querycount import count_queries
+from .models import Account, Contact, Message
+from .search import SEARCH_FIELDS, index_account, unindex_account
+from .sharding import message_databases
+from .storage import media_storage
+
+
+@receiver(post_save, sender=Account)
+@receiver(post_delete, sender=Account)
+def invalidate_identity(sender, instance, **kwargs):
+    identity_cache.invalidate(instance.pk)
+    contact_cache.invalidate_account(instance.telegram_id)
+
+
+@receiver(post_save, sender=Contact)
+@receiver(post_delete, sender=Contact)
+def invalidate_contact_lists(sender, instance, **kwargs):
+    # A request shows up in both the sender's and the receiver's list
+    contact_cache.invalidate(instance.user_id, instance.contact_id)
+
+
+@receiver(post_save, sender=Account)
+def index_account_search(sender, instance, update_fields=None, **kwargs):
+    if update_fields is not None and not set(update_fields) & set(SEARCH_FIELDS):
+        return
+    index_account(instance)
+    autocomplete_index.update(instance.pk, instance.username, instance.first_name)
+
+
+@receiver(post_delete, sender=Account)
+def unindex_account_search(sender, instance, **kwargs):
+    unindex_account(instance.pk)
+    autocomplete_index.remove(instance.pk)
+
+
+@receiver(pre_delete, sender=Account)
+def delete_account_messages(sender, instance, **kwargs):
+    # Message foreign keys don't cascade: the messages may be on a shard
+    for alias in message_databases():
+        Message.objects.using(alias).filter(Q(sender_id=instance.pk) | Q(receiver_id=instance.pk)).delete()
+
+
+@receiver(post_delete, sender=Message)
+def release_message_media(sender, instance, **kwargs):
+    # Text messages have neither; only media rows touch MediaBlob
+    for field in (instance.media_file, instance.media_thumbnail):
+        if field:
+            media_storage.release(field.name)
+
+
+@receiver(connection_created)
+def install_query_counter(sender, connection, **kwargs):
+    if count_queries not in connection.execute_wrappers:
+        connection.execute_wrappers.append(count_queries)
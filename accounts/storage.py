@@ -0,0 +1,165 @@
+# accounts/storage.py
+"""
+Content-addressed storage for message media.
+
+``Message.media_file`` and ``media_thumbnail`` are saved under their SHA-256
+(``cas/ab/cd/<sha256>``) instead of their ``upload_to`` date path, so a
+forwarded image is stored once however many messages point at it. The
+``MediaBlob`` table counts references. Every save adds one, and the
+``post_delete`` handler in ``accounts.signals`` releases one for each file of
+a deleted message, including the reaper's batch deletes. A stored blob is
+never overwritten: saving content whose blob already exists only adds the
+reference. Callers that fail to save the message afterwards release the
+reference again.
+
+The file goes away with the last reference, once the release has committed:
+a transaction of its own deletes the row only if its count is still 0 and
+unlinks the file before committing. ``_save`` takes its reference and writes
+the file inside one transaction too, so with SQLite's write lock the two
+never interleave, and a save of the same content either comes first (the
+row is kept) or writes the file again after. A row left at 0 by a crash in
+between goes with its file in the next media GC walk.
+
+Files saved before this storage existed keep their old names and are served
+as before; they are not reference counted.
+"""
+import hashlib
+import os
+import uuid
+
+from django.core.files.move import file_move_safe
+from django.core.files.storage import FileSystemStorage
+from django.db import connections, router, transaction
+from django.utils import timezone
+from django.utils.deconstruct import deconstructible
+
+CAS_PREFIX = 'cas/'
+HASH_BUFFER = 64 * 1024
+
+
+def blob_name(sha256):
+    return f'{CAS_PREFIX}{sha256[:2]}/{sha256[2:4]}/{sha256}'
+
+
+def _content_hash(content):
+    # Uploads arrive with their hash already computed chunk by chunk
+    sha256 = getattr(content, 'sha256', None)
+    if sha256:
+        return sha256
+    hasher = hashlib.sha256()
+    content.seek(0)
+    for chunk in content.chunks(HASH_BUFFER):
+        hasher.update(chunk)
+    content.seek(0)
+    return hasher.hexdigest()
+
+
+def _blob_db():
+    from .models import MediaBlob
+
+    return router.db_for_write(MediaBlob)
+
+
+def _add_reference(sha256, size):
+    """
+    One more reference to the blob, as a single upsert so concurrent first
+    saves can't collide. Returns the new reference count.
+    """
+    from .models import MediaBlob
+
+    connection = connections[_blob_db()]
+    with connection.cursor() as cursor:
+        cursor.execute(
+            f"INSERT INTO {MediaBlob._meta.db_table} (sha256, size, refcount, created_at) "
+            "VALUES (%s, %s, 1, %s) "
+            "ON CONFLICT (sha256) DO UPDATE SET refcount = refcount + 1 "
+            "RETURNING refcount",
+            [sha256, size, connection.ops.adapt_datetimefield_value(timezone.now())],
+        )
+        return cursor.fetchone()[0]
+
+
+@deconstructible
+class ContentAddressedStorage(FileSystemStorage):
+    def get_available_name(self, name, max_length=None):
+        # The name is derived from the content in _save()
+        return name
+
+    def _save(self, name, content):
+        sha256 = _content_hash(content)
+        name = blob_name(sha256)
+        full_path = self.path(name)
+        os.makedirs(os.path.dirname(full_path), exist_ok=True)
+
+        with transaction.atomic(using=_blob_db()):
+            if _add_reference(sha256, content.size) == 1:
+                # Nobody else refers to it: write, replacing a file left by a blob being freed
+                self._write(content, full_path, replace=True)
+            elif not os.path.exists(full_path):
+                # Referenced elsewhere: only ever fill in a missing file, never replace one
+                self._write(content, full_path, replace=False)
+
+        if self.file_permissions_mode is not None:
+            os.chmod(full_path, self.file_permissions_mode)
+        return name
+
+    def _write(self, content, full_path, replace):
+        try:
+            if hasattr(content, 'temporary_file_path'):
+                # A rename either way
+                file_move_safe(content.temporary_file_path(), full_path, allow_overwrite=replace)
+                return
+            tmp_path = f'{full_path}.{uuid.uuid4().hex}.tmp'
+            with open(tmp_path, 'wb') as f:
+                for chunk in content.chunks():
+                    f.write(chunk)
+            if replace:
+                os.replace(tmp_path, full_path)
+                return
+            try:
+                # Unlike os.replace(), fails if a concurrent save got there first
+                os.link(tmp_path, full_path)
+            finally:
+                os.remove(tmp_path)
+        except FileExistsError:
+            pass
+
+    def release(self, name):
+        """Drop one reference to ``name``; the file is deleted with the last one."""
+        from .models import MediaBlob
+
+        if not name or not name.startswith(CAS_PREFIX):
+            return
+        sha256 = os.path.basename(name)
+        using = _blob_db()
+        with connections[using].cursor() as cursor:
+            cursor.execute(
+                f"UPDATE {MediaBlob._meta.db_table} SET refcount = refcount - 1 "
+                "WHERE sha256 = %s AND refcount > 0 "
+                "RETURNING refcount",
+                [sha256],
+            )
+            row = cursor.fetchone()
+        if row is not None and row[0] == 0:
+            # The release may still roll back with the caller's transaction
+            transaction.on_commit(lambda: self._remove_unreferenced(sha256), using=using)
+
+    def _remove_unreferenced(self, sha256):
+        from .models import MediaBlob
+
+        with transaction.atomic(using=_blob_db()):
+            # Saved again since the release committed
+            if not MediaBlob.objects.filter(sha256=sha256, refcount=0).delete()[0]:
+                return
+            # Before the commit, while a save of the same content waits for the lock
+            try:
+                os.remove(self.path(blob_name(sha256)))
+            except FileNotFoundError:
+                pass
+
+
+media_storage = ContentAddressedStorage()
+
+
+def get_media_storage():
+    return media_storage
@@ -1,3 +1,994 @@
-from django.test import TestCase
+import asyncio
+import hashlib
+import io
+import json
+import os
+import shutil
+import tempfile
+import threading
+import warnings
+from collections import Counter
+from datetime import timedelta
+from unittest import mock
 
-# Create your tests here.
+from channels.exceptions import ChannelFull
+from django.conf import settings
+from django.core.files.base import ContentFile
+from django.db import IntegrityError
+from django.test import Client, SimpleTestCase, TransactionTestCase, override_settings
+from django.utils import timezone
+from PIL import Image
+
+from config.channel_layers import SQLiteChannelLayer
+
+from . import batching, thumbnails, uploads
+from .autocomplete import PrefixIndex
+from .consumers import ChatConsumer
+from .contact_cache import contact_cache
+from .db_executor import consumer_db, db_writer
+from .ephemeral import EphemeralMessageStore
+from .expiry import ExpiryScheduler
+from .history import history_page
+from .identity import IdentityCache, identity_cache
+from .media import RangeNotSatisfiable, parse_range
+from .media_gc import MediaCollector
+from .presence import PresenceRegistry
+from .reaper import reap_expired
+from .receipts import ReadReceipts
+from .models import Account, Contact, MediaBlob, MediaUpload, Message, PresenceConnection, ThumbnailJob
+from .querycount import query_report, track_queries
+from .sharding import conversation_key, message_databases, message_db, message_db_for_id
+from .storage import blob_name, media_storage
+from .timing_wheel import TimingWheel
+from .urls import urlpatterns
+
+# Most queries each endpoint may run with cold caches, with one or two
+# message shards, writes included whichever thread runs them. Every URL in
+# accounts/urls.py needs an entry; raise one only with a reason.
+QUERY_BUDGETS = {
+    'index': 0,
+    'chat': 0,
+    'telegram_auth_api': 11,
+    'logout_api': 2,
+    'search_users': 2,
+    'suggest_users': 2,  # autocomplete index not loaded: search fallback
+    'add_contact': 4,
+    'accept_contact': 6,
+    'reject_contact': 3,
+    'get_contacts': 4,  # version check, then the three lists on a miss
+    'get_messages': 1,
+    'send_message': 6,  # insert + the writer's savepoint pair, then the broadcast lookups
+    'mark_read': 3,
+    'get_conversations': 4,  # 2 + 1 per extra shard
+    'create_upload': 5,
+    'upload_chunk': 2,
+    'finish_upload': 10,  # blob upsert, message + thumbnail job, upload row
+    'serve_media': 1,
+    'serve_thumbnail': 1,
+    'metrics': 2,
+}
+
+MEDIA_TMP = tempfile.mkdtemp(prefix='vchat_tests_')
+
+
+def tearDownModule():
+    shutil.rmtree(MEDIA_TMP, ignore_errors=True)
+
+
+def decode(response):
+    if not response.streaming:
+        return response.json()
+    with warnings.catch_warnings():
+        # The test client reads the async body synchronously
+        warnings.simplefilter('ignore')
+        return json.loads(b''.join(response))
+
+
+@override_settings(MEDIA_ROOT=f'{MEDIA_TMP}/media', MEDIA_UPLOAD_TEMP_DIR=f'{MEDIA_TMP}/uploads', DEBUG=True)
+class QueryBudgetTests(TransactionTestCase):
+    databases = '__all__'
+    single_writer = True  # DB_SINGLE_WRITER, whatever the environment says
+
+    def setUp(self):
+        patcher = mock.patch.object(db_writer, 'fallback', None if self.single_writer else consumer_db)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        identity_cache.clear()
+        contact_cache.clear()
+        self.alice, self.bob, self.carol = Client(), Client(), Client()
+        self.exercised = set()
+
+    def request(self, name, client, method, url, data=None, **headers):
+        """Send one request and check it against the budget of ``name``."""
+        # Cold caches: the budget is the worst case
+        identity_cache.clear()
+        contact_cache.clear()
+        if isinstance(data, dict):
+            data = json.dumps(data)
+        kwargs = {'content_type': headers.pop('content_type', 'application/json')} if data is not None else {}
+        with track_queries() as stats:
+            # Media bodies are streamed after the view's queries
+            response = getattr(client, method)(url, data, **kwargs, **headers)
+
+        self.assertEqual(response.resolver_match.url_name, name)
+        self.assertLess(response.status_code, 400, response.content if not response.streaming else name)
+        self.assertLessEqual(
+            stats.count, QUERY_BUDGETS[name],
+            f"{name} ran {stats.count} queries:\n" + '\n'.join(stats.statements),
+        )
+        self.assertEqual(stats.repeated(settings.QUERY_REPEAT_THRESHOLD), [], f"{name} has an N+1")
+        self.exercised.add(name)
+        return response
+
+    def login(self, client, telegram_id, username):
+        response = self.request('telegram_auth_api', client, 'post', '/api/auth/telegram/', {
+            'id': telegram_id, 'first_name': username.title(), 'username': username,
+        })
+        return response.json()['user']['id']
+
+    def test_every_url_has_a_budget(self):
+        self.assertEqual({pattern.name for pattern in urlpatterns}, set(QUERY_BUDGETS))
+
+    def test_query_budgets(self):
+        self.request('index', self.alice, 'get', '/')
+        self.request('chat', self.alice, 'get', '/chat/')
+
+        alice_id = self.login(self.alice, 111, 'alice')
+        bob_id = self.login(self.bob, 222, 'bob')
+        carol_id = self.login(self.carol, 333, 'carol')
+        self.login(self.alice, 111, 'alice')  # existing account
+
+        self.request('search_users', self.alice, 'post', '/api/search/users/', {'type': 'username', 'value': 'bo'})
+        self.request('search_users', self.alice, 'post', '/api/search/users/', {'type': 'telegram_id', 'value': '222'})
+        self.request('suggest_users', self.alice, 'get', '/api/search/suggest/?q=bo')
+
+        self.request('add_contact', self.alice, 'post', '/api/contacts/add/', {'username': '@bob'})
+        self.request('add_contact', self.carol, 'post', '/api/contacts/add/', {'username': 'alice'})
+        self.request('accept_contact', self.bob, 'post', '/api/contacts/accept/', {'from_user_id': alice_id})
+        self.request('reject_contact', self.alice, 'post', '/api/contacts/reject/', {'from_user_id': carol_id})
+        self.request('get_contacts', self.alice, 'get', '/api/contacts/')
+
+        for i in range(3):
+            self.request('send_message', self.alice, 'post', '/api/messages/send/', {
+                'to_user_id': bob_id, 'content': f'message {i}',
+            })
+        page = decode(self.request('get_messages', self.bob, 'get', f'/api/messages/{alice_id}/'))
+        self.assertEqual(len(page['messages']), 3)
+        self.request('get_messages', self.bob, 'get', f"/api/messages/{alice_id}/?before={page['cursor']['before']}")
+        self.request('mark_read', self.bob, 'post', '/api/messages/read/', {
+            'contact_id': alice_id, 'up_to': page['cursor']['after'],
+        })
+        conversations = self.request('get_conversations', self.bob, 'get', '/api/conversations/').json()
+        self.assertEqual(conversations['conversations'][0]['unread_count'], 0)
+
+        buffer = io.BytesIO()
+        Image.new('RGB', (64, 48), (200, 10, 10)).save(buffer, 'PNG')
+        data = buffer.getvalue()
+        upload = self.request('create_upload', self.alice, 'post', '/api/media/uploads/', {
+            'to_user_id': bob_id, 'file_name': 'pic.png', 'file_size': len(data),
+        }).json()['upload_id']
+        self.request('upload_chunk', self.alice, 'patch', f'/api/media/uploads/{upload}/', data,
+                     content_type='application/octet-stream', HTTP_UPLOAD_OFFSET='0')
+        self.request('upload_chunk', self.alice, 'get', f'/api/media/uploads/{upload}/')
+        message_id = self.request(
+            'finish_upload', self.alice, 'post', f'/api/media/uploads/{upload}/complete/', {}
+        ).json()['message']['id']
+
+        # Rendered here instead of by the worker, stored the same way
+        alias = message_db_for_id(message_id)
+        job = ThumbnailJob.objects.using(alias).filter(message_id=message_id).values(
+            'id', 'attempts', 'message_id', 'message__media_file',
+        ).get()
+        thumbnail_path = f'{MEDIA_TMP}/thumbnail.jpg'
+        Image.new('RGB', (32, 24), (200, 10, 10)).save(thumbnail_path, 'JPEG')
+        asyncio.run(thumbnails.finish_job(job, thumbnail_path, None))
+        message = Message.objects.using(alias).get(id=message_id)
+        self.assertEqual(MediaBlob.objects.get(sha256=os.path.basename(message.media_thumbnail.name)).refcount, 1)
+        self.request('serve_media', self.bob, 'get', f'/api/media/{message_id}/')
+        self.request('serve_media', self.bob, 'get', f'/api/media/{message_id}/', HTTP_RANGE='bytes=0-9')
+        self.request('serve_thumbnail', self.alice, 'get', f'/api/media/{message_id}/thumbnail/')
+
+        self.request('metrics', self.alice, 'get', '/api/metrics/')
+        self.request('logout_api', self.alice, 'post', '/api/logout/', {})
+
+        self.assertEqual(self.exercised, set(QUERY_BUDGETS))
+
+    def test_repeated_queries_are_reported(self):
+        alice_id = self.login(self.alice, 111, 'alice')
+        for n in range(6):
+            self.login(Client(), 400 + n, f'user{n}')
+        for contact_id in range(alice_id + 1, alice_id + 7):
+            Contact.objects.create(user_id=alice_id, contact_id=contact_id)
+
+        with track_queries() as stats:
+            # One account query per contact
+            names = [c.contact.username for c in Contact.objects.filter(user_id=alice_id)]
+        self.assertEqual(len(names), 6)
+        self.assertEqual(len(stats.repeated(settings.QUERY_REPEAT_THRESHOLD)), 1)
+
+        with self.assertLogs('accounts.querycount', 'WARNING') as logs:
+            query_report.report('contacts', stats)
+        self.assertIn('Possible N+1 in contacts', logs.output[0])
+
+
+class ConsumerDbQueryBudgetTests(QueryBudgetTests):
+    """The same budgets with DB_SINGLE_WRITER off."""
+    single_writer = False
+
+
+@override_settings(MEDIA_ROOT=f'{MEDIA_TMP}/media', MEDIA_UPLOAD_TEMP_DIR=f'{MEDIA_TMP}/uploads')
+class UploadTests(TransactionTestCase):
+    databases = '__all__'
+
+    def setUp(self):
+        self.alice = Account.objects.create(telegram_id=111, first_name='Alice', username='alice')
+        self.bob = Account.objects.create(telegram_id=222, first_name='Bob', username='bob')
+
+    def start_upload(self, data, name='pic.png'):
+        upload = MediaUpload.objects.create(
+            uploader=self.alice, receiver=self.bob, message_type='image',
+            file_name=name, file_size=len(data), expire_seconds=3600,
+        )
+        uploads.create_part_file(upload.id)
+        return upload
+
+    def write(self, upload, data, offset):
+        """One chunk, stored like the upload_chunk view does."""
+        upload.received = uploads.write_chunk(upload, io.BytesIO(data), offset, len(data))
+        MediaUpload.objects.filter(id=upload.id).update(received=upload.received)
+        return upload.received
+
+    def test_chunks_split_across_processes(self):
+        data = bytes(range(256)) * 400
+        upload = self.start_upload(data)
+        half = len(data) // 2
+
+        self.write(upload, data[:half], 0)
+        # This process saw only the first half; another worker took the rest
+        first_worker = uploads._states.pop(upload.id)
+        self.write(upload, data[half:], half)
+        uploads._states[upload.id] = first_worker
+
+        message = uploads.complete_upload(upload)
+        self.assertEqual(upload.sha256, hashlib.sha256(data).hexdigest())
+        self.assertEqual(message.media_file.name, blob_name(upload.sha256))
+        with message.media_file.open('rb') as f:
+            self.assertEqual(f.read(), data)
+
+    def test_failed_message_save_releases_the_blob(self):
+        data = b'y' * 1000
+        upload = self.start_upload(data)
+        self.write(upload, data, 0)
+        with mock.patch.object(Message, 'save', side_effect=RuntimeError('disk full')):
+            with self.assertRaises(RuntimeError):
+                uploads.complete_upload(upload)
+        self.assertFalse(MediaBlob.objects.exists())
+        self.assertFalse(media_storage.exists(blob_name(hashlib.sha256(data).hexdigest())))
+
+    def test_rehash_runs_off_the_writer(self):
+        data = bytes(range(256)) * 40
+        upload = self.start_upload(data)
+        self.write(upload, data, 0)
+        uploads._states.pop(upload.id)  # chunks taken by another worker
+        threads = []
+        hash_prefix = uploads._hash_prefix
+
+        def record(*args):
+            threads.append(threading.current_thread().name)
+            return hash_prefix(*args)
+
+        with mock.patch.object(uploads, '_hash_prefix', side_effect=record):
+            message = asyncio.run(uploads.acomplete_upload(upload))
+        self.assertEqual(len(threads), 1)
+        self.assertFalse(threads[0].startswith('db-writer'), threads[0])
+        self.assertEqual(message.media_file.name, blob_name(hashlib.sha256(data).hexdigest()))
+        self.assertEqual(MediaUpload.objects.get(id=upload.id).message_id, message.id)
+
+    def test_incomplete_upload_is_refused(self):
+        data = b'x' * 1000
+        upload = self.start_upload(data)
+        self.write(upload, data[:600], 0)
+        upload.received = upload.file_size  # stale row claims more than the part file has
+        with self.assertRaises(ValueError):
+            uploads.complete_upload(upload)
+
+
+@override_settings(MEDIA_ROOT=f'{MEDIA_TMP}/media')
+class ContentAddressedStorageTests(TransactionTestCase):
+    databases = '__all__'
+
+    def read(self, name):
+        with media_storage.open(name, 'rb') as f:
+            return f.read()
+
+    def test_same_content_is_stored_once(self):
+        first = media_storage.save('a.png', ContentFile(b'same bytes'))
+        second = media_storage.save('b.png', ContentFile(b'same bytes'))
+        self.assertEqual(first, second)
+        self.assertEqual(MediaBlob.objects.get().refcount, 2)
+
+        media_storage.release(first)
+        self.assertTrue(media_storage.exists(first))
+        media_storage.release(second)
+        self.assertFalse(MediaBlob.objects.exists())
+        self.assertFalse(media_storage.exists(first))
+
+    def test_referenced_blob_is_never_overwritten(self):
+        name = media_storage.save('a.png', ContentFile(b'original'))
+        wrong = ContentFile(b'something else')
+        wrong.sha256 = os.path.basename(name)  # e.g. a hash over part of an upload
+        self.assertEqual(media_storage.save('b.png', wrong), name)
+        self.assertEqual(self.read(name), b'original')
+        self.assertEqual(MediaBlob.objects.get().refcount, 2)
+
+    def test_first_save_racing_another(self):
+        data = b'new blob'
+        sha256 = hashlib.sha256(data).hexdigest()
+        # Another saver has taken the first reference but not written the file yet
+        MediaBlob.objects.create(sha256=sha256, size=len(data), refcount=1)
+
+        self.assertEqual(media_storage.save('a.png', ContentFile(data)), blob_name(sha256))
+        self.assertEqual(MediaBlob.objects.get().refcount, 2)
+        self.assertEqual(self.read(blob_name(sha256)), data)
+
+    def test_blob_saved_again_before_its_file_is_removed(self):
+        name = media_storage.save('a.png', ContentFile(b'picture'))
+        with mock.patch('accounts.storage.transaction.on_commit') as on_commit:
+            media_storage.release(name)
+        remove_unreferenced = on_commit.call_args.args[0]
+        self.assertEqual(MediaBlob.objects.get().refcount, 0)
+
+        # Forwarded again between the release's commit and the removal
+        self.assertEqual(media_storage.save('b.png', ContentFile(b'picture')), name)
+        remove_unreferenced()
+        self.assertEqual(MediaBlob.objects.get().refcount, 1)
+        self.assertEqual(self.read(name), b'picture')
+
+        media_storage.release(name)
+        media_storage.release(name)  # one too many: never below 0
+        self.assertFalse(MediaBlob.objects.exists())
+        self.assertFalse(media_storage.exists(name))
+
+
+@override_settings(MEDIA_ROOT=f'{MEDIA_TMP}/media')
+class MediaCollectorTests(TransactionTestCase):
+    databases = '__all__'
+
+    def setUp(self):
+        self.alice = Account.objects.create(telegram_id=111, first_name='Alice', username='alice')
+        self.bob = Account.objects.create(telegram_id=222, first_name='Bob', username='bob')
+
+    def media_message(self, data=b'forwarded picture'):
+        message = Message(
+            sender=self.alice, receiver=self.bob, message_type='image', file_name='pic.png',
+            file_size=len(data), expires_at=timezone.now() + timedelta(hours=1),
+        )
+        message.media_file.save('pic.png', ContentFile(data), save=False)
+        message.save(using=message_db(self.alice.id, self.bob.id))
+        return message.media_file.name
+
+    def snapshot(self, collector, batch_size=100):
+        while collector.update_snapshot(batch_size):
+            pass
+        return collector.referenced
+
+    def test_stale_snapshot_never_lowers_a_refcount(self):
+        name = self.media_message()
+        snapshot = self.snapshot(MediaCollector())
+        # Forwarded again after the snapshot was taken
+        self.media_message()
+
+        MediaCollector().reconcile_blobs(snapshot)
+        self.assertEqual(MediaBlob.objects.get().refcount, 2)
+        media_storage.release(name)
+        self.assertTrue(media_storage.exists(name))
+
+    def test_low_refcount_is_raised(self):
+        self.media_message()
+        self.media_message()
+        MediaBlob.objects.update(refcount=1)
+
+        collector = MediaCollector()
+        self.assertIsNotNone(collector.reconcile_blobs(self.snapshot(collector), limit=1))
+        self.assertEqual(MediaBlob.objects.get().refcount, 2)
+
+    def test_snapshot_is_paged_and_incremental(self):
+        name = self.media_message()
+        self.media_message()
+        collector = MediaCollector()
+
+        with track_queries() as stats:
+            self.assertEqual(self.snapshot(collector, batch_size=1), Counter({name: 2}))
+        # One query per message, and one finding each shard's end
+        self.assertEqual(stats.count, 2 + len(message_databases()))
+
+        self.media_message()
+        with track_queries() as stats:
+            self.assertEqual(self.snapshot(collector), Counter({name: 3}))
+        # Only the new message is read
+        self.assertEqual(stats.count, len(message_databases()))
+
+    def test_pass_steps_run_on_the_collectors_thread(self):
+        self.media_message()
+        collector = MediaCollector()
+        threads = set()
+
+        def collect_batch(*args):
+            threads.add(threading.current_thread().name)
+            return MediaCollector.collect_batch(collector, *args)
+
+        with mock.patch.object(collector, 'collect_batch', side_effect=collect_batch):
+            step = collector.executor(collector.collect_batch)
+            while asyncio.run(step(100)):
+                pass
+        self.assertEqual(collector.passes, 1)
+        self.assertEqual(len(threads), 1)
+        self.assertTrue(threads.pop().startswith('media-gc'))
+
+
+class PresenceTests(TransactionTestCase):
+    databases = '__all__'
+
+    def setUp(self):
+        contact_cache.clear()
+        self.alice = Account.objects.create(telegram_id=111, first_name='Alice', username='alice')
+        self.bob = Account.objects.create(telegram_id=222, first_name='Bob', username='bob', is_online=True)
+        Contact.objects.create(user=self.alice, contact=self.bob, is_accepted=True)
+
+    def test_logout_shows_offline_in_cached_contact_lists(self):
+        self.assertTrue(contact_cache.get(self.alice.id).rows[0]['is_online'])
+        client = Client()
+        client.cookies['user_id'] = str(self.bob.id)
+        client.post('/api/logout/', '{}', content_type='application/json')
+
+        row = contact_cache.get(self.alice.id).rows[0]
+        self.assertFalse(row['is_online'])
+        self.assertEqual(row['last_seen'], Account.objects.get(id=self.bob.id).last_seen.isoformat())
+
+    def test_failed_presence_flush_is_retried(self):
+        registry = PresenceRegistry()
+        registry.pending = {'111': timezone.now(), '222': timezone.now()}
+        reconnected = timezone.now()
+
+        def save(counts, changed_at):
+            # Alice comes back while the write is failing
+            registry.pending['111'] = reconnected
+            raise RuntimeError('database is locked')
+
+        with mock.patch.object(registry, 'save', side_effect=save):
+            with self.assertRaises(RuntimeError):
+                asyncio.run(registry.flush())
+        self.assertEqual(set(registry.pending), {'111', '222'})
+        self.assertEqual(registry.pending['111'], reconnected)
+
+    def test_online_while_another_process_has_sockets(self):
+        first, second = PresenceRegistry(flush_interval=60), PresenceRegistry(flush_interval=60)
+
+        def step(registry, change):
+            async def run():
+                change(111)
+                await registry.flush()
+            asyncio.run(run())
+            return Account.objects.get(telegram_id=111).is_online
+
+        step(first, first.connect)
+        self.assertTrue(step(second, second.connect))
+        # Closing the tab on one worker leaves the other one's socket
+        self.assertTrue(step(first, first.disconnect))
+        self.assertFalse(step(second, second.disconnect))
+        self.assertFalse(PresenceConnection.objects.exists())
+
+    def test_connections_of_dead_process_expire(self):
+        # Bob's worker died with his socket open
+        last_heard = timezone.now() - timedelta(minutes=5)
+        PresenceConnection.objects.create(process='gone:1:x', telegram_id=222, count=1, heartbeat=last_heard)
+        registry = PresenceRegistry(flush_interval=60)
+
+        async def scenario():
+            await registry.heartbeat()
+            await registry.flush()
+
+        asyncio.run(scenario())
+        bob = Account.objects.get(telegram_id=222)
+        self.assertFalse(bob.is_online)
+        self.assertEqual(bob.last_seen, last_heard)
+        self.assertFalse(PresenceConnection.objects.exists())
+
+
+class ContactCacheTests(TransactionTestCase):
+    databases = '__all__'
+
+    def setUp(self):
+        contact_cache.clear()
+        self.alice = Account.objects.create(telegram_id=111, first_name='Alice', username='alice')
+        self.bob = Account.objects.create(telegram_id=222, first_name='Bob', username='bob')
+
+    def test_changes_without_signals_are_seen(self):
+        # As another worker would: no signal reaches this process's cache
+        self.assertEqual(contact_cache.get(self.alice.id).rows, [])
+        stale = contact_cache.stale
+        Contact.objects.bulk_create([Contact(user=self.bob, contact=self.alice)])
+        rows = contact_cache.get(self.alice.id).rows
+        self.assertEqual([(row['id'], row['pending_from_them']) for row in rows], [(self.bob.id, True)])
+
+        Contact.objects.filter(user=self.bob).update(is_accepted=True, accepted_at=timezone.now())
+        Contact.objects.bulk_create([Contact(user=self.alice, contact=self.bob, is_accepted=True, accepted_at=timezone.now())])
+        rows = contact_cache.get(self.alice.id).rows
+        self.assertEqual([(row['id'], row['is_accepted']) for row in rows], [(self.bob.id, True)])
+
+        Account.objects.filter(id=self.bob.id).update(is_online=True)
+        self.assertTrue(contact_cache.get(self.alice.id).rows[0]['is_online'])
+        self.assertEqual(contact_cache.stale - stale, 3)
+
+    def test_unchanged_list_is_a_hit(self):
+        first = contact_cache.get(self.alice.id)
+        hits = contact_cache.hits
+        self.assertIs(contact_cache.get(self.alice.id), first)
+        self.assertEqual(contact_cache.hits, hits + 1)
+
+
+class ThumbnailJobTests(TransactionTestCase):
+    databases = '__all__'
+
+    def test_stale_jobs_are_reclaimed_until_the_last_attempt(self):
+        alice = Account.objects.create(telegram_id=111, first_name='Alice', username='alice')
+        bob = Account.objects.create(telegram_id=222, first_name='Bob', username='bob')
+        alias = message_db(alice.id, bob.id)
+        long_ago = timezone.now() - timedelta(hours=1)
+        jobs = {}
+        for attempts in (1, settings.THUMBNAIL_MAX_ATTEMPTS):
+            message = Message(
+                sender=alice, receiver=bob, message_type='image',
+                expires_at=timezone.now() + timedelta(hours=1),
+            )
+            message.save(using=alias)
+            # Left running by a worker that crashed
+            jobs[attempts] = ThumbnailJob.objects.using(alias).create(
+                message=message, status=ThumbnailJob.RUNNING, attempts=attempts, started_at=long_ago,
+            ).id
+
+        claimed = thumbnails._claim_shard_jobs(alias, 'test-worker', 10)
+        self.assertEqual([job['id'] for job in claimed], [jobs[1]])
+        given_up = ThumbnailJob.objects.using(alias).get(id=jobs[settings.THUMBNAIL_MAX_ATTEMPTS])
+        self.assertEqual(given_up.status, ThumbnailJob.FAILED)
+        self.assertIsNotNone(given_up.finished_at)
+
+    def test_partial_save_does_not_load_deferred_fields(self):
+        alice = Account.objects.create(telegram_id=111, first_name='Alice', username='alice')
+        bob = Account.objects.create(telegram_id=222, first_name='Bob', username='bob')
+        alias = message_db(alice.id, bob.id)
+        message = Message(sender=alice, receiver=bob, message_type='image', expires_at=timezone.now())
+        message.save(using=alias)
+
+        # As _finish_job loads it
+        partial = Message.objects.using(alias).only('id', 'media_thumbnail').get(id=message.id)
+        partial.media_thumbnail.name = 'thumbnails/x.jpg'
+        with self.assertNumQueries(1, using=alias):
+            partial.save(update_fields=['media_thumbnail'])
+        self.assertEqual(
+            Message.objects.using(alias).get(id=message.id).conversation_key,
+            conversation_key(alice.id, bob.id),
+        )
+
+
+class ReaperTests(TransactionTestCase):
+    databases = '__all__'
+
+    def test_each_shard_gets_the_batch_budget(self):
+        accounts = [
+            Account.objects.create(telegram_id=100 + i, first_name=f'User{i}', username=f'user{i}')
+            for i in range(4)
+        ]
+        expired = timezone.now() - timedelta(minutes=1)
+        for sender in accounts:
+            for receiver in accounts:
+                if sender != receiver:
+                    message = Message(sender=sender, receiver=receiver, message_type='image', expires_at=expired)
+                    message.save(using=message_db(sender.id, receiver.id))
+                    ThumbnailJob.objects.using(message_db(sender.id, receiver.id)).create(message=message)
+
+        stats = reap_expired(batch_size=100, max_batches=1)
+        # Messages only, not the thumbnail jobs that went with them
+        self.assertEqual(stats['last_rows'], 12)
+        self.assertEqual(stats['batches'], len(message_databases()))
+        self.assertEqual(stats['last_backlog'], 0)
+
+
+class SendMessageTests(SimpleTestCase):
+    def consumer(self):
+        consumer = ChatConsumer()
+        consumer.user_id, consumer.account_id = '111', 1
+        consumer.send = mock.AsyncMock()
+        consumer.get_telegram_id = mock.AsyncMock(return_value='222')
+        consumer.channel_layer = mock.AsyncMock()
+        return consumer
+
+    def test_invalid_expire_seconds_gets_an_error_frame(self):
+        for expire_seconds in ('soon', -5, '1e400', float('inf'), [1]):
+            consumer = self.consumer()
+            with mock.patch('accounts.consumers.get_message_batcher') as batcher:
+                asyncio.run(consumer.handle_send_message(
+                    {'to_user_id': 2, 'message': 'hi', 'message_id': 'm1', 'expire_seconds': expire_seconds}
+                ))
+            batcher.assert_not_called()
+            consumer.channel_layer.group_send.assert_not_called()
+            frame = json.loads(consumer.send.call_args.kwargs['text_data'])
+            self.assertEqual(frame, {'type': 'message_failed', 'message_id': 'm1', 'error': 'Invalid expire_seconds'})
+
+    @override_settings(CHAT_MESSAGE_MAX_TTL=3600, EPHEMERAL_MESSAGE_TTL_THRESHOLD=0)
+    def test_expire_seconds_is_capped(self):
+        consumer = self.consumer()
+        with mock.patch('accounts.consumers.get_message_batcher') as batcher, \
+                mock.patch.object(consumer, 'ack_message', mock.AsyncMock()):
+            asyncio.run(consumer.handle_send_message(
+                {'to_user_id': 2, 'message': 'hi', 'message_id': 'm1', 'expire_seconds': 10 ** 30}
+            ))
+        message = batcher.return_value.submit.call_args.args[0]
+        self.assertLessEqual(message.expires_at, timezone.now() + timedelta(seconds=3600))
+
+
+class ParseRangeTests(SimpleTestCase):
+    def test_satisfiable_ranges(self):
+        self.assertEqual(parse_range('bytes=0-99', 1000), (0, 99))
+        self.assertEqual(parse_range('bytes=900-', 1000), (900, 999))
+        self.assertEqual(parse_range('bytes=900-5000', 1000), (900, 999))
+        self.assertEqual(parse_range('bytes=-100', 1000), (900, 999))
+        self.assertEqual(parse_range('bytes=-5000', 1000), (0, 999))
+        self.assertEqual(parse_range('bytes=5-5', 1000), (5, 5))
+
+    def test_invalid_ranges_are_ignored(self):
+        for header in (
+            '', 'items=0-1', 'bytes=5-3', 'bytes=-', 'bytes=', 'bytes=abc-', 'bytes=1-x',
+            'bytes=+1-2', 'bytes=1_0-20', 'bytes=--5', 'bytes=0-1,5-6', 'bytes=5',
+        ):
+            with self.subTest(header=header):
+                self.assertIsNone(parse_range(header, 1000))
+
+    def test_unsatisfiable_ranges(self):
+        for header, size in (('bytes=1000-', 1000), ('bytes=2000-3000', 1000), ('bytes=-0', 1000), ('bytes=-5', 0)):
+            with self.subTest(header=header, size=size):
+                with self.assertRaises(RangeNotSatisfiable):
+                    parse_range(header, size)
+
+
+class ReadReceiptTests(SimpleTestCase):
+    def test_failed_flush_is_retried(self):
+        receipts = ReadReceipts()
+        receipts.pending = {(1, 2): (10, None), (1, 3): (5, 7)}
+
+        def apply_read_marks(marks):
+            # Read further while the write is failing
+            receipts.merge((1, 2), 12, 3)
+            receipts.merge((1, 3), 4, None)
+            raise RuntimeError('database is locked')
+
+        with mock.patch('accounts.receipts.apply_read_marks', side_effect=apply_read_marks):
+            with self.assertRaises(RuntimeError):
+                asyncio.run(receipts.flush())
+        self.assertEqual(receipts.pending, {(1, 2): (12, 3), (1, 3): (5, 7)})
+
+
+class MessageBatcherTests(TransactionTestCase):
+    databases = '__all__'
+
+    def setUp(self):
+        self.accounts = [
+            Account.objects.create(telegram_id=100 + i, first_name=f'User{i}', username=f'user{i}')
+            for i in range(4)
+        ]
+        self.expires_at = timezone.now() + timedelta(hours=1)
+
+    def messages(self):
+        """One message in each direction of every conversation, so every shard gets some."""
+        return [
+            Message(sender=sender, receiver=receiver, text=f'{sender.id}->{receiver.id}', expires_at=self.expires_at)
+            for sender in self.accounts for receiver in self.accounts if sender != receiver
+        ]
+
+    def submit_all(self, batcher, messages):
+        async def run():
+            futures = [batcher.submit(message) for message in messages]
+            return await asyncio.wait_for(asyncio.gather(*futures, return_exceptions=True), 5)
+        return asyncio.run(run())
+
+    def test_one_bulk_insert_per_shard(self):
+        messages = self.messages()
+        with mock.patch('accounts.batching.save_messages', wraps=batching.save_messages) as save_messages:
+            results = self.submit_all(batching.MessageBatcher(max_batch=100, max_delay=0.05), messages)
+
+        shards = {message_db(message.sender_id, message.receiver_id) for message in messages}
+        self.assertEqual(sorted(call.args[0] for call in save_messages.call_args_list), sorted(shards))
+        for alias, shard_messages in (call.args for call in save_messages.call_args_list):
+            self.assertTrue(all(message_db(m.sender_id, m.receiver_id) == alias for m in shard_messages))
+        # Each sender gets its own row back
+        self.assertEqual([result.text for result in results], [message.text for message in messages])
+        for result in results:
+            alias = message_db(result.sender_id, result.receiver_id)
+            self.assertEqual(Message.objects.using(alias).get(id=result.id).text, result.text)
+
+    def test_full_batch_does_not_wait_for_the_delay(self):
+        messages = self.messages()[:3]
+        with mock.patch('accounts.batching.save_messages', wraps=batching.save_messages) as save_messages:
+            # wait_for() in submit_all gives up long before the delay
+            results = self.submit_all(batching.MessageBatcher(max_batch=3, max_delay=60), messages)
+        self.assertTrue(all(result.id for result in results))
+        self.assertEqual(
+            sum(len(call.args[1]) for call in save_messages.call_args_list), 3,
+        )
+
+    def test_failed_bulk_insert_falls_back_to_row_by_row(self):
+        messages = self.messages()
+        bad = messages[1]
+        bad.expires_at = None  # NOT NULL: fails the bulk insert of its shard
+        with self.assertLogs('accounts.batching', 'WARNING'):
+            results = self.submit_all(batching.MessageBatcher(max_batch=100, max_delay=0.05), messages)
+
+        self.assertIsInstance(results[1], IntegrityError)
+        for message, result in zip(messages, results):
+            if message is not bad:
+                self.assertIsInstance(result, Message)
+                self.assertEqual(result.text, message.text)
+        saved = sorted(
+            text for alias in message_databases()
+            for text in Message.objects.using(alias).values_list('text', flat=True)
+        )
+        self.assertEqual(saved, sorted(message.text for message in messages if message is not bad))
+
+    def test_failed_flush_fails_every_sender(self):
+        messages = self.messages()[:2]
+        with mock.patch('accounts.batching.save_messages', side_effect=RuntimeError('disk I/O error')), \
+                self.assertLogs('accounts.batching', 'ERROR'):
+            results = self.submit_all(batching.MessageBatcher(max_batch=100, max_delay=0.05), messages)
+        self.assertEqual([type(result) for result in results], [RuntimeError, RuntimeError])
+
+
+class HistoryTests(TransactionTestCase):
+    databases = '__all__'
+
+    def setUp(self):
+        self.alice = Account.objects.create(telegram_id=111, first_name='Alice', username='alice')
+        self.bob = Account.objects.create(telegram_id=222, first_name='Bob', username='bob')
+        self.now = timezone.now()
+        self.store = EphemeralMessageStore()
+        patcher = mock.patch('accounts.history.ephemeral_store', self.store)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+        alias = message_db(self.alice.id, self.bob.id)
+        expires_at = self.now + timedelta(hours=1)
+        # Stored messages at minutes 1, 3 and 5, in-memory ones at 2, 4 and 6
+        self.ids = {}
+        for minute in (1, 3, 5):
+            message = Message(sender=self.alice, receiver=self.bob, text=f'm{minute}', expires_at=expires_at)
+            message.save(using=alias)
+            Message.objects.using(alias).filter(id=message.id).update(created_at=self.at(minute))
+            self.ids[minute] = message.id
+        for minute in (2, 4, 6):
+            row = self.store.add(self.bob.id, self.alice.id, f'e{minute}', self.at(minute), expires_at)
+            self.ids[minute] = row['id']
+
+    def at(self, minute):
+        return self.now - timedelta(minutes=10 - minute)
+
+    def page(self, **cursor):
+        rows, has_more = history_page(self.alice.id, self.bob.id, self.now, **cursor)
+        return [row['text'] for row in rows], has_more
+
+    def test_pages_hold_each_message_once(self):
+        self.assertEqual(self.page(limit=2), (['m5', 'e6'], True))
+        self.assertEqual(self.page(before=self.ids[5], limit=2), (['m3', 'e4'], True))
+        self.assertEqual(self.page(before=self.ids[3], limit=2), (['m1', 'e2'], False))
+        self.assertEqual(self.page(limit=3), (['m5', 'e6'], True))
+        self.assertEqual(self.page(limit=10), (['m1', 'e2', 'm3', 'e4', 'm5', 'e6'], False))
+
+    def test_polls_get_only_newer_messages(self):
+        self.assertEqual(self.page(after=self.ids[5]), (['e6'], False))
+        self.assertEqual(self.page(after=self.ids[1], limit=3), (['e2', 'm3'], True))
+        self.assertEqual(self.page(after=self.ids[3], limit=3), (['e4', 'm5', 'e6'], False))
+
+
+class AutocompleteTests(TransactionTestCase):
+    def test_refresh_picks_up_other_processes(self):
+        Account.objects.create(telegram_id=111, first_name='Alice', username='alice')
+        index = PrefixIndex()
+        index.warm()
+
+        # Saved by another process: no signal here
+        Account.objects.bulk_create([Account(telegram_id=222, first_name='Bob', username='bob')])
+        Account.objects.filter(username='alice').update(username='alicia', updated_at=timezone.now())
+        self.assertEqual(index.suggest('b'), [])
+
+        self.assertEqual(index.refresh(), 2)
+        self.assertEqual([row['username'] for row in index.suggest('b')], ['bob'])
+        self.assertEqual([row['username'] for row in index.suggest('ali')], ['alicia'])
+
+
+class IdentityCacheTests(TransactionTestCase):
+    def test_async_miss_is_counted_once(self):
+        alice = Account.objects.create(telegram_id=111, first_name='Alice', username='alice')
+        cache = IdentityCache()
+
+        self.assertEqual(asyncio.run(cache.aget(telegram_id=111)).id, alice.id)
+        self.assertEqual(asyncio.run(cache.aget(username='alice')).id, alice.id)
+        self.assertEqual((cache.misses, cache.hits), (1, 1))
+
+
+class ExpirySchedulerTests(TransactionTestCase):
+    databases = '__all__'
+
+    def setUp(self):
+        lock_dir = tempfile.mkdtemp(prefix='vchat_tests_')
+        self.addCleanup(shutil.rmtree, lock_dir, ignore_errors=True)
+        self.lock_path = f'{lock_dir}/expiry.lock'
+
+    def scheduler(self):
+        return ExpiryScheduler(lock_path=self.lock_path)
+
+    def send(self, alice, bob, expires_in):
+        message = Message(sender=alice, receiver=bob, text='hi', expires_at=timezone.now() + expires_in)
+        message.save(using=message_db(alice.id, bob.id))
+
+    def test_one_process_owns_database_messages(self):
+        first, second = self.scheduler(), self.scheduler()
+        self.assertTrue(first.acquire())
+        self.assertFalse(second.acquire())
+        # The owner exits
+        first.lock_file.close()
+        self.assertTrue(second.acquire())
+        second.lock_file.close()
+
+    def test_each_message_is_loaded_once(self):
+        alice = Account.objects.create(telegram_id=111, first_name='Alice', username='alice')
+        bob = Account.objects.create(telegram_id=222, first_name='Bob', username='bob')
+        self.send(alice, bob, timedelta(hours=-1))
+        self.send(alice, bob, timedelta(hours=1))
+        scheduler = self.scheduler()
+
+        self.assertEqual(scheduler.load_pending(), 1)
+        self.send(alice, bob, timedelta(hours=1))
+        self.send(alice, bob, timedelta(seconds=-1))  # expired before the next load
+        self.assertEqual(scheduler.load_pending(), 2)
+        self.assertEqual(scheduler.load_pending(), 0)
+        self.assertEqual(len(scheduler.wheel), 3)
+
+    def test_expiry_brought_forward_is_rescheduled(self):
+        alice = Account.objects.create(telegram_id=111, first_name='Alice', username='alice')
+        bob = Account.objects.create(telegram_id=222, first_name='Bob', username='bob')
+        self.send(alice, bob, timedelta(hours=1))
+        scheduler = self.scheduler()
+        self.assertEqual(scheduler.load_pending(), 1)
+
+        # Media quota eviction, possibly in another process
+        now = timezone.now()
+        alias = message_db(alice.id, bob.id)
+        message_id = Message.objects.using(alias).get().id
+        Message.objects.using(alias).update(expires_at=now)
+        self.assertEqual(scheduler.load_pending(), 1)
+        self.assertEqual(scheduler.load_pending(), 0)
+
+        self.assertEqual(scheduler.pop_expired(now.timestamp() + 1), [(message_id, '111', '222')])
+        # The original entry comes due later and is dropped
+        self.assertEqual(scheduler.pop_expired(now.timestamp() + 7200), [])
+        self.assertEqual(scheduler.load_pending(), 0)
+
+
+class TimingWheelTests(SimpleTestCase):
+    def test_entries_cascade_down_and_fire_on_their_tick(self):
+        wheel = TimingWheel(5, tick=1, slots=4, levels=3)
+        deadlines = range(6, 70)  # every level, crossing bucket boundaries
+        for deadline in deadlines:
+            wheel.add(deadline, deadline)
+        self.assertEqual(len(wheel), len(deadlines))
+
+        for now in range(6, 70):
+            self.assertEqual(wheel.advance(now), [now])
+        self.assertEqual(len(wheel), 0)
+
+    def test_deadlines_past_the_horizon_wait_in_overflow(self):
+        wheel = TimingWheel(0, tick=1, slots=4, levels=2)  # 16 ticks
+        wheel.add(100, 'far')
+        wheel.add(1000, 'farther')
+        self.assertEqual(len(wheel.overflow), 2)
+        self.assertEqual(wheel.advance(99), [])
+        self.assertEqual(wheel.advance(100), ['far'])
+        # One big jump still lands on every intermediate tick
+        self.assertEqual(wheel.advance(2000), ['farther'])
+        self.assertEqual(len(wheel), 0)
+
+    def test_fractional_deadlines_never_fire_early(self):
+        wheel = TimingWheel(0, tick=0.5, slots=4, levels=2)
+        wheel.add(1.2, 'x')
+        self.assertEqual(wheel.advance(1.4), [])
+        self.assertEqual(wheel.advance(1.5), ['x'])
+
+
+class SQLiteChannelLayerTests(SimpleTestCase):
+    def setUp(self):
+        directory = tempfile.mkdtemp(prefix='vchat_tests_')
+        self.addCleanup(shutil.rmtree, directory, ignore_errors=True)
+        self.path = f'{directory}/channels.sqlite3'
+
+    def layer(self, **config):
+        # One per worker process, all on the same file
+        layer = SQLiteChannelLayer(path=self.path, poll_interval=0.01, **config)
+        self.addCleanup(layer._executor.shutdown)
+        return layer
+
+    def receive(self, layer, channel, timeout=1):
+        return asyncio.wait_for(layer.receive(channel), timeout)
+
+    def test_capacity(self):
+        first, second = self.layer(capacity=2), self.layer(capacity=2)
+
+        async def scenario():
+            await first.send('jobs', {'type': 'job', 'n': 1})
+            await first.send('jobs', {'type': 'job', 'n': 2})
+            with self.assertRaises(ChannelFull):
+                await second.send('jobs', {'type': 'job', 'n': 3})
+            self.assertEqual((await self.receive(second, 'jobs'))['n'], 1)
+            await second.send('jobs', {'type': 'job', 'n': 3})
+
+            local = await first.new_channel()
+            await first.send(local, {'type': 'a'})
+            await first.send(local, {'type': 'b'})
+            with self.assertRaises(ChannelFull):
+                await first.send(local, {'type': 'c'})
+            await first.close()
+
+        asyncio.run(scenario())
+
+    def test_expired_messages_are_dropped(self):
+        sender, receiver = self.layer(expiry=0.05), self.layer()
+
+        async def scenario():
+            channel = await receiver.new_channel()
+            await sender.send(channel, {'type': 'late'})
+            await sender.send('jobs', {'type': 'late'})
+            await asyncio.sleep(0.1)
+            for name in (channel, 'jobs'):
+                with self.assertRaises(asyncio.TimeoutError):
+                    await self.receive(receiver, name, timeout=0.2)
+            await sender.send(channel, {'type': 'fresh'})
+            self.assertEqual(await self.receive(receiver, channel), {'type': 'fresh'})
+            await receiver.close()
+
+        asyncio.run(scenario())
+
+    def test_group_send_reaches_both_processes(self):
+        first, second = self.layer(), self.layer()
+
+        async def scenario():
+            here, there = await first.new_channel(), await second.new_channel()
+            await first.group_add('chat_111', here)
+            await second.group_add('chat_111', there)
+            await first.group_send('chat_111', {'type': 'chat_message', 'message': 'hi'})
+            received = [await self.receive(first, here), await self.receive(second, there)]
+
+            await second.group_discard('chat_111', there)
+            await first.group_send('chat_111', {'type': 'chat_message', 'message': 'again'})
+            self.assertEqual((await self.receive(first, here))['message'], 'again')
+            with self.assertRaises(asyncio.TimeoutError):
+                await self.receive(second, there, timeout=0.2)
+            await first.close()
+            await second.close()
+            return received
+
+        self.assertEqual([event['message'] for event in asyncio.run(scenario())], ['hi', 'hi'])
+
+    def test_flush(self):
+        first, second = self.layer(), self.layer()
+
+        async def scenario():
+            there = await second.new_channel()
+            await second.group_add('chat_111', there)
+            await first.send('jobs', {'type': 'job'})
+            await first.flush()
+
+            await first.group_send('chat_111', {'type': 'chat_message'})
+            with self.assertRaises(asyncio.TimeoutError):
+                await self.receive(second, there, timeout=0.2)
+            with self.assertRaises(asyncio.TimeoutError):
+                await self.receive(second, 'jobs', timeout=0.2)
+            await second.close()
+
+        asyncio.run(scenario())
@@ -0,0 +1,224 @@
+# accounts/thumbnails.py
+"""
+Thumbnail pipeline for media messages.
+
+Completing an upload inserts a ``ThumbnailJob`` row in the same transaction
+as the ``Message``. ``ThumbnailWorker`` claims pending jobs in batches with a
+single ``UPDATE``, which is safe with several workers. It renders them in a
+``spawn`` process pool (``accounts.imaging``), so image decoding never runs
+on the event loop or holds the GIL of the web process. Results are saved to
+``Message.media_thumbnail``, and both participants get a ``thumbnail_ready``
+event over the channel layer.
+
+The ASGI process runs a worker when ``THUMBNAIL_WORKER_ENABLED`` is set;
+``manage.py thumbnail_worker`` runs one standalone. Jobs left ``running`` by
+a crashed worker are claimed again after ``THUMBNAIL_JOB_TIMEOUT`` seconds,
+up to ``THUMBNAIL_MAX_ATTEMPTS`` attempts in all; after that they are
+marked ``failed``, so an image that kills the renderer can't loop forever.
+"""
+import asyncio
+import logging
+import multiprocessing
+import os
+import socket
+import tempfile
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from datetime import timedelta
+
+from channels.layers import get_channel_layer
+from django.conf import settings
+from django.core.files import File
+from django.db.models import F, Q
+from django.utils import timezone
+
+from .db_executor import db_writer
+from .identity import identity_cache
+from .imaging import render_thumbnail
+from .media import media_url
+from .models import Message, ThumbnailJob
+from .sharding import message_databases, message_db_for_id
+from .storage import media_storage
+
+logger = logging.getLogger(__name__)
+
+
+def _stale(now):
+    stale = now - timedelta(seconds=getattr(settings, 'THUMBNAIL_JOB_TIMEOUT', 300))
+    return Q(status=ThumbnailJob.RUNNING, started_at__lt=stale)
+
+
+def _claimable(now):
+    max_attempts = getattr(settings, 'THUMBNAIL_MAX_ATTEMPTS', 3)
+    return Q(status=ThumbnailJob.PENDING) | (_stale(now) & Q(attempts__lt=max_attempts))
+
+
+def _claim_shard_jobs(alias, token, limit):
+    now = timezone.now()
+    jobs = ThumbnailJob.objects.using(alias)
+    # Timed out on their last attempt
+    jobs.filter(_stale(now), attempts__gte=getattr(settings, 'THUMBNAIL_MAX_ATTEMPTS', 3)).update(
+        status=ThumbnailJob.FAILED,
+        error='Timed out',
+        finished_at=now,
+    )
+    oldest = jobs.filter(_claimable(now)).order_by('id').values('id')[:limit]
+    claimed = jobs.filter(_claimable(now), id__in=oldest).update(
+        status=ThumbnailJob.RUNNING,
+        claimed_by=token,
+        started_at=now,
+        attempts=F('attempts') + 1,
+    )
+    if not claimed:
+        return []
+    return list(jobs.filter(
+        claimed_by=token, status=ThumbnailJob.RUNNING, started_at=now
+    ).values(
+        'id', 'attempts', 'message_id', 'message__message_type', 'message__media_file',
+        'message__sender_id', 'message__receiver_id',
+    ))
+
+
+async def claim_jobs(token, limit):
+    """Claim up to ``limit`` jobs from each message shard."""
+    claimed = await asyncio.gather(*(
+        db_writer.using(alias)(_claim_shard_jobs)(alias, token, limit)
+        for alias in message_databases()
+    ))
+    return [job for jobs in claimed for job in jobs]
+
+
+def _finish_job(job, thumbnail_path, error):
+    now = timezone.now()
+    alias = message_db_for_id(job['message_id'])
+    jobs = ThumbnailJob.objects.using(alias).filter(id=job['id'])
+    if error:
+        retry = job['attempts'] < getattr(settings, 'THUMBNAIL_MAX_ATTEMPTS', 3)
+        jobs.update(
+            status=ThumbnailJob.PENDING if retry else ThumbnailJob.FAILED,
+            error=error,
+            finished_at=None if retry else now,
+        )
+        return None
+
+    message = Message.objects.using(alias).filter(id=job['message_id']).only('id', 'media_thumbnail').first()
+    if message is None:
+        # Expired while we were rendering; the job went with it
+        return None
+    with open(thumbnail_path, 'rb') as f:
+        name = os.path.splitext(os.path.basename(job['message__media_file']))[0] + '.jpg'
+        message.media_thumbnail.save(name, File(f), save=False)
+    try:
+        # Fails if the message was deleted meanwhile
+        message.save(update_fields=['media_thumbnail'])
+    except Exception:
+        media_storage.release(message.media_thumbnail.name)
+        raise
+    jobs.update(status=ThumbnailJob.DONE, error=None, finished_at=now)
+    return media_url(message.id, thumbnail=True)
+
+
+async def finish_job(job, thumbnail_path, error):
+    """Store the rendered thumbnail (or the failure); returns the thumbnail URL or None."""
+    alias = message_db_for_id(job['message_id'])
+    return await db_writer.using(alias)(_finish_job)(job, thumbnail_path, error)
+
+
+class ThumbnailWorker:
+    def __init__(self, processes=None, batch_size=None, size=None, poll_interval=None):
+        self.processes = processes or getattr(settings, 'THUMBNAIL_WORKERS', 2)
+        self.batch_size = batch_size or getattr(settings, 'THUMBNAIL_BATCH_SIZE', 8)
+        self.size = size or getattr(settings, 'THUMBNAIL_SIZE', 320)
+        self.poll_interval = poll_interval or getattr(settings, 'THUMBNAIL_POLL_INTERVAL', 1.0)
+        self.token = f'{socket.gethostname()}:{os.getpid()}'
+        self.pool = None
+        self.running = False
+        self.processed = 0
+        self.failed = 0
+        self.finished = deque(maxlen=10000)  # monotonic completion times
+
+    def get_pool(self):
+        if self.pool is None:
+            self.pool = ProcessPoolExecutor(
+                max_workers=self.processes,
+                mp_context=multiprocessing.get_context('spawn'),
+            )
+        return self.pool
+
+    async def run(self, once=False):
+        """Process jobs until the queue is empty (``once``) or forever."""
+        self.running = True
+        try:
+            while True:
+                jobs = await claim_jobs(self.token, self.batch_size)
+                if jobs:
+                    await asyncio.gather(*(self.process(job) for job in jobs))
+                elif once:
+                    return
+                else:
+                    await asyncio.sleep(self.poll_interval)
+        finally:
+            self.running = False
+
+    async def process(self, job):
+        loop = asyncio.get_running_loop()
+        storage = Message._meta.get_field('media_file').storage
+        fd, thumbnail_path = tempfile.mkstemp(suffix='.jpg')
+        os.close(fd)
+        try:
+            try:
+                await loop.run_in_executor(
+                    self.get_pool(), render_thumbnail,
+                    job['message__message_type'], storage.path(job['message__media_file']),
+                    thumbnail_path, self.size,
+                )
+                error = None
+            except Exception as e:
+                error = f'{type(e).__name__}: {e}'
+                logger.warning(f"⚠️ Thumbnail for message {job['message_id']} failed: {error}")
+
+            url = await finish_job(job, thumbnail_path, error)
+        finally:
+            os.remove(thumbnail_path)
+
+        self.finished.append(time.monotonic())
+        if error:
+            self.failed += 1
+            return
+        self.processed += 1
+        if url:
+            await self.notify(job, url)
+
+    async def notify(self, job, url):
+        channel_layer = get_channel_layer()
+        for account_id in (job['message__sender_id'], job['message__receiver_id']):
+            identity = await identity_cache.aget(id=account_id)
+            if identity is None:
+                continue
+            await channel_layer.group_send(
+                f'chat_{identity.telegram_id}',
+                {
+                    'type': 'thumbnail_ready',
+                    'message_id': job['message_id'],
+                    'thumbnail_url': url,
+                }
+            )
+
+    def stats(self):
+        cutoff = time.monotonic() - 60
+        recent = sum(1 for finished_at in self.finished if finished_at >= cutoff)
+        return {
+            'running': self.running,
+            'processes': self.processes,
+            'queue_depth': sum(
+                ThumbnailJob.objects.using(alias).filter(status=ThumbnailJob.PENDING).count()
+                for alias in message_databases()
+            ),
+            'processed': self.processed,
+            'failed': self.failed,
+            'jobs_per_sec': round(recent / 60, 3),
+        }
+
+
+thumbnail_worker = ThumbnailWorker()
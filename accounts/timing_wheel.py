@@ -0,0 +1,78 @@
+# accounts/timing_wheel.py
+"""
+Hierarchical timing wheel.
+
+Deadlines are bucketed by tick number. Level ``l`` has ``slots`` buckets of
+``slots ** l`` ticks each; an entry goes to the lowest level whose bucket
+range still contains it, so ``add`` is O(1) regardless of how many entries
+are pending. When time crosses a bucket boundary of a higher level, that
+bucket's entries are cascaded one level down, until they reach level 0 and
+fire. Deadlines past the top level's horizon wait in an overflow list.
+"""
+import math
+
+
+class TimingWheel:
+    def __init__(self, start, tick=1.0, slots=64, levels=4):
+        self.tick = tick
+        self.slots = slots
+        self.levels = levels
+        self.current = int(start // tick)
+        self.wheels = [[[] for _ in range(slots)] for _ in range(levels)]
+        self.overflow = []
+        self.due = []
+        self.size = 0
+
+    def add(self, deadline, item):
+        # Round up so nothing fires before its deadline (at most one tick late)
+        self._place(math.ceil(deadline / self.tick), item)
+        self.size += 1
+
+    def _place(self, tick, item):
+        if tick <= self.current:
+            self.due.append(item)
+            return
+        span = 1
+        for level in range(self.levels):
+            # Same digits above this level => the bucket is still ahead of us
+            if tick // (span * self.slots) == self.current // (span * self.slots):
+                self.wheels[level][(tick // span) % self.slots].append((tick, item))
+                return
+            span *= self.slots
+        self.overflow.append((tick, item))
+
+    def advance(self, now):
+        """Move the wheel to ``now`` and return every item that became due."""
+        target = int(now // self.tick)
+        while self.current < target:
+            self.current += 1
+            self._cascade()
+            bucket = self.wheels[0][self.current % self.slots]
+            if bucket:
+                self.due.extend(item for _, item in bucket)
+                bucket.clear()
+
+        fired, self.due = self.due, []
+        self.size -= len(fired)
+        return fired
+
+    def _cascade(self):
+        top_span = self.slots ** self.levels
+        if self.overflow and self.current % top_span == 0:
+            pending, self.overflow = self.overflow, []
+            for tick, item in pending:
+                self._place(tick, item)
+
+        for level in range(self.levels - 1, 0, -1):
+            span = self.slots ** level
+            if self.current % span:
+                continue
+            bucket = self.wheels[level][(self.current // span) % self.slots]
+            if bucket:
+                entries = bucket[:]
+                bucket.clear()
+                for tick, item in entries:
+                    self._place(tick, item)
+
+    def __len__(self):
+        return self.size
@@ -0,0 +1,226 @@
+# accounts/uploads.py
+"""
+Chunked, resumable media uploads.
+
+A client creates a ``MediaUpload``, then sends the file as raw request
+bodies tagged with their ``Upload-Offset``, in order. A lost connection
+only costs the chunk in flight: the current offset can be read back and
+the upload resumed from it. Each chunk is copied straight from the request
+stream into ``MEDIA_UPLOAD_TEMP_DIR/<id>.part`` in ``COPY_BUFFER`` pieces.
+Under ASGI, Django spools request bodies above ``FILE_UPLOAD_MAX_MEMORY_SIZE``
+to disk, so memory per upload stays constant whatever the file size.
+
+The SHA-256 of the file is updated as chunks arrive. A process whose
+state is behind ``MediaUpload.received`` (restart, or chunks handled by
+another worker) re-hashes the part file from disk, also in pieces.
+Completion moves the part file into ``Message.media_file`` (stored under
+that hash, see ``accounts.storage``) with a rename and queues a
+``ThumbnailJob``. ``acomplete_upload()`` does the hashing and the move on
+``consumer_db``; only the saves go to the single writer, whose open
+transaction would otherwise hold up every write while a large file is
+hashed.
+"""
+import hashlib
+import mimetypes
+import os
+import threading
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.files import File
+from django.db import transaction
+from django.db.models import Sum
+from django.utils import timezone
+
+from .db_executor import consumer_db, db_writer
+from .models import MediaUpload, Message, ThumbnailJob
+from .sharding import message_databases, message_db
+from .storage import media_storage
+
+COPY_BUFFER = 64 * 1024
+
+
+class OffsetMismatch(Exception):
+    def __init__(self, offset):
+        super().__init__(f"Expected offset {offset}")
+        self.offset = offset
+
+
+class _PartFile(File):
+    # FileSystemStorage moves files that have a temporary_file_path() instead of copying them
+    def temporary_file_path(self):
+        return self.file.name
+
+
+class _UploadState:
+    def __init__(self, offset, hasher):
+        self.lock = threading.Lock()
+        self.offset = offset
+        self.hasher = hasher
+
+
+_states = {}
+_states_lock = threading.Lock()
+
+
+def part_path(upload_id):
+    return os.path.join(settings.MEDIA_UPLOAD_TEMP_DIR, f'{upload_id}.part')
+
+
+def media_type(file_name):
+    """'image' or 'video' from the file name, None for anything else."""
+    mime, _ = mimetypes.guess_type(file_name)
+    if mime:
+        kind = mime.split('/')[0]
+        if kind in ('image', 'video'):
+            return kind
+    return None
+
+
+def user_media_usage(user_id):
+    """Bytes of live media sent by the user plus uploads still in progress."""
+    sent = sum(
+        Message.objects.using(alias).filter(
+            sender_id=user_id, message_type__in=('image', 'video'), expires_at__gt=timezone.now()
+        ).aggregate(total=Sum('file_size'))['total'] or 0
+        for alias in message_databases()
+    )
+    pending = MediaUpload.objects.filter(
+        uploader_id=user_id, message__isnull=True
+    ).aggregate(total=Sum('file_size'))['total']
+    return sent + (pending or 0)
+
+
+def create_part_file(upload_id):
+    os.makedirs(settings.MEDIA_UPLOAD_TEMP_DIR, exist_ok=True)
+    open(part_path(upload_id), 'wb').close()
+
+
+def _hash_prefix(path, length):
+    hasher = hashlib.sha256()
+    with open(path, 'rb') as f:
+        while length > 0:
+            data = f.read(min(COPY_BUFFER, length))
+            if not data:
+                break
+            hasher.update(data)
+            length -= len(data)
+    return hasher
+
+
+def _state(upload):
+    with _states_lock:
+        state = _states.get(upload.id)
+        if state is None or state.offset != upload.received:
+            # New to this process, or other workers took chunks since: rebuild the hash from disk
+            state = _states[upload.id] = _UploadState(
+                upload.received, _hash_prefix(part_path(upload.id), upload.received)
+            )
+        return state
+
+
+def write_chunk(upload, stream, offset, length):
+    """
+    Append ``length`` bytes from ``stream`` at ``offset``; returns the new
+    offset. Raises ``OffsetMismatch`` if the client is out of step.
+    """
+    state = _state(upload)
+    with state.lock:
+        if offset != state.offset:
+            raise OffsetMismatch(state.offset)
+        if offset + length > upload.file_size:
+            raise ValueError("Chunk goes past the declared file size")
+
+        written = 0
+        with open(part_path(upload.id), 'r+b') as f:
+            # Drop bytes of a chunk that failed half way
+            f.seek(offset)
+            f.truncate()
+            while written < length:
+                data = stream.read(min(COPY_BUFFER, length - written))
+                if not data:
+                    break
+                f.write(data)
+                state.hasher.update(data)
+                written += len(data)
+
+        if written != length:
+            # Client went away mid-chunk; the hash can't be rewound
+            with _states_lock:
+                _states.pop(upload.id, None)
+            raise ValueError(f"Chunk truncated: got {written} of {length} bytes")
+
+        state.offset = offset + written
+        return state.offset
+
+
+def store_upload(upload):
+    """
+    Check the received file and store it as the media of a new, unsaved
+    ``Message``; returns the message. Re-hashing and moving a large file
+    take a while, so this runs outside any write transaction.
+    """
+    state = _state(upload)
+    with state.lock:
+        if state.offset != upload.file_size or os.path.getsize(part_path(upload.id)) != upload.file_size:
+            # The digest would cover only part of the file
+            raise ValueError(f"Upload incomplete: {state.offset} of {upload.file_size} bytes hashed")
+        upload.sha256 = state.hasher.hexdigest()
+        message = Message(
+            sender_id=upload.uploader_id,
+            receiver_id=upload.receiver_id,
+            message_type=upload.message_type,
+            file_name=upload.file_name,
+            file_size=upload.file_size,
+            expires_at=timezone.now() + timedelta(seconds=upload.expire_seconds),
+        )
+        with open(part_path(upload.id), 'rb') as f:
+            part = _PartFile(f)
+            # Content-addressed storage uses it instead of reading the file again
+            part.sha256 = upload.sha256
+            message.media_file.save(upload.file_name, part, save=False)
+    return message
+
+
+def save_upload_message(upload, message):
+    """Save the message from ``store_upload()`` and queue its thumbnail; returns it."""
+    alias = message_db(upload.uploader_id, upload.receiver_id)
+    try:
+        with transaction.atomic(using=alias):
+            message.save(using=alias)
+            # Rendered later by the thumbnail worker
+            ThumbnailJob.objects.using(alias).create(message=message)
+    except Exception:
+        # The blob reference was taken outside this transaction
+        media_storage.release(message.media_file.name)
+        raise
+    # MediaUpload stays on the default database when messages are sharded
+    upload.message = message
+    upload.save(update_fields=['sha256', 'message', 'updated_at'])
+    return message
+
+
+def complete_upload(upload):
+    """Turn a fully received upload into a media ``Message``; returns it."""
+    message = save_upload_message(upload, store_upload(upload))
+    # Still there if the blob was stored already
+    discard_upload(upload.id)
+    return message
+
+
+async def acomplete_upload(upload):
+    """``complete_upload()`` with only the saves on the writer of the message's shard."""
+    message = await consumer_db(store_upload)(upload)
+    writer = db_writer.using(message_db(upload.uploader_id, upload.receiver_id))
+    message = await writer(save_upload_message)(upload, message)
+    await consumer_db(discard_upload)(upload.id)
+    return message
+
+
+def discard_upload(upload_id):
+    with _states_lock:
+        _states.pop(upload_id, None)
+    try:
+        os.remove(part_path(upload_id))
+    except FileNotFoundError:
+        pass
@@ -15,6 +15,7 @@ urlpatterns = [
     
     # 🔍 Search
     path('api/search/users/', views.search_users, name='search_users'),
+    path('api/search/suggest/', views.suggest_users, name='suggest_users'),
     
     # 👥 Contacts
     path('api/contacts/add/', views.add_contact, name='add_contact'),
@@ -25,4 +26,16 @@ urlpatterns = [
     # 💬 Messages
     path('api/messages/<int:contact_id>/', views.get_messages, name='get_messages'),
     path('api/messages/send/', views.send_message, name='send_message'),  # ✅ NEW
+    path('api/messages/read/', views.mark_read, name='mark_read'),
+    path('api/conversations/', views.get_conversations, name='get_conversations'),
+    
+    # 📎 Media
+    path('api/media/uploads/', views.create_upload, name='create_upload'),
+    path('api/media/uploads/<uuid:upload_id>/', views.upload_chunk, name='upload_chunk'),
+    path('api/media/uploads/<uuid:upload_id>/complete/', views.finish_upload, name='finish_upload'),
+    path('api/media/<int:message_id>/', views.serve_media, name='serve_media'),
+    path('api/media/<int:message_id>/thumbnail/', views.serve_thumbnail, name='serve_thumbnail'),
+    
+    # 📊 Metrics
+    path('api/metrics/', views.metrics, name='metrics'),
 ]
\ No newline at end of file
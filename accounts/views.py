@@ -1,13 +1,37 @@
 # accounts/views.py
-from django.http import JsonResponse
+from django.conf import settings
+from django.http import HttpResponse, HttpResponseNotModified, JsonResponse
 from django.views.decorators.csrf import csrf_exempt
 from django.views.decorators.http import require_http_methods
+from django.utils.http import parse_etags
 from django.shortcuts import render
-from rest_framework_simplejwt.tokens import RefreshToken
 from django.db.models import Q
+from rest_framework_simplejwt.tokens import RefreshToken
+from asgiref.sync import sync_to_async
+from channels.layers import get_channel_layer
 import json
 import logging
-from .models import Account, Contact, Message
+import mimetypes
+import os
+from .models import Account, Contact, MediaUpload, Message
+from .autocomplete import autocomplete_index
+from .contact_cache import contact_cache
+from .conversations import aconversation_summaries
+from .batching import get_message_batcher
+from .db_executor import consumer_db, db_writer
+from .expiry import expiry_scheduler
+from .identity import identity_cache
+from .media import media_response, media_url
+from .media_gc import media_collector
+from .querycount import query_report
+from .reaper import reaper_stats
+from .receipts import apply_read_marks, parse_read_mark
+from .search import search_accounts
+from .serialization import JSONResponse, StreamingJSONResponse
+from .sharding import message_db_for_id
+from .thumbnails import thumbnail_worker
+from .uploads import OffsetMismatch, acomplete_upload, create_part_file, media_type, user_media_usage, write_chunk
+from .history import DEFAULT_PAGE_SIZE, MAX_PAGE_SIZE, ahistory_page, page_cursor
 from django.utils import timezone
 from datetime import timedelta
 
@@ -42,7 +66,7 @@ def chat(request):
 # ========================
 @csrf_exempt
 @require_http_methods(["POST"])
-def telegram_auth_api(request):
+async def telegram_auth_api(request):
     """Telegram authentication"""
     logger.info("📨 Telegram auth request")
     
@@ -57,7 +81,7 @@ def telegram_auth_api(request):
             return JsonResponse({'success': False, 'error': 'Missing fields'}, status=400)
         
         # Create/Update user
-        user, created = Account.objects.get_or_create(
+        user, created = await Account.objects.aget_or_create(
             telegram_id=telegram_id,
             defaults={
                 'first_name': first_name,
@@ -71,51 +95,18 @@ def telegram_auth_api(request):
             user.last_name = last_name
             user.username = username
             user.is_online = True
-            user.save()
-        
-        # Generate tokens
-        tokens = get_tokens_for_user(user)
+            await user.asave()
         
-        # Get user's accepted contacts
-        accepted_contacts = Contact.objects.filter(
-            user=user, 
-            is_accepted=True
-        ).select_related('contact')
+        # Generate tokens (simplejwt writes an OutstandingToken row)
+        tokens = await sync_to_async(get_tokens_for_user)(user)
         
-        # Get pending requests (where user is the receiver)
-        pending_requests = Contact.objects.filter(
-            contact=user,
-            is_accepted=False
-        ).select_related('user')
-        
-        # Combine all contacts
-        contacts_data = []
-        
-        # Add accepted contacts
-        for c in accepted_contacts:
-            contacts_data.append({
-                'id': c.contact.id,
-                'user_id': c.user.id,
-                'telegram_id': c.contact.telegram_id,
-                'name': c.custom_name or c.contact.first_name,
-                'username': c.contact.username,
-                'is_online': c.contact.is_online,
-                'is_accepted': True,
-                'pending_from_them': False
-            })
-        
-        # Add pending requests
-        for c in pending_requests:
-            contacts_data.append({
-                'id': c.user.id,
-                'user_id': c.user.id,
-                'telegram_id': c.user.telegram_id,
-                'name': c.custom_name or c.user.first_name,
-                'username': c.user.username,
-                'is_online': c.user.is_online,
-                'is_accepted': False,
-                'pending_from_them': True  # This is a request from them to us
-            })
+        # Accepted contacts + requests to this user, from the shared contact list
+        contact_list = await contact_cache.aget(user.id)
+        contacts_data = [
+            {key: value for key, value in row.items() if key != 'last_seen'}
+            for row in contact_list.rows
+            if row['is_accepted'] or row['pending_from_them']
+        ]
         
         response_data = {
             'success': True,
@@ -130,7 +121,7 @@ def telegram_auth_api(request):
             'contacts': contacts_data
         }
         
-        response = JsonResponse(response_data)
+        response = JSONResponse(response_data)
         
         # Set cookies
         response.set_cookie('access_token', tokens['access'], max_age=7*24*60*60, path='/', samesite='Lax')
@@ -156,14 +147,17 @@ def logout_api(request):
     try:
         user_id = request.COOKIES.get('user_id')
         if user_id:
-            try:
-                user = Account.objects.get(id=user_id)
-                user.is_online = False
-                user.last_seen = timezone.now()
-                user.save()
-                logger.info(f"✅ User {user} set offline")
-            except Account.DoesNotExist:
-                pass
+            user = identity_cache.get(id=user_id)
+            if user:
+                # Only the presence columns, no full-row save()
+                last_seen = timezone.now()
+                Account.objects.filter(id=user.id).update(
+                    is_online=False,
+                    last_seen=last_seen
+                )
+                # update() skips the cached contact lists that show this user
+                contact_cache.set_presence(user.telegram_id, False, last_seen)
+                logger.info(f"✅ User {user.first_name} ({user.telegram_id}) set offline")
         
         response = JsonResponse({'success': True, 'message': 'Logged out'})
         
@@ -183,7 +177,7 @@ def logout_api(request):
 # ========================
 @csrf_exempt
 @require_http_methods(["POST"])
-def search_users(request):
+async def search_users(request):
     """Search users by username, telegram_id, or first_name"""
     logger.info("🔍 Search users request")
     
@@ -204,31 +198,22 @@ def search_users(request):
         user_id = request.COOKIES.get('user_id')
         
         # Build search query
-        if search_type == 'username':
-            # Remove @ if present
-            if search_value.startswith('@'):
-                search_value = search_value[1:]
-            
-            users = Account.objects.filter(
-                Q(username__icontains=search_value) | 
-                Q(first_name__icontains=search_value)
-            )
-        elif search_type == 'telegram_id':
+        if search_type == 'telegram_id':
             users = Account.objects.filter(telegram_id=search_value)
+            # Exclude current user
+            if user_id:
+                users = users.exclude(id=user_id)
+            users = [u async for u in users[:10]]
         else:
-            users = Account.objects.filter(
-                Q(username__icontains=search_value) | 
-                Q(first_name__icontains=search_value)
+            # "@name" is a username prefix, anything else a substring of the names
+            prefix = search_type == 'username' and search_value.startswith('@')
+            users = await sync_to_async(search_accounts)(
+                search_value.lstrip('@') if prefix else search_value,
+                prefix=prefix,
+                exclude_id=user_id,
             )
         
-        # Exclude current user
-        if user_id:
-            users = users.exclude(id=user_id)
-        
-        # Limit results
-        users = users[:10]
-        
-        logger.info(f"Found {users.count()} users")
+        logger.info(f"Found {len(users)} users")
         
         results = [{
             'id': u.id,
@@ -241,7 +226,7 @@ def search_users(request):
         } for u in users]
         
         logger.info(f"✅ Returning {len(results)} results")
-        return JsonResponse({
+        return JSONResponse({
             'success': True,
             'results': results,
             'total': len(results)
@@ -253,6 +238,28 @@ def search_users(request):
         traceback.print_exc()
         return JsonResponse({'success': False, 'error': str(e), 'results': []}, status=500)
 
+@require_http_methods(["GET"])
+async def suggest_users(request):
+    """Username / first name suggestions while typing (in-memory, no DB)"""
+    q = request.GET.get('q', '').strip().lstrip('@')
+    if not q:
+        return JsonResponse({'success': True, 'results': []})
+    
+    try:
+        limit = min(int(request.GET.get('limit', settings.AUTOCOMPLETE_LIMIT)), 50)
+        user_id = int(request.COOKIES['user_id']) if request.COOKIES.get('user_id') else None
+    except ValueError:
+        return JsonResponse({'success': False, 'error': 'Invalid parameters'}, status=400)
+    
+    if autocomplete_index.ready:
+        results = autocomplete_index.suggest(q, limit=limit, exclude_id=user_id)
+    else:
+        # Index still warming: answer from the search index instead
+        users = await sync_to_async(search_accounts)(q, prefix=True, exclude_id=user_id, limit=limit)
+        results = [{'id': u.id, 'username': u.username or '', 'first_name': u.first_name} for u in users]
+    
+    return JsonResponse({'success': True, 'results': results})
+
 # ========================
 # 👥 CONTACTS
 # ========================
@@ -276,18 +283,16 @@ def add_contact(request):
         if not contact_username:
             return JsonResponse({'success': False, 'error': 'Username required'}, status=400)
         
-        try:
-            user = Account.objects.get(id=user_id)
-        except Account.DoesNotExist:
+        user = identity_cache.get(id=user_id)
+        if not user:
             return JsonResponse({'success': False, 'error': 'User not found'}, status=404)
         
         # Remove @ if present
         if contact_username.startswith('@'):
             contact_username = contact_username[1:]
         
-        try:
-            contact = Account.objects.get(username=contact_username)
-        except Account.DoesNotExist:
+        contact = identity_cache.get(username=contact_username)
+        if not contact:
             logger.warning(f"❌ Contact not found: {contact_username}")
             return JsonResponse({'success': False, 'error': 'User not found'}, status=404)
         
@@ -295,7 +300,7 @@ def add_contact(request):
             return JsonResponse({'success': False, 'error': 'Cannot add yourself'}, status=400)
         
         # Check if already exists
-        existing = Contact.objects.filter(user=user, contact=contact).first()
+        existing = Contact.objects.filter(user_id=user.id, contact_id=contact.id).first()
         if existing:
             if existing.is_accepted:
                 return JsonResponse({'success': False, 'error': 'Already a contact'}, status=400)
@@ -304,13 +309,13 @@ def add_contact(request):
         
         # Create contact request
         contact_obj = Contact.objects.create(
-            user=user,
-            contact=contact,
+            user_id=user.id,
+            contact_id=contact.id,
             custom_name=custom_name or contact.first_name,
             is_accepted=False
         )
         
-        logger.info(f"✅ Contact request created: {user} -> {contact}")
+        logger.info(f"✅ Contact request created: {user.id} -> {contact.id}")
         return JsonResponse({
             'success': True,
             'message': 'Contact request sent',
@@ -358,13 +363,14 @@ def accept_contact(request):
         contact_request.save()
         
         # Create reverse contact (so both can message each other)
+        from_user = identity_cache.get(id=from_user_id)
         Contact.objects.get_or_create(
             user_id=user_id,
             contact_id=from_user_id,
             defaults={
                 'is_accepted': True, 
                 'accepted_at': timezone.now(),
-                'custom_name': contact_request.user.first_name
+                'custom_name': from_user.first_name if from_user else None
             }
         )
         
@@ -412,7 +418,7 @@ def reject_contact(request):
 
 @csrf_exempt
 @require_http_methods(["GET"])
-def get_contacts(request):
+async def get_contacts(request):
     """Get user's contacts (accepted + pending requests)"""
     logger.info("📋 Get contacts")
     
@@ -421,70 +427,17 @@ def get_contacts(request):
         if not user_id:
             return JsonResponse({'success': False, 'error': 'Not authenticated'}, status=401)
         
-        # Get accepted contacts
-        accepted = Contact.objects.filter(
-            user_id=user_id,
-            is_accepted=True
-        ).select_related('contact').order_by('-accepted_at')
-        
-        # Get pending requests TO this user (from others)
-        pending_from_them = Contact.objects.filter(
-            contact_id=user_id,
-            is_accepted=False
-        ).select_related('user').order_by('-created_at')
+        contact_list = await contact_cache.aget(user_id)
         
-        # Get pending requests FROM this user (to others)
-        pending_from_me = Contact.objects.filter(
-            user_id=user_id,
-            is_accepted=False
-        ).select_related('contact').order_by('-created_at')
-        
-        contacts_data = []
-        
-        # Add accepted contacts
-        for c in accepted:
-            contacts_data.append({
-                'id': c.contact.id,
-                'user_id': c.user.id,
-                'telegram_id': c.contact.telegram_id,
-                'name': c.custom_name or c.contact.first_name,
-                'username': c.contact.username,
-                'is_online': c.contact.is_online,
-                'last_seen': c.contact.last_seen.isoformat() if c.contact.last_seen else None,
-                'is_accepted': True,
-                'pending_from_them': False
-            })
-        
-        # Add pending requests (FROM them TO me)
-        for c in pending_from_them:
-            contacts_data.append({
-                'id': c.user.id,
-                'user_id': c.user.id,
-                'telegram_id': c.user.telegram_id,
-                'name': c.custom_name or c.user.first_name,
-                'username': c.user.username,
-                'is_online': c.user.is_online,
-                'last_seen': c.user.last_seen.isoformat() if c.user.last_seen else None,
-                'is_accepted': False,
-                'pending_from_them': True  # Show accept/reject buttons
-            })
-        
-        # Add pending requests (FROM me TO them)
-        for c in pending_from_me:
-            contacts_data.append({
-                'id': c.contact.id,
-                'user_id': c.user.id,
-                'telegram_id': c.contact.telegram_id,
-                'name': c.custom_name or c.contact.first_name,
-                'username': c.contact.username,
-                'is_online': c.contact.is_online,
-                'last_seen': c.contact.last_seen.isoformat() if c.contact.last_seen else None,
-                'is_accepted': False,
-                'pending_from_them': False  # Just show "Pending" badge
-            })
-        
-        logger.info(f"✅ Found {len(contacts_data)} contacts/requests")
-        return JsonResponse({'success': True, 'contacts': contacts_data})
+        # Client already has this version
+        if contact_list.etag in parse_etags(request.headers.get('If-None-Match', '')):
+            response = HttpResponseNotModified()
+        else:
+            logger.info(f"✅ Found {len(contact_list.rows)} contacts/requests")
+            response = HttpResponse(contact_list.body, content_type='application/json')
+        response['ETag'] = contact_list.etag
+        response['Cache-Control'] = 'private, no-cache'
+        return response
     
     except Exception as e:
         logger.error(f"❌ Get contacts error: {str(e)}")
@@ -497,7 +450,7 @@ def get_contacts(request):
 # ========================
 @csrf_exempt
 @require_http_methods(["GET"])
-def get_messages(request, contact_id):
+async def get_messages(request, contact_id):
     """Get messages with a specific contact"""
     logger.info(f"💬 Get messages with contact {contact_id}")
     
@@ -506,34 +459,41 @@ def get_messages(request, contact_id):
         if not user_id:
             return JsonResponse({'success': False, 'error': 'Not authenticated'}, status=401)
         
-        # Get messages between user and contact
-        messages = Message.objects.filter(
-            Q(sender_id=user_id, receiver_id=contact_id) |
-            Q(sender_id=contact_id, receiver_id=user_id)
-        ).order_by('created_at')
-        
-        # Delete expired messages
+        # Cursor params: ?before=<id> | ?after=<id>, &limit=<n>
+        try:
+            before = int(request.GET['before']) if request.GET.get('before') else None
+            after = int(request.GET['after']) if request.GET.get('after') else None
+            limit = int(request.GET.get('limit', DEFAULT_PAGE_SIZE))
+        except ValueError:
+            return JsonResponse({'success': False, 'error': 'Invalid cursor'}, status=400)
+        limit = max(1, min(limit, MAX_PAGE_SIZE))
+        
+        # Expired rows are deleted by the background reaper (accounts/reaper.py)
         now = timezone.now()
-        expired = messages.filter(expires_at__lt=now)
-        expired_count = expired.count()
-        if expired_count > 0:
-            logger.info(f"🗑️ Deleting {expired_count} expired messages")
-            expired.delete()
-        
-        # Get remaining messages
-        messages = messages.filter(expires_at__gte=now)
-        
-        messages_data = [{
-            'id': m.id,
-            'content': m.text,
-            'sender_id': m.sender_id,
-            'is_read': m.is_read,
-            'created_at': m.created_at.isoformat(),
-            'expires_at': m.expires_at.isoformat(),
-        } for m in messages]
-        
-        logger.info(f"✅ Found {len(messages_data)} messages")
-        return JsonResponse({'success': True, 'messages': messages_data})
+        
+        # Get one page of unexpired messages
+        rows, has_more = await ahistory_page(
+            user_id, contact_id, now,
+            before=before, after=after, limit=limit
+        )
+        
+        def message_data(m):
+            return {
+                'id': m['id'],
+                'content': m['text'],
+                'sender_id': m['sender_id'],
+                'is_read': m['is_read'],
+                'created_at': m['created_at'].isoformat(),
+                'expires_at': m['expires_at'].isoformat(),
+            }
+        
+        # Encoded a chunk at a time, no list of dicts or whole body in memory
+        logger.info(f"✅ Found {len(rows)} messages")
+        return StreamingJSONResponse(
+            {'success': True},
+            'messages', map(message_data, rows),
+            {'has_more': has_more, 'cursor': page_cursor(rows, before, after)},
+        )
     
     except Exception as e:
         logger.error(f"❌ Get messages error: {str(e)}")
@@ -543,7 +503,82 @@ def get_messages(request, contact_id):
 
 @csrf_exempt
 @require_http_methods(["POST"])
-def send_message(request):
+async def mark_read(request):
+    """Mark everything a contact sent up to a message id as read"""
+    logger.info("👁️ Mark read")
+    
+    try:
+        data = json.loads(request.body)
+        user_id = request.COOKIES.get('user_id')
+        if not user_id:
+            return JsonResponse({'success': False, 'error': 'Not authenticated'}, status=401)
+        
+        try:
+            contact_id = int(data.get('contact_id'))
+            up_to, ephemeral_up_to = parse_read_mark(data.get('up_to'), data.get('ephemeral_up_to'))
+        except (TypeError, ValueError) as e:
+            return JsonResponse({'success': False, 'error': str(e)}, status=400)
+        
+        # One UPDATE for the whole range, one read_up_to event to the contact
+        count = await apply_read_marks({(int(user_id), contact_id): (up_to, ephemeral_up_to)})
+        
+        logger.info(f"✅ Marked {count} messages read")
+        return JsonResponse({'success': True, 'marked': count})
+    
+    except Exception as e:
+        logger.error(f"❌ Mark read error: {str(e)}")
+        import traceback
+        traceback.print_exc()
+        return JsonResponse({'success': False, 'error': str(e)}, status=500)
+
+@csrf_exempt
+@require_http_methods(["GET"])
+async def get_conversations(request):
+    """Sidebar: accepted contacts with last message, unread count and expiry"""
+    logger.info("🗂️ Get conversations")
+    
+    try:
+        user_id = request.COOKIES.get('user_id')
+        if not user_id:
+            return JsonResponse({'success': False, 'error': 'Not authenticated'}, status=401)
+        
+        now = timezone.now()
+        summaries = await aconversation_summaries(int(user_id), now)
+        
+        def isoformat(value):
+            return value.isoformat() if value else None
+        
+        conversations_data = [{
+            'id': s['id'],
+            'telegram_id': s['telegram_id'],
+            'name': s['name'],
+            'username': s['username'],
+            'is_online': s['is_online'],
+            'last_seen': isoformat(s['last_seen']),
+            'last_message': {
+                'id': s['last_message']['id'],
+                'content': s['last_message']['text'],
+                'sender_id': s['last_message']['sender_id'],
+                'is_read': s['last_message']['is_read'],
+                'created_at': s['last_message']['created_at'].isoformat(),
+                'expires_at': s['last_message']['expires_at'].isoformat(),
+            } if s['last_message'] else None,
+            'unread_count': s['unread_count'],
+            'unread_expires_at': isoformat(s['unread_expires_at']),
+        } for s in summaries]
+        
+        logger.info(f"✅ Found {len(conversations_data)} conversations")
+        return JSONResponse({'success': True, 'conversations': conversations_data})
+    
+    except Exception as e:
+        logger.error(f"❌ Get conversations error: {str(e)}")
+        import traceback
+        traceback.print_exc()
+        return JsonResponse({'success': False, 'error': str(e)}, status=500)
+
+@csrf_exempt
+@require_http_methods(["POST"])
+async def send_message(request):
     """Send a message"""
     logger.info("📤 Send message")
     
@@ -558,23 +593,29 @@ def send_message(request):
             return JsonResponse({'success': False, 'error': 'Missing fields'}, status=400)
         
         # Check if users are contacts
-        contact_exists = Contact.objects.filter(
+        contact_exists = await Contact.objects.filter(
             user_id=user_id,
             contact_id=to_user_id,
             is_accepted=True
-        ).exists()
+        ).aexists()
         
         if not contact_exists:
             return JsonResponse({'success': False, 'error': 'Not a contact'}, status=403)
         
-        # Create message
+        # Create message (batched with the WebSocket inserts on the writer thread)
         expires_at = timezone.now() + timedelta(seconds=expire_seconds)
-        message = Message.objects.create(
+        message = await get_message_batcher().submit(Message(
             sender_id=user_id,
             receiver_id=to_user_id,
             text=content,
             expires_at=expires_at
-        )
+        ))
+        
+        # Push a messages_expired event to both sides when it expires
+        sender = await identity_cache.aget(id=user_id)
+        receiver = await identity_cache.aget(id=to_user_id)
+        if sender and receiver:
+            expiry_scheduler.schedule(message.id, expires_at, sender.telegram_id, receiver.telegram_id)
         
         logger.info(f"✅ Message sent: {user_id} -> {to_user_id}")
         return JsonResponse({
@@ -591,4 +632,257 @@ def send_message(request):
         logger.error(f"❌ Send message error: {str(e)}")
         import traceback
         traceback.print_exc()
-        return JsonResponse({'success': False, 'error': str(e)}, status=500)
\ No newline at end of file
+        return JsonResponse({'success': False, 'error': str(e)}, status=500)
+
+# ========================
+# 📎 MEDIA UPLOADS
+# ========================
+def media_message_data(message):
+    return {
+        'id': message.id,
+        'message_type': message.message_type,
+        'file_name': message.file_name,
+        'file_size': message.file_size,
+        'url': media_url(message.id) if message.media_file else None,
+        'thumbnail_url': media_url(message.id, thumbnail=True) if message.media_thumbnail else None,
+        'sender_id': message.sender_id,
+        'created_at': message.created_at.isoformat(),
+        'expires_at': message.expires_at.isoformat(),
+    }
+
+async def get_own_upload(request, upload_id):
+    """The upload if it belongs to the cookie user, else None"""
+    user_id = request.COOKIES.get('user_id')
+    if not user_id:
+        return None
+    return await MediaUpload.objects.filter(id=upload_id, uploader_id=user_id).afirst()
+
+@csrf_exempt
+@require_http_methods(["POST"])
+async def create_upload(request):
+    """Start a resumable media upload"""
+    logger.info("📎 Create upload")
+    
+    try:
+        data = json.loads(request.body)
+        user_id = request.COOKIES.get('user_id')
+        to_user_id = data.get('to_user_id')
+        file_name = os.path.basename(data.get('file_name') or '')
+        
+        if not user_id or not to_user_id or not file_name:
+            return JsonResponse({'success': False, 'error': 'Missing fields'}, status=400)
+        
+        try:
+            file_size = int(data.get('file_size'))
+            expire_seconds = int(data.get('expire_seconds', 86400))  # Default 24 hours
+        except (TypeError, ValueError):
+            return JsonResponse({'success': False, 'error': 'Invalid file_size'}, status=400)
+        
+        if not 0 < file_size <= settings.MEDIA_UPLOAD_MAX_SIZE:
+            return JsonResponse({'success': False, 'error': 'File too large'}, status=413)
+        
+        quota = getattr(settings, 'MEDIA_QUOTA_PER_USER', None)
+        if quota and await sync_to_async(user_media_usage)(user_id) + file_size > quota:
+            return JsonResponse({'success': False, 'error': 'Media quota exceeded'}, status=413)
+        
+        message_type = media_type(file_name)
+        if not message_type:
+            return JsonResponse({'success': False, 'error': 'Only images and videos'}, status=400)
+        
+        contact_exists = await Contact.objects.filter(
+            user_id=user_id,
+            contact_id=to_user_id,
+            is_accepted=True
+        ).aexists()
+        if not contact_exists:
+            return JsonResponse({'success': False, 'error': 'Not a contact'}, status=403)
+        
+        upload = await MediaUpload.objects.acreate(
+            uploader_id=user_id,
+            receiver_id=to_user_id,
+            message_type=message_type,
+            file_name=file_name,
+            file_size=file_size,
+            expire_seconds=expire_seconds,
+        )
+        await sync_to_async(create_part_file, thread_sensitive=False)(upload.id)
+        
+        logger.info(f"✅ Upload created: {upload.id} ({file_size} bytes)")
+        return JsonResponse({
+            'success': True,
+            'upload_id': str(upload.id),
+            'offset': 0,
+            'chunk_size': settings.MEDIA_UPLOAD_CHUNK_SIZE,
+        })
+    
+    except Exception as e:
+        logger.error(f"❌ Create upload error: {str(e)}")
+        import traceback
+        traceback.print_exc()
+        return JsonResponse({'success': False, 'error': str(e)}, status=500)
+
+@csrf_exempt
+@require_http_methods(["GET", "PATCH"])
+async def upload_chunk(request, upload_id):
+    """GET: current offset (to resume). PATCH: append the body at Upload-Offset"""
+    try:
+        upload = await get_own_upload(request, upload_id)
+        if not upload:
+            return JsonResponse({'success': False, 'error': 'Upload not found'}, status=404)
+        
+        if request.method == 'GET' or upload.message_id:
+            return JsonResponse({
+                'success': True,
+                'offset': upload.received,
+                'file_size': upload.file_size,
+                'complete': upload.message_id is not None,
+            })
+        
+        try:
+            offset = int(request.headers['Upload-Offset'])
+            length = int(request.headers['Content-Length'])
+        except (KeyError, ValueError):
+            return JsonResponse({'success': False, 'error': 'Upload-Offset and Content-Length required'}, status=400)
+        
+        if length > settings.MEDIA_UPLOAD_CHUNK_SIZE:
+            return JsonResponse({'success': False, 'error': 'Chunk too large'}, status=413)
+        
+        try:
+            # Streamed request body -> part file, off the event loop
+            received = await sync_to_async(write_chunk, thread_sensitive=False)(
+                upload, request, offset, length
+            )
+        except OffsetMismatch as e:
+            return JsonResponse({'success': False, 'error': 'Offset mismatch', 'offset': e.offset}, status=409)
+        except ValueError as e:
+            return JsonResponse({'success': False, 'error': str(e)}, status=400)
+        
+        await MediaUpload.objects.filter(id=upload.id).aupdate(received=received, updated_at=timezone.now())
+        return JsonResponse({'success': True, 'offset': received, 'file_size': upload.file_size})
+    
+    except Exception as e:
+        logger.error(f"❌ Upload chunk error: {str(e)}")
+        import traceback
+        traceback.print_exc()
+        return JsonResponse({'success': False, 'error': str(e)}, status=500)
+
+@csrf_exempt
+@require_http_methods(["POST"])
+async def finish_upload(request, upload_id):
+    """Turn a fully received upload into an image/video message"""
+    logger.info(f"📎 Finish upload {upload_id}")
+    
+    try:
+        upload = await get_own_upload(request, upload_id)
+        if not upload:
+            return JsonResponse({'success': False, 'error': 'Upload not found'}, status=404)
+        
+        if upload.message_id:
+            # Retried request, already done
+            message = await Message.objects.using(message_db_for_id(upload.message_id)).filter(id=upload.message_id).afirst()
+            if not message:
+                return JsonResponse({'success': False, 'error': 'Message expired'}, status=404)
+            return JsonResponse({'success': True, 'message': media_message_data(message)})
+        
+        if upload.received != upload.file_size:
+            return JsonResponse({'success': False, 'error': 'Upload incomplete', 'offset': upload.received}, status=409)
+        
+        message = await acomplete_upload(upload)
+        
+        # Push a messages_expired event to both sides when it expires
+        sender = await identity_cache.aget(id=message.sender_id)
+        receiver = await identity_cache.aget(id=message.receiver_id)
+        if sender and receiver:
+            expiry_scheduler.schedule(message.id, message.expires_at, sender.telegram_id, receiver.telegram_id)
+            await get_channel_layer().group_send(
+                f'chat_{receiver.telegram_id}',
+                {
+                    'type': 'media_message',
+                    'from_user_id': str(sender.telegram_id),
+                    'message': media_message_data(message),
+                }
+            )
+        
+        logger.info(f"✅ Media message {message.id} created from upload {upload.id}")
+        return JsonResponse({'success': True, 'message': media_message_data(message)})
+    
+    except Exception as e:
+        logger.error(f"❌ Finish upload error: {str(e)}")
+        import traceback
+        traceback.print_exc()
+        return JsonResponse({'success': False, 'error': str(e)}, status=500)
+
+# ========================
+# 🖼️ MEDIA SERVING
+# ========================
+async def get_participant_message(request, message_id):
+    """The unexpired message if the cookie user sent or received it, else None"""
+    user_id = request.COOKIES.get('user_id')
+    if not user_id:
+        return None
+    return await Message.objects.using(message_db_for_id(message_id)).filter(
+        Q(sender_id=user_id) | Q(receiver_id=user_id),
+        id=message_id,
+        expires_at__gt=timezone.now(),
+    ).only('id', 'file_name', 'media_file', 'media_thumbnail', 'expires_at').afirst()
+
+async def serve_message_file(request, message_id, thumbnail):
+    try:
+        message = await get_participant_message(request, message_id)
+        field = message and (message.media_thumbnail if thumbnail else message.media_file)
+        if not field:
+            return JsonResponse({'success': False, 'error': 'Not found'}, status=404)
+
+        if thumbnail:
+            content_type, file_name = 'image/jpeg', None
+        else:
+            content_type = mimetypes.guess_type(message.file_name or '')[0] or 'application/octet-stream'
+            file_name = message.file_name
+        # Content never changes; cache it until the message expires
+        max_age = (message.expires_at - timezone.now()).total_seconds()
+
+        return await sync_to_async(media_response, thread_sensitive=False)(
+            request, field, content_type, file_name, max_age
+        )
+
+    except FileNotFoundError:
+        logger.warning(f"⚠️ Media file missing for message {message_id}")
+        return JsonResponse({'success': False, 'error': 'Not found'}, status=404)
+    except Exception as e:
+        logger.error(f"❌ Serve media error: {str(e)}")
+        import traceback
+        traceback.print_exc()
+        return JsonResponse({'success': False, 'error': str(e)}, status=500)
+
+@require_http_methods(["GET"])
+async def serve_media(request, message_id):
+    """Message media file, with Range support for video seeking"""
+    return await serve_message_file(request, message_id, thumbnail=False)
+
+@require_http_methods(["GET"])
+async def serve_thumbnail(request, message_id):
+    """Message thumbnail"""
+    return await serve_message_file(request, message_id, thumbnail=True)
+
+# ========================
+# 📊 METRICS
+# ========================
+@require_http_methods(["GET"])
+def metrics(request):
+    """In-process cache and queue counters (DEBUG or staff only)"""
+    if not settings.DEBUG and not request.user.is_staff:
+        return JsonResponse({'success': False, 'error': 'Forbidden'}, status=403)
+    
+    return JsonResponse({
+        'success': True,
+        'identity_cache': identity_cache.stats(),
+        'reaper': reaper_stats,
+        'expiry_scheduler': expiry_scheduler.stats(),
+        'contact_cache': contact_cache.stats(),
+        'autocomplete': autocomplete_index.stats(),
+        'consumer_db': consumer_db.stats(),
+        'db_writer': db_writer.stats(),
+        'thumbnails': thumbnail_worker.stats(),
+        'media_gc': media_collector.stats(),
+        'queries': query_report.stats(),
+    })
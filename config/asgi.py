@@ -14,15 +14,16 @@ from django.core.asgi import get_asgi_application
 from channels.routing import ProtocolTypeRouter, URLRouter
 from channels.auth import AuthMiddlewareStack
 from accounts.routing import websocket_urlpatterns
+from accounts.background import BackgroundTasksMiddleware
 
 # 4️⃣ ASGI application yaratish
-application = ProtocolTypeRouter({
+application = BackgroundTasksMiddleware(ProtocolTypeRouter({
     'http': get_asgi_application(),
     'websocket': AuthMiddlewareStack(
         URLRouter(
             websocket_urlpatterns
         )
     ),
-})
+}))
 
 print("✅ ASGI application loaded successfully!")
\ No newline at end of file
@@ -0,0 +1,356 @@
+"""
+Channel layers used by the ASGI application.
+
+``SQLiteChannelLayer`` lets several daphne worker processes on the same host
+share groups and channels through one SQLite file in WAL mode, so a message
+sent by a consumer in one process reaches sockets connected to another.
+It needs no broker: every process polls the shared file for rows addressed
+to its own process-specific channels and fans them out to local queues.
+"""
+
+import asyncio
+import os
+import pickle
+import random
+import sqlite3
+import string
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from channels.exceptions import ChannelFull
+from channels.layers import BaseChannelLayer
+
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS channel_message (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    channel TEXT NOT NULL,
+    expires REAL NOT NULL,
+    payload BLOB NOT NULL
+);
+CREATE INDEX IF NOT EXISTS channel_message_channel ON channel_message (channel, id);
+CREATE INDEX IF NOT EXISTS channel_message_expires ON channel_message (expires);
+CREATE TABLE IF NOT EXISTS channel_group (
+    grp TEXT NOT NULL,
+    channel TEXT NOT NULL,
+    joined REAL NOT NULL,
+    PRIMARY KEY (grp, channel)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS channel_group_channel ON channel_group (channel);
+"""
+
+
+class SQLiteChannelLayer(BaseChannelLayer):
+    """
+    Channel layer backed by a SQLite file shared between local processes.
+
+    Messages are pickled, like the in-memory layer copies them, so any
+    value a consumer puts in an event survives the trip. Unpickling runs
+    whatever the payload says, which is only safe because the sole writers
+    are the worker processes of this deployment: keep the file (and its
+    ``-wal``/``-shm`` companions) in a directory only their user can write,
+    never on a shared or network path.
+    """
+
+    extensions = ["groups", "flush"]
+
+    def __init__(
+        self,
+        path='channels.sqlite3',
+        expiry=60,
+        group_expiry=86400,
+        capacity=100,
+        channel_capacity=None,
+        poll_interval=0.05,
+        cleanup_interval=5,
+        **kwargs,
+    ):
+        super().__init__(expiry=expiry, capacity=capacity, **kwargs)
+        self.channel_capacity = self.compile_capacities(channel_capacity or {})
+        self.path = str(path)
+        self.group_expiry = group_expiry
+        self.poll_interval = poll_interval
+        self.cleanup_interval = cleanup_interval
+
+        # Every process gets its own prefix for process-specific channels
+        self.client_prefix = "sqlite_%s_%s" % (
+            os.getpid(),
+            "".join(random.choice(string.ascii_letters) for _ in range(8)),
+        )
+        self.receive_buffer = {}
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='channel-layer')
+        self._local = threading.local()
+        self._poller = None
+        self._poller_loop = None
+        self._last_cleanup = 0.0
+
+    # ========================
+    # SQLite access (runs on the layer's own thread)
+    # ========================
+    def _connection(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=OFF')
+            conn.executescript(SCHEMA)
+            self._local.conn = conn
+        return conn
+
+    async def _run(self, func, *args):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._executor, func, *args)
+
+    def _db_send(self, channels, payload, expires):
+        """Insert one payload for each channel that still has capacity."""
+        conn = self._connection()
+        now = time.time()
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            placeholders = ','.join('?' * len(channels))
+            depth = dict(conn.execute(
+                'SELECT channel, COUNT(*) FROM channel_message '
+                'WHERE channel IN (%s) AND expires >= ? GROUP BY channel' % placeholders,
+                (*channels, now),
+            ).fetchall())
+            rows, full = [], []
+            for channel in channels:
+                if depth.get(channel, 0) >= self.get_capacity(channel):
+                    full.append(channel)
+                else:
+                    rows.append((channel, expires, payload))
+            conn.executemany(
+                'INSERT INTO channel_message (channel, expires, payload) VALUES (?, ?, ?)',
+                rows,
+            )
+            conn.execute('COMMIT')
+        except BaseException:
+            conn.execute('ROLLBACK')
+            raise
+        return full
+
+    def _db_group_channels(self, group):
+        conn = self._connection()
+        cutoff = time.time() - self.group_expiry
+        return [
+            row[0] for row in conn.execute(
+                'SELECT channel FROM channel_group WHERE grp = ? AND joined >= ?',
+                (group, cutoff),
+            )
+        ]
+
+    def _db_pop(self, low, high):
+        """Remove and return every pending row with low <= channel < high."""
+        conn = self._connection()
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            rows = conn.execute(
+                'SELECT id, channel, expires, payload FROM channel_message '
+                'WHERE channel >= ? AND channel < ? ORDER BY id',
+                (low, high),
+            ).fetchall()
+            if rows:
+                conn.execute(
+                    'DELETE FROM channel_message WHERE channel >= ? AND channel < ? AND id <= ?',
+                    (low, high, rows[-1][0]),
+                )
+            conn.execute('COMMIT')
+        except BaseException:
+            conn.execute('ROLLBACK')
+            raise
+        return rows
+
+    def _db_pop_one(self, channel):
+        conn = self._connection()
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            row = conn.execute(
+                'SELECT id, expires, payload FROM channel_message '
+                'WHERE channel = ? AND expires >= ? ORDER BY id LIMIT 1',
+                (channel, time.time()),
+            ).fetchone()
+            if row:
+                conn.execute('DELETE FROM channel_message WHERE id = ?', (row[0],))
+            conn.execute('COMMIT')
+        except BaseException:
+            conn.execute('ROLLBACK')
+            raise
+        return row
+
+    def _db_cleanup(self):
+        """Drop expired messages, and memberships of channels that let them expire."""
+        conn = self._connection()
+        now = time.time()
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            conn.execute(
+                'DELETE FROM channel_group WHERE channel IN '
+                '(SELECT DISTINCT channel FROM channel_message WHERE expires < ?)',
+                (now,),
+            )
+            conn.execute('DELETE FROM channel_message WHERE expires < ?', (now,))
+            conn.execute('DELETE FROM channel_group WHERE joined < ?', (now - self.group_expiry,))
+            conn.execute('COMMIT')
+        except BaseException:
+            conn.execute('ROLLBACK')
+            raise
+
+    def _db_execute(self, sql, params=()):
+        self._connection().execute(sql, params)
+
+    # ========================
+    # Channel layer API
+    # ========================
+    async def send(self, channel, message):
+        assert isinstance(message, dict), "message is not a dict"
+        self.require_valid_channel_name(channel)
+        assert "__asgi_channel__" not in message
+
+        if self._is_local(channel):
+            # Same process: skip the database entirely
+            self._deliver_local(channel, message)
+            return
+
+        payload = pickle.dumps(message, protocol=pickle.HIGHEST_PROTOCOL)
+        full = await self._run(self._db_send, [channel], payload, time.time() + self.expiry)
+        if full:
+            raise ChannelFull(channel)
+
+    async def receive(self, channel):
+        self.require_valid_channel_name(channel)
+
+        if "!" in channel:
+            # Process-specific channel, fed by this process' poller
+            self._ensure_poller()
+            queue = self._buffer_for(channel)
+            try:
+                return await queue.get()
+            finally:
+                if queue.empty():
+                    self.receive_buffer.pop(channel, None)
+
+        # Normal channel shared by all processes: poll for it directly
+        delay = 0.001
+        while True:
+            row = await self._run(self._db_pop_one, channel)
+            if row:
+                return pickle.loads(row[2])
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, self.poll_interval)
+
+    async def new_channel(self, prefix="specific"):
+        return "%s.%s!%s" % (
+            self.client_prefix,
+            prefix.rstrip("."),
+            "".join(random.choice(string.ascii_letters) for _ in range(12)),
+        )
+
+    # Flush extension
+
+    async def flush(self):
+        await self._run(self._db_execute, 'DELETE FROM channel_message')
+        await self._run(self._db_execute, 'DELETE FROM channel_group')
+        self.receive_buffer = {}
+
+    async def close(self):
+        if self._poller is not None:
+            self._poller.cancel()
+            self._poller = None
+
+    # Groups extension
+
+    async def group_add(self, group, channel):
+        self.require_valid_group_name(group)
+        self.require_valid_channel_name(channel)
+        await self._run(
+            self._db_execute,
+            'INSERT OR REPLACE INTO channel_group (grp, channel, joined) VALUES (?, ?, ?)',
+            (group, channel, time.time()),
+        )
+
+    async def group_discard(self, group, channel):
+        self.require_valid_channel_name(channel)
+        self.require_valid_group_name(group)
+        await self._run(
+            self._db_execute,
+            'DELETE FROM channel_group WHERE grp = ? AND channel = ?',
+            (group, channel),
+        )
+
+    async def group_send(self, group, message):
+        assert isinstance(message, dict), "Message is not a dict"
+        self.require_valid_group_name(group)
+
+        channels = await self._run(self._db_group_channels, group)
+        remote = []
+        for channel in channels:
+            if self._is_local(channel):
+                try:
+                    self._deliver_local(channel, message)
+                except ChannelFull:
+                    pass
+            else:
+                remote.append(channel)
+
+        if remote:
+            # One serialization and one transaction for the whole fan-out;
+            # channels at capacity silently miss the message, like in-memory
+            payload = pickle.dumps(message, protocol=pickle.HIGHEST_PROTOCOL)
+            await self._run(self._db_send, remote, payload, time.time() + self.expiry)
+
+    # ========================
+    # Local delivery
+    # ========================
+    def _is_local(self, channel):
+        return "!" in channel and channel.startswith("%s." % self.client_prefix)
+
+    def _buffer_for(self, channel):
+        queue = self.receive_buffer.get(channel)
+        if queue is None:
+            queue = self.receive_buffer[channel] = asyncio.Queue(
+                maxsize=self.get_capacity(channel)
+            )
+        return queue
+
+    def _deliver_local(self, channel, message):
+        try:
+            self._buffer_for(channel).put_nowait(pickle.loads(
+                pickle.dumps(message, protocol=pickle.HIGHEST_PROTOCOL)
+            ))
+        except asyncio.QueueFull:
+            raise ChannelFull(channel)
+
+    def _ensure_poller(self):
+        loop = asyncio.get_running_loop()
+        if self._poller is None or self._poller.done() or self._poller_loop is not loop:
+            self._poller_loop = loop
+            self._poller = loop.create_task(self._poll())
+
+    async def _poll(self):
+        """Move rows addressed to this process into the local receive queues."""
+        # Local channel names all start with "<client_prefix>.", so one
+        # index range scan picks up everything addressed to this process
+        low = "%s." % self.client_prefix
+        high = "%s/" % self.client_prefix
+        delay = 0.001
+        while True:
+            now = time.time()
+            if now - self._last_cleanup > self.cleanup_interval:
+                self._last_cleanup = now
+                await self._run(self._db_cleanup)
+
+            rows = await self._run(self._db_pop, low, high)
+            for _, channel, expires, payload in rows:
+                if expires < now:
+                    continue
+                try:
+                    self._buffer_for(channel).put_nowait(pickle.loads(payload))
+                except asyncio.QueueFull:
+                    pass
+
+            if rows:
+                delay = 0.001
+            else:
+                await asyncio.sleep(delay)
+                delay = min(delay * 2, self.poll_interval)
@@ -105,6 +105,7 @@ MIDDLEWARE = [
     'django.contrib.auth.middleware.AuthenticationMiddleware',
     'django.contrib.messages.middleware.MessageMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
+    'accounts.querycount.QueryCountMiddleware',
 ]
 
 # CORS Settings
@@ -133,6 +134,66 @@ CHANNEL_LAYERS = {
         'BACKEND': 'channels.layers.InMemoryChannelLayer'
     }
 }
+# Bir nechta daphne process uchun: CHANNEL_LAYER_BACKEND=sqlite
+if os.getenv('CHANNEL_LAYER_BACKEND', 'memory') == 'sqlite':
+    CHANNEL_LAYERS['default'] = {
+        'BACKEND': 'config.channel_layers.SQLiteChannelLayer',
+        'CONFIG': {
+            'path': os.getenv('CHANNEL_LAYER_PATH', str(BASE_DIR / 'channels.sqlite3')),
+            'capacity': 100,
+            'expiry': 60,
+            'group_expiry': 86400,
+        },
+    }
+
+# WebSocket xabarlarining umri (client expire_seconds yuborishi mumkin)
+CHAT_MESSAGE_TTL = 30  # seconds
+# Mijoz so'rashi mumkin bo'lgan eng uzun umr (UI'dagi eng kattasi: 1 oy)
+CHAT_MESSAGE_MAX_TTL = 30 * 24 * 60 * 60  # seconds
+# Umri shundan qisqa xabarlar DB'ga yozilmaydi, xotirada saqlanadi (0 = o'chirilgan)
+EPHEMERAL_MESSAGE_TTL_THRESHOLD = 60  # seconds
+EPHEMERAL_MESSAGE_MAX = 100000
+
+# WebSocket xabarlarini bulk_create bilan yozish (write-behind)
+MESSAGE_BATCH_SIZE = 200
+MESSAGE_BATCH_DELAY = 0.05  # seconds
+# Online/offline holatini DB'ga yozish oralig'i
+PRESENCE_FLUSH_INTERVAL = 1.0  # seconds
+# Har bir process o'z ulanishlarini PresenceConnection jadvalida yangilab turadi;
+# shu muddatdan eski yozuvlar o'lgan processniki hisoblanadi
+PRESENCE_HEARTBEAT_INTERVAL = 15  # seconds
+PRESENCE_STALE_AFTER = 60  # seconds
+# id <-> telegram_id <-> username keshi (LRU + TTL)
+IDENTITY_CACHE_SIZE = 10000
+IDENTITY_CACHE_TTL = 300  # seconds
+# Muddati o'tgan xabarlarni fonda o'chirish (manage.py reap_messages ham bor)
+MESSAGE_REAPER_ENABLED = os.getenv('MESSAGE_REAPER_ENABLED', '1') == '1'
+MESSAGE_REAPER_INTERVAL = 30  # seconds
+MESSAGE_REAPER_BATCH_SIZE = 1000
+MESSAGE_REAPER_MAX_BATCHES = 50  # per run
+# Xabar muddati tugaganda ikkala tomonga messages_expired event yuborish
+EXPIRY_EVENTS_ENABLED = True
+EXPIRY_EVENTS_TICK = 1.0  # seconds
+# Bazadagi xabarlarni faqat shu lock faylni ushlagan bitta process kuzatadi
+EXPIRY_LOCK_FILE = os.environ.get('EXPIRY_LOCK_FILE')  # None: vaqtinchalik papkada vchat-expiry.lock
+EXPIRY_LOAD_INTERVAL = 5.0  # seconds, yangi xabarlarni yuklash oralig'i
+# WebSocket consumerlarning DB ishlari uchun alohida thread pool
+CONSUMER_DB_WORKERS = int(os.environ.get('CONSUMER_DB_WORKERS', '8'))
+# Har bir foydalanuvchining kontaktlar ro'yxati keshi (ETag bilan)
+CONTACT_CACHE_SIZE = 10000
+CONTACT_CACHE_TTL = 300  # seconds
+# Username / ism bo'yicha xotiradagi autocomplete indeksi (startda to'ldiriladi)
+AUTOCOMPLETE_ENABLED = True
+AUTOCOMPLETE_LIMIT = 10
+# Boshqa processlar saqlagan akkauntlar shu oraliqda qo'shiladi
+AUTOCOMPLETE_REFRESH_INTERVAL = 60  # seconds
+AUTOCOMPLETE_REWARM_INTERVAL = 3600  # seconds, to'liq qayta yuklash
+# O'qilganlik belgilari shu oraliqda bitta UPDATE bilan yoziladi
+READ_RECEIPT_FLUSH_INTERVAL = 0.5  # seconds
+# Har bir so'rov / WebSocket frame'dagi querylar soni (accounts/querycount.py)
+QUERY_COUNT_WARN = 30  # shundan ko'p query bo'lsa log
+QUERY_REPEAT_THRESHOLD = 5  # bir xil query shuncha marta takrorlansa N+1 deb log
+
 TEMPLATES = [
     {
         'BACKEND': 'django.template.backends.django.DjangoTemplates',
@@ -160,8 +221,36 @@ DATABASES = {
     'default': {
         'ENGINE': 'django.db.backends.sqlite3',
         'NAME': BASE_DIR / 'db.sqlite3',
+        # Ulanishlar qayta ishlatiladi (har so'rovda qayta ulanmaslik uchun)
+        'CONN_MAX_AGE': 600,
+        'CONN_HEALTH_CHECKS': True,
+        'OPTIONS': {
+            # WAL: o'qishlar yozishni kutmaydi; busy_timeout o'rniga 'timeout' (sekund)
+            'init_command': (
+                'PRAGMA journal_mode=WAL;'
+                'PRAGMA synchronous=NORMAL;'
+                'PRAGMA cache_size=-20000;'
+                'PRAGMA temp_store=MEMORY;'
+                'PRAGMA mmap_size=134217728;'
+            ),
+            'timeout': 20,
+            # Yozish lock'i tranzaksiya boshida olinadi: deadlock/"database is locked" bo'lmaydi
+            'transaction_mode': 'IMMEDIATE',
+        },
     }
 }
+# Xabarlar suhbat bo'yicha N ta SQLite faylga bo'linadi (accounts/sharding.py); 1 = faqat default
+MESSAGE_SHARDS = int(os.getenv('MESSAGE_SHARDS', '1'))
+if MESSAGE_SHARDS > 1:
+    for _index in range(MESSAGE_SHARDS):
+        DATABASES[f'messages_{_index}'] = {
+            **DATABASES['default'],
+            'NAME': BASE_DIR / f'messages_{_index}.sqlite3',
+        }
+DATABASE_ROUTERS = ['accounts.sharding.MessageRouter']
+# Barcha yozishlar bitta writer thread orqali, group commit bilan (accounts/db_executor.py)
+DB_SINGLE_WRITER = os.getenv('DB_SINGLE_WRITER', '1') == '1'
+DB_WRITER_MAX_BATCH = 64
 
 
 # Password validation
@@ -206,10 +295,40 @@ STATICFILES_DIRS = [
 # Media files
 MEDIA_URL = '/media/'
 MEDIA_ROOT = os.path.join(BASE_DIR, 'media')
+# Media faqat suhbat ishtirokchilariga /api/media/<id>/ orqali beriladi (Range, ETag)
+MEDIA_BLOCK_SIZE = 262144  # 256KB
+# nginx orqasida: 'X-Accel-Redirect' (internal location MEDIA_SENDFILE_PREFIX -> MEDIA_ROOT)
+MEDIA_SENDFILE_HEADER = os.environ.get('MEDIA_SENDFILE_HEADER') or None
+MEDIA_SENDFILE_PREFIX = '/protected-media/'
 
 # File upload settings
-FILE_UPLOAD_MAX_MEMORY_SIZE = 20971520  # 20MB
+# Bundan katta so'rov tanasi xotirada emas, diskda saqlanadi (ASGI)
+FILE_UPLOAD_MAX_MEMORY_SIZE = 2621440  # 2.5MB
 DATA_UPLOAD_MAX_MEMORY_SIZE = 20971520  # 20MB
+# Media fayllar bo'laklab (resumable) yuklanadi
+MEDIA_UPLOAD_TEMP_DIR = os.path.join(BASE_DIR, 'media_uploads')
+MEDIA_UPLOAD_CHUNK_SIZE = 4194304  # 4MB
+MEDIA_UPLOAD_MAX_SIZE = 524288000  # 500MB
+MEDIA_UPLOAD_EXPIRE_SECONDS = 86400  # tugallanmagan upload'lar 24 soatdan keyin o'chiriladi
+# Hech bir xabarga tegishli bo'lmagan media fayllarni fonda tozalash (manage.py collect_media ham bor)
+MEDIA_GC_ENABLED = os.getenv('MEDIA_GC_ENABLED', '1') == '1'
+MEDIA_GC_INTERVAL = 300  # seconds between passes
+MEDIA_GC_BATCH_SIZE = 500  # files
+MEDIA_GC_MAX_BATCHES = 20  # per run
+MEDIA_GC_PAUSE = 0.05  # seconds between batches
+MEDIA_GC_GRACE_SECONDS = 3600  # yangi fayllarga tegilmaydi
+MEDIA_GC_SNAPSHOT_REBUILD = 12  # passes; o'chirilgan xabarlar nomlari shundan keyin tushadi
+# Disk kvotalari (bytes); None = cheklovsiz
+MEDIA_QUOTA_PER_USER = int(os.getenv('MEDIA_QUOTA_PER_USER', str(2 * 1024 ** 3)))  # 2GB
+MEDIA_QUOTA_TOTAL = int(os.getenv('MEDIA_QUOTA_TOTAL', '0')) or None
+# Thumbnail'lar alohida process pool'da yasaladi (ThumbnailJob navbati)
+THUMBNAIL_WORKER_ENABLED = os.environ.get('THUMBNAIL_WORKER_ENABLED', '1') == '1'
+THUMBNAIL_WORKERS = int(os.environ.get('THUMBNAIL_WORKERS', '2'))  # processes
+THUMBNAIL_SIZE = 320  # px, longest side
+THUMBNAIL_BATCH_SIZE = 8
+THUMBNAIL_POLL_INTERVAL = 1.0  # seconds
+THUMBNAIL_JOB_TIMEOUT = 300  # seconds
+THUMBNAIL_MAX_ATTEMPTS = 3
 # Default primary key field type
 # https://docs.djangoproject.com/en/5.2/ref/settings/#default-auto-field
 
@@ -27,5 +27,6 @@ urlpatterns = [
 
     path('', include('accounts.urls')),
 
-] + static(settings.MEDIA_URL, document_root=settings.MEDIA_ROOT) + static(settings.STATIC_URL, document_root=settings.STATIC_ROOT)
+    # Media is served by accounts.views.serve_media (participants only)
+] + static(settings.STATIC_URL, document_root=settings.STATIC_ROOT)
 